@@ -0,0 +1,116 @@
+'''
+Encode / decode throughput of the Music FaderNets models, for sizing inference machines.
+Runs on random token batches, so no dataset is needed. CPU by default.
+'''
+import json
+import time
+import argparse
+import torch
+import numpy as np
+from model_v2 import *
+from gmm_model import *
+
+# model dimensions
+EVENT_DIMS = 342
+RHYTHM_DIMS = 3
+NOTE_DIMS = 16
+CHROMA_DIMS = 24
+
+MODELS = {
+    "vanilla": (MusicAttrRegVAE, "model_config_v2.json"),
+    "gmm": (MusicAttrRegGMVAE, "gmm_model_config.json"),
+    "singlevae": (MusicAttrSingleVAE, "model_config_v2.json"),
+    "cvae": (MusicAttrCVAE, "model_config_v2.json"),
+    "fader": (MusicAttrFaderNets, "model_config_v2.json"),
+}
+
+
+def get_model(name, device, save_path=None):
+    model_class, config_path = MODELS[name]
+    with open(config_path) as f:
+        args = json.load(f)
+    kwargs = {"n_component": args["num_clusters"]} if name == "gmm" else {}
+    model = model_class(roll_dims=EVENT_DIMS, rhythm_dims=RHYTHM_DIMS, note_dims=NOTE_DIMS,
+                        chroma_dims=CHROMA_DIMS,
+                        hidden_dims=args['hidden_dim'], z_dims=args['z_dim'],
+                        n_step=args['time_step'], device=device, **kwargs)
+    if save_path is not None:
+        print("Loading {}".format(save_path))
+        model.load_state_dict(torch.load(save_path, map_location=device))
+    return model.eval()
+
+
+def encode(name, model, d, lengths):
+    if name == "gmm":
+        return model.encode(d, lengths)
+    if name == "cvae":
+        density = torch.full((d.size(0), 1), 0.5, device=d.device)
+        return model.encoder(d, density, density, None, lengths)
+    return model.encoder(d, lengths)
+
+
+def get_means(dis):
+    # encoders return one distribution or a tuple of them
+    dis = dis if isinstance(dis, tuple) else (dis,)
+    return torch.cat([k.mean for k in dis], dim=-1)
+
+
+def check_encoder(name, model, d, lengths, tol=1e-5):
+    '''
+    Token and one-hot inputs of a mixed-length batch give the same packed encoder output,
+    and extra padding does not change it.
+    '''
+    h = get_means(encode(name, model, d, lengths))
+    h_oh = get_means(encode(name, model, F.one_hot(d, EVENT_DIMS).float(), lengths))
+    h_pad = get_means(encode(name, model, F.pad(d, (0, 10)), lengths))
+    diff = max((h - h_oh).abs().max().item(), (h - h_pad).abs().max().item())
+    print("Encoder check - max difference (one-hot / padded): {:.2e}".format(diff))
+    assert diff < tol, "token and one-hot encoder outputs differ"
+
+
+def timeit(func, num_batches):
+    func()      # warm-up
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        func()
+    return (time.perf_counter() - start) / num_batches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Encode / decode throughput benchmark.')
+    parser.add_argument('--model', default="vanilla", choices=sorted(MODELS))
+    parser.add_argument('--device', default="cpu", help='Torch device, e.g. cpu or cuda:0')
+    parser.add_argument('--save_path', default=None, help='Optional checkpoint to load')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--seq_len', type=int, default=100, help='Maximum input tokens')
+    parser.add_argument('--steps', type=int, default=100, help='Decoded tokens per sample')
+    parser.add_argument('--num_batches', type=int, default=10)
+    parser.add_argument('--num_threads', type=int, default=None, help='Intra-op CPU threads')
+    input_args = parser.parse_args()
+
+    if input_args.num_threads is not None:
+        torch.set_num_threads(input_args.num_threads)
+    device = torch.device(input_args.device)
+    model = get_model(input_args.model, device, input_args.save_path)
+    print('Using: ', device, '- threads:', torch.get_num_threads())
+
+    # random token batches with lengths between half and full `seq_len`
+    batch_size, seq_len = input_args.batch_size, input_args.seq_len
+    lengths = torch.randint(seq_len // 2, seq_len + 1, (batch_size,), device=device)
+    d = torch.randint(2, EVENT_DIMS, (batch_size, seq_len), device=device)
+    d[torch.arange(seq_len, device=device) >= lengths.unsqueeze(1)] = 0
+    z = torch.randn(batch_size, model.linear_init_global.in_features, device=device)
+
+    with torch.no_grad():
+        check_encoder(input_args.model, model, d, lengths)
+        t_encode = timeit(lambda: encode(input_args.model, model, d, lengths), input_args.num_batches)
+        d_oh = F.one_hot(d, EVENT_DIMS).float()
+        t_encode_oh = timeit(lambda: encode(input_args.model, model, d_oh, lengths), input_args.num_batches)
+        t_decode = timeit(lambda: model.global_decoder(z, steps=input_args.steps), input_args.num_batches)
+
+    print("Encode: {:.1f} samples/s, {:.1f} tokens/s ({:.2f} ms / batch)".format(
+        batch_size / t_encode, lengths.sum().item() / t_encode, t_encode * 1000))
+    print("Encode (one-hot input): {:.1f} samples/s ({:.2f} ms / batch)".format(
+        batch_size / t_encode_oh, t_encode_oh * 1000))
+    print("Decode: {:.1f} samples/s, {:.1f} tokens/s ({:.2f} ms / batch)".format(
+        batch_size / t_decode, batch_size * input_args.steps / t_decode, t_decode * 1000))
@@ -0,0 +1,100 @@
+'''
+Shared data loading for the trainers: length-bucketed batches collated into model dtypes
+by worker processes, pinned host memory, and batches prefetched onto the device.
+'''
+import os
+import torch
+from functools import partial
+from torch.utils.data import DataLoader
+from ptb_v2 import *
+
+
+def collate_batch(batch, num_of_padded=1):
+    '''
+    `collate_padded`, with integer fields (tokens, rhythm, notes) as int64 and float fields
+    (chroma, densities, labels) as float32, ready for the models.
+    '''
+    return [k.float() if torch.is_floating_point(k) else k.long()
+            for k in collate_padded(batch, num_of_padded=num_of_padded)]
+
+
+def get_num_workers(num_workers=None):
+    '''
+    Loader worker processes, by default up to 4 depending on the available CPUs.
+    '''
+    if num_workers is None:
+        num_workers = min(4, os.cpu_count() or 1)
+    return num_workers
+
+
+class DeviceLoader:
+    '''
+    Iterates a `DataLoader` with its batches already on `device`. The next batch is copied
+    asynchronously (from pinned memory on CUDA) while the current one is in use.
+    '''
+    def __init__(self, dl, device):
+        self.dl = dl
+        self.device = device
+
+    def __len__(self):
+        return len(self.dl)
+
+    def __iter__(self):
+        batch = None
+        for next_batch in self.dl:
+            next_batch = [k.to(self.device, non_blocking=True) for k in next_batch]
+            if batch is not None:
+                yield batch
+            batch = next_batch
+        if batch is not None:
+            yield batch
+
+
+def get_loader(ds, batch_size, shuffle=True, device=None, num_workers=None, num_of_padded=1,
+               bucket_size=100, prefetch_factor=4, persistent=True):
+    '''
+    Loader over a dataset with a `lengths()` method. Batches are length-bucketed, padded and
+    converted by `num_workers` worker processes (tensors reach the main process through
+    shared memory), `prefetch_factor` batches ahead per worker, and come out on `device`.
+    With `persistent`, the workers are kept between epochs; loaders iterated only once
+    should pass `persistent=False` so that their workers exit after the pass.
+    '''
+    device = get_device(device)
+    num_workers = get_num_workers(num_workers)
+    dl = DataLoader(ds, batch_sampler=BucketBatchSampler(ds.lengths(), batch_size, shuffle=shuffle,
+                                                         bucket_size=bucket_size),
+                    collate_fn=partial(collate_batch, num_of_padded=num_of_padded),
+                    num_workers=num_workers, pin_memory=device.type == "cuda",
+                    persistent_workers=persistent and num_workers > 0,
+                    prefetch_factor=prefetch_factor if num_workers > 0 else None)
+    return DeviceLoader(dl, device)
+
+
+def get_yamaha_loaders(batch_size, shuffle=True, device=None, num_workers=None):
+    '''
+    Train / validation / test datasets of the Yamaha Piano e-Competition data, and the train /
+    validation loaders iterated every epoch.
+    '''
+    data_lst, rhythm_lst, note_density_lst, chroma_lst, density_lst = get_classic_piano(return_densities=True)
+    ds_lst = [YamahaDataset(data_lst, rhythm_lst, note_density_lst, chroma_lst, mode=mode,
+                            densities=density_lst) for mode in ["train", "val", "test"]]
+    # the test split is only evaluated, through a loader of its own
+    dl_lst = [get_loader(ds, batch_size, shuffle=shuffle, device=device, num_workers=num_workers)
+              for ds in ds_lst[:2]]
+    return ds_lst, dl_lst
+
+
+def get_vgmidi_loaders(batch_size=32, shuffle=True, device=None, num_workers=None):
+    '''
+    Train / validation / test datasets of the VGMIDI data, and the train / validation loaders
+    iterated every epoch.
+    '''
+    data_lst, rhythm_lst, note_density_lst, arousal_lst, valence_lst, chroma_lst, \
+        density_lst = get_vgmidi(return_densities=True)
+    ds_lst = [VGMIDIDataset(data_lst, rhythm_lst, note_density_lst, chroma_lst, arousal_lst,
+                            valence_lst, mode=mode, densities=density_lst)
+              for mode in ["train", "val", "test"]]
+    # the test split is only evaluated, through a loader of its own
+    dl_lst = [get_loader(ds, batch_size, shuffle=shuffle, device=device, num_workers=num_workers,
+                         num_of_padded=3) for ds in ds_lst[:2]]
+    return ds_lst, dl_lst
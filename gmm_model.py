@@ -5,6 +5,7 @@ from torch.distributions import Normal
 from torch.autograd import Function
 import numpy as np
 from collections import Counter
+from model_v2 import encode_gru, as_tokens, get_token_cell_weights, token_cell
 
 
 class MusicAttrRegGMVAE(nn.Module):
@@ -20,7 +21,8 @@ class MusicAttrRegGMVAE(nn.Module):
                  hidden_dims,
                  z_dims,
                  n_step,
-                 n_component=4):
+                 n_component=4,
+                 device=None):
 
         super(MusicAttrRegGMVAE, self).__init__()
 
@@ -69,25 +71,20 @@ class MusicAttrRegGMVAE(nn.Module):
         # build latent mean and variance lookup
         self._build_mu_lookup()
         self._build_logvar_lookup(pow_exp=-2)       # a hyperparameter to set
-    
+
+        if device is not None:
+            self.to(device)
+
     def _sampling(self, x):
-        idx = x.max(1)[1]
-        x = torch.zeros_like(x)
-        arange = torch.arange(x.size(0)).long()
-        if torch.cuda.is_available():
-            arange = arange.cuda()
-        x[arange, idx] = 1
-        return x
-
-    def encode(self, x):
+        return x.max(1)[1]
+
+    def encode(self, x, lengths=None):
         # rhythm encoder
-        x_r = self.gru_r(x)[-1]
-        x_r = x_r.transpose_(0, 1).contiguous().view(x_r.size(0), -1)
+        x_r = encode_gru(self.gru_r, x, lengths)
         mu_r, var_r = self.mu_r(x_r), self.var_r(x_r).exp_()
         
         # note encoder
-        x_n = self.gru_n(x)[-1]
-        x_n = x_n.transpose_(0, 1).contiguous().view(x_n.size(0), -1)
+        x_n = encode_gru(self.gru_n, x, lengths)
         mu_n, var_n = self.mu_n(x_n), self.var_n(x_n).exp_()
 
         dis_r = Normal(mu_r, var_r)
@@ -117,20 +114,19 @@ class MusicAttrRegGMVAE(nn.Module):
         return rhythm_out, note_out, 0, 0
     
     def global_decoder(self, z, steps):
-        out = torch.zeros((z.size(0), self.roll_dims)).cuda()
-        out[:, -1] = 1.
+        # previous token, starting from the last vocabulary entry
+        out = torch.full((z.size(0),), self.roll_dims - 1, dtype=torch.long, device=z.device)
         x, hx = [], [None, None]
         t = self.linear_init_global(z)
         hx[0] = t
-        if torch.cuda.is_available():
-            out = out.cuda()
+        token_weight, static_gates = get_token_cell_weights(self.grucell_g.weight_ih,
+                                                            self.grucell_g.bias_ih, z)
         
         # if not self.training:
             # print("not training mode")
 
         for i in range(steps):
-            out = torch.cat([out, z], 1)
-            hx[0] = self.grucell_g(out, hx[0])
+            hx[0] = token_cell(self.grucell_g, token_weight, static_gates, out, hx[0])
             if i == 0:
                 hx[1] = hx[0]
             hx[1] = self.grucell_g_2(hx[0], hx[1])
@@ -139,7 +135,7 @@ class MusicAttrRegGMVAE(nn.Module):
             if self.training:
                 p = torch.rand(1).item()
                 if p < self.eps:
-                    out = self.sample[:, i, :]
+                    out = self.sample[:, i]
                 else:
                     out = self._sampling(out)
                 # self.eps = self.k / \
@@ -209,25 +205,25 @@ class MusicAttrRegGMVAE(nn.Module):
             llh = torch.sum(llh, dim=1)  # sum over dimensions
             return llh
 
-        logLogit_qy_x = torch.zeros(z.shape[0], n_component).cuda()  # log-logit of q(y|x)
-        for k_i in torch.arange(0, n_component):
-            mu_k, logvar_k = mu_lookup(k_i.cuda()), logvar_lookup(k_i.cuda())
+        logLogit_qy_x = torch.zeros(z.shape[0], n_component, device=z.device)  # log-logit of q(y|x)
+        for k_i in torch.arange(0, n_component, device=z.device):
+            mu_k, logvar_k = mu_lookup(k_i), logvar_lookup(k_i)
             logLogit_qy_x[:, k_i] = log_gauss_lh(z, mu_k, logvar_k) + np.log(1 / n_component)
 
         qy_x = torch.nn.functional.softmax(logLogit_qy_x, dim=1)
         return logLogit_qy_x, qy_x
 
-    def forward(self, x, rhythm, note, chroma):
+    def forward(self, x, rhythm, note, chroma, lengths=None):
         
         if self.training:
-            self.sample = x
+            self.sample = as_tokens(x)
         
         # ========================== INFERENCE ====================== #
         # infer latent
-        dis_r, dis_n = self.encode(x)
+        dis_r, dis_n = self.encode(x, lengths)
         
         def repar(mu, stddev, sigma=1):
-            eps = Normal(0, sigma).sample(sample_shape=stddev.size()).cuda()
+            eps = torch.randn_like(stddev) * sigma
             z = mu + stddev * eps  # reparameterization trick
             return z
 
@@ -270,7 +266,8 @@ class MusicAttrSingleGMVAE(nn.Module):
                  hidden_dims,
                  z_dims,
                  n_step,
-                 n_component=4):
+                 n_component=4,
+                 device=None):
 
         super(MusicAttrSingleGMVAE, self).__init__()
 
@@ -299,39 +296,34 @@ class MusicAttrSingleGMVAE(nn.Module):
         # build latent mean and variance lookup
         self._build_mu_lookup()
         self._build_logvar_lookup(pow_exp=-1)       # a hyperparameter to set
-    
+
+        if device is not None:
+            self.to(device)
+
     def _sampling(self, x):
-        idx = x.max(1)[1]
-        x = torch.zeros_like(x)
-        arange = torch.arange(x.size(0)).long()
-        if torch.cuda.is_available():
-            arange = arange.cuda()
-        x[arange, idx] = 1
-        return x
-
-    def encode(self, x):
+        return x.max(1)[1]
+
+    def encode(self, x, lengths=None):
         # rhythm encoder
-        x = self.gru(x)[-1]
-        x = x.transpose_(0, 1).contiguous().view(x.size(0), -1)
+        x = encode_gru(self.gru, x, lengths)
         mu, var = self.mu(x), self.var(x).exp_()
 
         return Normal(mu, var)
 
     def global_decoder(self, z, steps):
-        out = torch.zeros((z.size(0), self.roll_dims)).cuda()
-        out[:, -1] = 1.
+        # previous token, starting from the last vocabulary entry
+        out = torch.full((z.size(0),), self.roll_dims - 1, dtype=torch.long, device=z.device)
         x, hx = [], [None, None]
         t = self.linear_init_global(z)
         hx[0] = t
-        if torch.cuda.is_available():
-            out = out.cuda()
+        token_weight, static_gates = get_token_cell_weights(self.grucell_g.weight_ih,
+                                                            self.grucell_g.bias_ih, z)
         
         # if not self.training:
             # print("not training mode")
 
         for i in range(steps):
-            out = torch.cat([out, z], 1)
-            hx[0] = self.grucell_g(out, hx[0])
+            hx[0] = token_cell(self.grucell_g, token_weight, static_gates, out, hx[0])
             if i == 0:
                 hx[1] = hx[0]
             hx[1] = self.grucell_g_2(hx[0], hx[1])
@@ -340,7 +332,7 @@ class MusicAttrSingleGMVAE(nn.Module):
             if self.training:
                 p = torch.rand(1).item()
                 if p < self.eps:
-                    out = self.sample[:, i, :]
+                    out = self.sample[:, i]
                 else:
                     out = self._sampling(out)
                 # self.eps = self.k / \
@@ -398,26 +390,26 @@ class MusicAttrSingleGMVAE(nn.Module):
             llh = torch.sum(llh, dim=1)  # sum over dimensions
             return llh
 
-        logLogit_qy_x = torch.zeros(z.shape[0], n_component).cuda()  # log-logit of q(y|x)
-        for k_i in torch.arange(0, n_component):
-            mu_k, logvar_k = mu_lookup(k_i.cuda()), logvar_lookup(k_i.cuda())
+        logLogit_qy_x = torch.zeros(z.shape[0], n_component, device=z.device)  # log-logit of q(y|x)
+        for k_i in torch.arange(0, n_component, device=z.device):
+            mu_k, logvar_k = mu_lookup(k_i), logvar_lookup(k_i)
             logLogit_qy_x[:, k_i] = log_gauss_lh(z, mu_k, logvar_k) + np.log(1 / n_component)
 
         qy_x = torch.nn.functional.softmax(logLogit_qy_x, dim=1)
         return logLogit_qy_x, qy_x
 
     def forward(self, x, rhythm, note, chroma, c_r_oh, c_n_oh,
-                is_class=False, is_res=False):
+                is_class=False, is_res=False, lengths=None):
         
         if self.training:
-            self.sample = x
+            self.sample = as_tokens(x)
         
         # ========================== INFERENCE ====================== #
         # infer latent
-        dis = self.encode(x)
+        dis = self.encode(x, lengths)
         
         def repar(mu, stddev, sigma=1):
-            eps = Normal(0, sigma).sample(sample_shape=stddev.size()).cuda()
+            eps = torch.randn_like(stddev) * sigma
             z = mu + stddev * eps  # reparameterization trick
             return z
 
@@ -6,6 +6,62 @@ from torch.autograd import Function
 from collections import Counter
 
 
+def as_tokens(x):
+    '''
+    Integer token indices of `x`, given either as tokens or as their one-hot encoding.
+    '''
+    return x.max(-1)[1] if torch.is_floating_point(x) else x
+
+
+def gru_cell_step(gates, h, weight_hh, bias_hh):
+    '''
+    GRU update from precomputed input gates, in the (r, z, n) gate order of `nn.GRU`.
+    '''
+    i_r, i_z, i_n = gates.chunk(3, -1)
+    h_r, h_z, h_n = F.linear(h, weight_hh, bias_hh).chunk(3, -1)
+    r, u = torch.sigmoid(i_r + h_r), torch.sigmoid(i_z + h_z)
+    n = torch.tanh(i_n + r * h_n)
+    return (1 - u) * n + u * h
+
+
+def get_token_cell_weights(weight_ih, bias_ih, static):
+    '''
+    Split an input-to-hidden GRU weight over a [one-hot token, static features] input into
+    per-token gate rows, looked up with `F.embedding`, and the gates of the static features
+    plus bias. Together they equal the weight applied to the one-hot input.
+    '''
+    roll_dims = weight_ih.size(1) - static.size(-1)
+    return weight_ih[:, :roll_dims].t().contiguous(), F.linear(static, weight_ih[:, roll_dims:], bias_ih)
+
+
+def token_cell(cell, token_weight, static_gates, tokens, h):
+    '''
+    `nn.GRUCell` step on one-hot `tokens`, from `get_token_cell_weights`.
+    '''
+    gates = F.embedding(tokens, token_weight) + static_gates
+    return gru_cell_step(gates, h, cell.weight_hh, cell.bias_hh)
+
+
+def encode_gru(gru, x, lengths=None, static=None):
+    '''
+    Final hidden state of a bidirectional encoder GRU, as (batch, 2 * hidden_dims). `x` is
+    either integer tokens, expanded to one-hot on their device, or their one-hot encoding;
+    `static` per-sample features are appended to every step. With per-sample `lengths`, the
+    padded batch is run as a packed sequence, so pad steps are skipped and do not leak into
+    the hidden state.
+    '''
+    if not torch.is_floating_point(x):
+        roll_dims = gru.input_size - (static.size(-1) if static is not None else 0)
+        x = F.one_hot(x, roll_dims).to(gru.weight_ih_l0.dtype)
+    if static is not None:
+        x = torch.cat([x, torch.stack([static] * x.shape[1], dim=1)], dim=-1)
+    if lengths is not None:
+        x = nn.utils.rnn.pack_padded_sequence(x, lengths.cpu().clamp(min=1), batch_first=True,
+                                              enforce_sorted=False)
+    h = gru(x)[-1]
+    return h.transpose(0, 1).contiguous().view(h.size(1), -1)
+
+
 class MusicAttrRegVAE(nn.Module):
     '''
     Music FaderNets, vanilla VAE model.
@@ -19,7 +75,8 @@ class MusicAttrRegVAE(nn.Module):
                  hidden_dims,
                  z_dims,
                  n_step,
-                 k=1000):
+                 k=1000,
+                 device=None):
         super(MusicAttrRegVAE, self).__init__()
         
         # encoder
@@ -69,24 +126,19 @@ class MusicAttrRegVAE(nn.Module):
         self.z_dims = z_dims
         self.k = torch.FloatTensor([k])
 
+        if device is not None:
+            self.to(device)
+
     def _sampling(self, x):
-        idx = x.max(1)[1]
-        x = torch.zeros_like(x)
-        arange = torch.arange(x.size(0)).long()
-        if torch.cuda.is_available():
-            arange = arange.cuda()
-        x[arange, idx] = 1
-        return x
-
-    def encoder(self, x):
+        return x.max(1)[1]
+
+    def encoder(self, x, lengths=None):
         # rhythm encoder
-        x_r = self.gru_r(x)[-1]
-        x_r = x_r.transpose_(0, 1).contiguous().view(x_r.size(0), -1)
+        x_r = encode_gru(self.gru_r, x, lengths)
         mu_r, var_r = self.mu_r(x_r), self.var_r(x_r).exp_()
         
         # note encoder
-        x_n = self.gru_n(x)[-1]
-        x_n = x_n.transpose_(0, 1).contiguous().view(x_n.size(0), -1)
+        x_n = encode_gru(self.gru_n, x, lengths)
         mu_n, var_n = self.mu_n(x_n), self.var_n(x_n).exp_()
 
         dis_r = Normal(mu_r, var_r)
@@ -116,17 +168,16 @@ class MusicAttrRegVAE(nn.Module):
         return rhythm_out, note_out
     
     def global_decoder(self, z, steps):
-        out = torch.zeros((z.size(0), self.roll_dims)).cuda()
-        out[:, -1] = 1.
+        # previous token, starting from the last vocabulary entry
+        out = torch.full((z.size(0),), self.roll_dims - 1, dtype=torch.long, device=z.device)
         x, hx = [], [None, None]
         t = self.linear_init_global(z)
         hx[0] = t
-        if torch.cuda.is_available():
-            out = out.cuda()
+        token_weight, static_gates = get_token_cell_weights(self.grucell_g.weight_ih,
+                                                            self.grucell_g.bias_ih, z)
 
         for i in range(steps):
-            out = torch.cat([out, z], 1)
-            hx[0] = self.grucell_g(out, hx[0])
+            hx[0] = token_cell(self.grucell_g, token_weight, static_gates, out, hx[0])
             if i == 0:
                 hx[1] = hx[0]
             hx[1] = self.grucell_g_2(hx[0], hx[1])
@@ -135,22 +186,22 @@ class MusicAttrRegVAE(nn.Module):
             if self.training:
                 p = torch.rand(1).item()
                 if p < self.eps:
-                    out = self.sample[:, i, :]
+                    out = self.sample[:, i]
                 else:
                     out = self._sampling(out)
             else:
                 out = self._sampling(out)
         return torch.stack(x, 1)
 
-    def forward(self, x, rhythm, note, chroma):
+    def forward(self, x, rhythm, note, chroma, lengths=None):
         if self.training:
-            self.sample = x
+            self.sample = as_tokens(x)
             self.iteration += 1
         
-        dis_r, dis_n = self.encoder(x)
+        dis_r, dis_n = self.encoder(x, lengths)
         
         def repar(mu, stddev, sigma=1):
-            eps = Normal(0, sigma).sample(sample_shape=stddev.size()).cuda()
+            eps = torch.randn_like(stddev) * sigma
             z = mu + stddev * eps  # reparameterization trick
             return z
 
@@ -183,7 +234,8 @@ class MusicAttrSingleVAE(nn.Module):
                  hidden_dims,
                  z_dims,
                  n_step,
-                 k=1000):
+                 k=1000,
+                 device=None):
         super(MusicAttrSingleVAE, self).__init__()
         
         # encoder
@@ -215,35 +267,30 @@ class MusicAttrSingleVAE(nn.Module):
         self.z_dims = z_dims
         self.k = torch.FloatTensor([k])
 
+        if device is not None:
+            self.to(device)
+
     def _sampling(self, x):
-        idx = x.max(1)[1]
-        x = torch.zeros_like(x)
-        arange = torch.arange(x.size(0)).long()
-        if torch.cuda.is_available():
-            arange = arange.cuda()
-        x[arange, idx] = 1
-        return x
-
-    def encoder(self, x):
+        return x.max(1)[1]
+
+    def encoder(self, x, lengths=None):
         # encoder
-        x = self.gru(x)[-1]
-        x = x.transpose_(0, 1).contiguous().view(x.size(0), -1)
+        x = encode_gru(self.gru, x, lengths)
         mu, var = self.mu(x), self.var(x).exp_()
 
         return Normal(mu, var)
 
     def global_decoder(self, z, steps):
-        out = torch.zeros((z.size(0), self.roll_dims)).cuda()
-        out[:, -1] = 1.
+        # previous token, starting from the last vocabulary entry
+        out = torch.full((z.size(0),), self.roll_dims - 1, dtype=torch.long, device=z.device)
         x, hx = [], [None, None]
         t = self.linear_init_global(z)
         hx[0] = t
-        if torch.cuda.is_available():
-            out = out.cuda()
+        token_weight, static_gates = get_token_cell_weights(self.grucell_g.weight_ih,
+                                                            self.grucell_g.bias_ih, z)
 
         for i in range(steps):
-            out = torch.cat([out, z], 1)
-            hx[0] = self.grucell_g(out, hx[0])
+            hx[0] = token_cell(self.grucell_g, token_weight, static_gates, out, hx[0])
             if i == 0:
                 hx[1] = hx[0]
             hx[1] = self.grucell_g_2(hx[0], hx[1])
@@ -252,7 +299,7 @@ class MusicAttrSingleVAE(nn.Module):
             if self.training:
                 p = torch.rand(1).item()
                 if p < self.eps:
-                    out = self.sample[:, i, :]
+                    out = self.sample[:, i]
                 else:
                     out = self._sampling(out)
                 # self.eps = self.k / \
@@ -261,17 +308,17 @@ class MusicAttrSingleVAE(nn.Module):
                 out = self._sampling(out)
         return torch.stack(x, 1)
 
-    def forward(self, x, chroma):
+    def forward(self, x, chroma, lengths=None):
         
         if self.training:
-            self.sample = x
+            self.sample = as_tokens(x)
             self.iteration += 1
         
         # residual or without
-        dis = self.encoder(x)
+        dis = self.encoder(x, lengths)
         
         def repar(mu, stddev, sigma=1):
-            eps = Normal(0, sigma).sample(sample_shape=stddev.size()).cuda()
+            eps = torch.randn_like(stddev) * sigma
             z = mu + stddev * eps  # reparameterization trick
             return z
 
@@ -297,7 +344,8 @@ class MusicAttrCVAE(nn.Module):
                  hidden_dims,
                  z_dims,
                  n_step,
-                 k=1000):
+                 k=1000,
+                 device=None):
         super(MusicAttrCVAE, self).__init__()
         
         # encoder
@@ -330,23 +378,15 @@ class MusicAttrCVAE(nn.Module):
         self.z_dims = z_dims
         self.k = torch.FloatTensor([k])
 
+        if device is not None:
+            self.to(device)
+
     def _sampling(self, x):
-        idx = x.max(1)[1]
-        x = torch.zeros_like(x)
-        arange = torch.arange(x.size(0)).long()
-        if torch.cuda.is_available():
-            arange = arange.cuda()
-        x[arange, idx] = 1
-        return x
-
-    def encoder(self, x, r_density, n_density, chroma):
-        r_density_rpt = torch.stack([r_density] * x.shape[1], dim=1)
-        n_density_rpt = torch.stack([n_density] * x.shape[1], dim=1)
-        x_in = torch.cat([x, r_density_rpt, n_density_rpt], dim=-1)
-
-        # 1 encoder
-        h = self.gru_e(x_in)[-1]
-        h = h.transpose_(0, 1).contiguous().view(h.size(0), -1)
+        return x.max(1)[1]
+
+    def encoder(self, x, r_density, n_density, chroma, lengths=None):
+        # 1 encoder, densities appended to every step
+        h = encode_gru(self.gru_e, x, lengths, static=torch.cat([r_density, n_density], dim=-1))
         mu, var = self.mu(h), self.var(h).exp_()
 
         dis = Normal(mu, var)
@@ -373,17 +413,16 @@ class MusicAttrCVAE(nn.Module):
         return rhythm_out, note_out, 0, 0
     
     def global_decoder(self, z, steps):
-        out = torch.zeros((z.size(0), self.roll_dims)).cuda()
-        out[:, -1] = 1.
+        # previous token, starting from the last vocabulary entry
+        out = torch.full((z.size(0),), self.roll_dims - 1, dtype=torch.long, device=z.device)
         x, hx = [], [None, None]
         t = self.linear_init_global(z)
         hx[0] = t
-        if torch.cuda.is_available():
-            out = out.cuda()
+        token_weight, static_gates = get_token_cell_weights(self.grucell_g.weight_ih,
+                                                            self.grucell_g.bias_ih, z)
 
         for i in range(steps):
-            out = torch.cat([out, z], 1)
-            hx[0] = self.grucell_g(out, hx[0])
+            hx[0] = token_cell(self.grucell_g, token_weight, static_gates, out, hx[0])
             if i == 0:
                 hx[1] = hx[0]
             hx[1] = self.grucell_g_2(hx[0], hx[1])
@@ -392,24 +431,24 @@ class MusicAttrCVAE(nn.Module):
             if self.training:
                 p = torch.rand(1).item()
                 if p < self.eps:
-                    out = self.sample[:, i, :]
+                    out = self.sample[:, i]
                 else:
                     out = self._sampling(out)
             else:
                 out = self._sampling(out)
         return torch.stack(x, 1)
 
-    def forward(self, x, rhythm, note, chroma, r_density, n_density):
+    def forward(self, x, rhythm, note, chroma, r_density, n_density, lengths=None):
         
         if self.training:
-            self.sample = x
+            self.sample = as_tokens(x)
             self.iteration += 1
         
         # residual or without
-        dis = self.encoder(x, r_density, n_density, chroma)
+        dis = self.encoder(x, r_density, n_density, chroma, lengths)
         
         def repar(mu, stddev, sigma=1):
-            eps = Normal(0, sigma).sample(sample_shape=stddev.size()).cuda()
+            eps = torch.randn_like(stddev) * sigma
             z = mu + stddev * eps  # reparameterization trick
             return z
 
@@ -447,7 +486,8 @@ class MusicAttrFaderNets(nn.Module):
                  hidden_dims,
                  z_dims,
                  n_step,
-                 k=1000):
+                 k=1000,
+                 device=None):
         super(MusicAttrFaderNets, self).__init__()
         
         # encoder
@@ -485,18 +525,14 @@ class MusicAttrFaderNets(nn.Module):
         self.z_dims = z_dims
         self.k = torch.FloatTensor([k])
 
+        if device is not None:
+            self.to(device)
+
     def _sampling(self, x):
-        idx = x.max(1)[1]
-        x = torch.zeros_like(x)
-        arange = torch.arange(x.size(0)).long()
-        if torch.cuda.is_available():
-            arange = arange.cuda()
-        x[arange, idx] = 1
-        return x
-
-    def encoder(self, x):
-        h = self.gru_e(x)[-1]
-        h = h.transpose_(0, 1).contiguous().view(h.size(0), -1)
+        return x.max(1)[1]
+
+    def encoder(self, x, lengths=None):
+        h = encode_gru(self.gru_e, x, lengths)
         mu, var = self.mu(h), self.var(h).exp_()
 
         dis = Normal(mu, var)
@@ -525,20 +561,19 @@ class MusicAttrFaderNets(nn.Module):
         return rhythm_out, note_out, 0, 0
     
     def global_decoder(self, z, steps):
-        out = torch.zeros((z.size(0), self.roll_dims)).cuda()
-        out[:, -1] = 1.
+        # previous token, starting from the last vocabulary entry
+        out = torch.full((z.size(0),), self.roll_dims - 1, dtype=torch.long, device=z.device)
         x, hx = [], [None, None]
         t = self.linear_init_global(z)
         hx[0] = t
-        if torch.cuda.is_available():
-            out = out.cuda()
+        token_weight, static_gates = get_token_cell_weights(self.grucell_g.weight_ih,
+                                                            self.grucell_g.bias_ih, z)
         
         # if not self.training:
             # print("not training mode")
 
         for i in range(steps):
-            out = torch.cat([out, z], 1)
-            hx[0] = self.grucell_g(out, hx[0])
+            hx[0] = token_cell(self.grucell_g, token_weight, static_gates, out, hx[0])
             if i == 0:
                 hx[1] = hx[0]
             hx[1] = self.grucell_g_2(hx[0], hx[1])
@@ -547,7 +582,7 @@ class MusicAttrFaderNets(nn.Module):
             if self.training:
                 p = torch.rand(1).item()
                 if p < self.eps:
-                    out = self.sample[:, i, :]
+                    out = self.sample[:, i]
                 else:
                     out = self._sampling(out)
                 # self.eps = self.k / \
@@ -556,17 +591,17 @@ class MusicAttrFaderNets(nn.Module):
                 out = self._sampling(out)
         return torch.stack(x, 1)
 
-    def forward(self, x, rhythm, note, chroma, r_density, n_density):
+    def forward(self, x, rhythm, note, chroma, r_density, n_density, lengths=None):
         
         if self.training:
-            self.sample = x
+            self.sample = as_tokens(x)
             self.iteration += 1
         
         # residual or without
-        dis = self.encoder(x)
+        dis = self.encoder(x, lengths)
         
         def repar(mu, stddev, sigma=1):
-            eps = Normal(0, sigma).sample(sample_shape=stddev.size()).cuda()
+            eps = torch.randn_like(stddev) * sigma
             z = mu + stddev * eps  # reparameterization trick
             return z
 
@@ -0,0 +1,241 @@
+'''
+Musical attributes computed straight from MidiPerformanceEncoder tokens, without
+decoding to MIDI and parsing it back with pypianoroll.
+'''
+import math
+import numpy as np
+from polyphonic_event_based_v2 import rasterize_notes, pr_to_rhythm
+from ptb_v2 import *
+
+# token layout of MidiPerformanceEncoder: reserved ids, note-on, note-off, time-shift, velocity
+NUM_RESERVED_IDS = 2        # 0 - pad, 1 - EOS
+NUM_PITCHES = MAX_PITCH - MIN_PITCH + 1
+MAX_SHIFT_STEPS = STEPS_PER_SECOND
+NOTE_ON_OFFSET = NUM_RESERVED_IDS
+NOTE_OFF_OFFSET = NOTE_ON_OFFSET + NUM_PITCHES
+TIME_SHIFT_OFFSET = NOTE_OFF_OFFSET + NUM_PITCHES
+VELOCITY_OFFSET = TIME_SHIFT_OFFSET + MAX_SHIFT_STEPS
+VOCAB_SIZE = VELOCITY_OFFSET + NUM_VELOCITY_BINS     # 342
+
+MAX_MIDI_VELOCITY = 127
+VELOCITY_BIN_SIZE = int(math.ceil(MAX_MIDI_VELOCITY / NUM_VELOCITY_BINS))
+DEFAULT_QPM = 120.0         # tempo written by magenta_decode_midi
+TICKS_PER_QUARTER = 220     # resolution of the MIDI file written by magenta_decode_midi
+
+
+def pad_tokens(tokens_lst):
+    '''
+    Stack token sequences of different lengths into a (N, L) array padded with -1.
+    '''
+    seqs = [np.asarray(k, dtype=np.int64).reshape(-1) for k in tokens_lst]
+    tokens = np.full((len(seqs), max([len(k) for k in seqs], default=0)), -1, dtype=np.int64)
+    for i, k in enumerate(seqs):
+        tokens[i, :len(k)] = k
+    return tokens
+
+
+def tokens_to_notes(tokens_lst):
+    '''
+    Turn a batch of performance token sequences into notes, following the performance
+    decoding rules: note-offs close the oldest open note of their pitch, unmatched
+    note-offs and zero-length notes are dropped, open notes end with the sequence.
+    Returns (seq_idx, pitch, start_step, end_step, velocity) arrays and the total
+    number of time-shift steps of each sequence.
+    '''
+    tokens = pad_tokens(tokens_lst)
+    num_of_seqs = len(tokens)
+
+    # vectorized time-shift accumulation: step at which every token happens
+    is_shift = (tokens >= TIME_SHIFT_OFFSET) & (tokens < VELOCITY_OFFSET)
+    shift_steps = np.where(is_shift, tokens - TIME_SHIFT_OFFSET + 1, 0)
+    total_steps = np.cumsum(shift_steps, axis=1)
+    steps = total_steps - shift_steps
+    total_steps = total_steps[:, -1] if tokens.shape[1] > 0 else np.zeros(num_of_seqs, dtype=np.int64)
+
+    # velocity in effect at every token
+    is_velocity = (tokens >= VELOCITY_OFFSET) & (tokens < VOCAB_SIZE)
+    positions = np.arange(tokens.shape[1])
+    last_velocity = np.maximum.accumulate(np.where(is_velocity, positions, -1), axis=1)
+    velocity_bin = np.take_along_axis(tokens, np.maximum(last_velocity, 0), axis=1) - VELOCITY_OFFSET + 1
+    velocities = np.where(last_velocity >= 0, 1 + (velocity_bin - 1) * VELOCITY_BIN_SIZE, MAX_MIDI_VELOCITY)
+
+    on_seq, on_pos = np.nonzero((tokens >= NOTE_ON_OFFSET) & (tokens < NOTE_OFF_OFFSET))
+    off_seq, off_pos = np.nonzero((tokens >= NOTE_OFF_OFFSET) & (tokens < TIME_SHIFT_OFFSET))
+    on_pitch = tokens[on_seq, on_pos] - NOTE_ON_OFFSET
+    off_pitch = tokens[off_seq, off_pos] - NOTE_OFF_OFFSET
+
+    # FIFO pairing per (sequence, pitch): sort all on (+1) / off (-1) events of a group
+    group = np.concatenate([on_seq * NUM_PITCHES + on_pitch, off_seq * NUM_PITCHES + off_pitch])
+    pos = np.concatenate([on_pos, off_pos])
+    sign = np.concatenate([np.ones(len(on_pos), dtype=np.int64), -np.ones(len(off_pos), dtype=np.int64)])
+    order = np.lexsort((pos, group))
+    group, pos, sign = group[order], pos[order], sign[order]
+
+    is_first = np.ones(len(group), dtype=bool)
+    is_first[1:] = group[1:] != group[:-1]
+    group_idx = np.cumsum(is_first) - 1
+    group_start = np.flatnonzero(is_first)
+
+    # a note-off is ignored when no note of its pitch is open, i.e. when the running
+    # on/off balance falls below its previous minimum
+    balance = np.cumsum(sign)
+    balance -= np.concatenate([[0], balance[group_start[1:] - 1]])[group_idx]
+    big = 2 * len(balance) + 1
+    floor = np.minimum.accumulate(balance - group_idx * big) + group_idx * big
+    floor = np.minimum(floor, 0)
+    prev_floor = np.zeros_like(floor)
+    prev_floor[1:] = floor[:-1]
+    prev_floor[is_first] = 0
+    is_on = sign > 0
+    is_valid_off = ~is_on & (balance >= prev_floor)
+
+    # the k-th valid note-off of a group closes the k-th note-on of that group
+    def rank_in_group(mask):
+        count = np.cumsum(mask)
+        return count - np.concatenate([[0], count[group_start[1:] - 1]])[group_idx] - 1
+
+    on_key = group_idx[is_on] * big + rank_in_group(is_on)[is_on]
+    off_key = group_idx[is_valid_off] * big + rank_in_group(is_valid_off)[is_valid_off]
+    is_closed = np.zeros(len(on_key), dtype=bool)
+    if len(off_key) > 0:
+        match = np.minimum(np.searchsorted(off_key, on_key), len(off_key) - 1)
+        is_closed = off_key[match] == on_key
+
+    note_seq = group[is_on] // NUM_PITCHES
+    note_pitch = group[is_on] % NUM_PITCHES + MIN_PITCH
+    note_pos = pos[is_on]
+    note_start = steps[note_seq, note_pos]
+    note_velocity = velocities[note_seq, note_pos]
+    note_end = total_steps[note_seq]
+    if is_closed.any():
+        note_end[is_closed] = steps[note_seq[is_closed], pos[is_valid_off][match[is_closed]]]
+
+    keep = note_end > note_start
+    return (note_seq[keep], note_pitch[keep], note_start[keep], note_end[keep],
+            note_velocity[keep]), total_steps
+
+
+def as_midi_file_notes(notes, qpm=DEFAULT_QPM, resolution=TICKS_PER_QUARTER):
+    '''
+    Reproduce what reading the notes back from a written MIDI file gives: times snap to
+    ticks, a note-off closes every open note of its pitch started on an earlier tick
+    (notes left open are lost), and notes come out in the order they are closed.
+    Takes and returns (seq_idx, pitch, start_step, end_step, velocity) arrays, with
+    times in seconds on the way out.
+    '''
+    seq, pitch, start, end, velocity = notes
+    ticks_per_step = qpm / 60. * resolution / STEPS_PER_SECOND
+    start_tick = np.round(start * ticks_per_step).astype(np.int64)
+    end_tick = np.round(end * ticks_per_step).astype(np.int64)
+
+    # first note-off of the same (sequence, pitch) on a tick after the note-on
+    big = int(end_tick.max(initial=0)) + 2
+    group = seq * 128 + pitch
+    off_key = np.sort(group * big + end_tick)
+    closing = np.searchsorted(off_key, group * big + start_tick, side="right")
+    is_closed = closing < len(off_key)
+    closing = off_key[np.minimum(closing, len(off_key) - 1)]
+    is_closed &= closing // big == group
+    end_tick = closing % big
+
+    # at a tick note-offs are written (and read) in pitch order, the notes a note-off
+    # closes in note-on order
+    idx = np.flatnonzero(is_closed)
+    idx = idx[np.lexsort((velocity[idx], start_tick[idx], pitch[idx], end_tick[idx], seq[idx]))]
+    tick_length = 60. / (qpm * resolution)
+    return (seq[idx], pitch[idx], start_tick[idx] * tick_length, end_tick[idx] * tick_length,
+            velocity[idx])
+
+
+def tokens_to_pr(tokens_lst, beat_resolution=4, qpm=DEFAULT_QPM):
+    '''
+    Quantize a batch of performance token sequences into (T, 128) uint8 piano rolls on the
+    beat grid pypianoroll would use for the decoded MIDI. Sequences without notes give
+    None, like an empty track list from `pypianoroll.parse`.
+    '''
+    notes, _ = tokens_to_notes(tokens_lst)
+    seq, pitch, start_time, end_time, velocity = as_midi_file_notes(notes, qpm=qpm)
+    beat_length = 60. / qpm
+
+    prs = []
+    bounds = np.searchsorted(seq, np.arange(len(tokens_lst) + 1))
+    for i in range(len(tokens_lst)):
+        idx = np.arange(bounds[i], bounds[i + 1])
+        if len(idx) == 0:
+            prs.append(None)
+            continue
+
+        # the written file carries a time signature at 0, so the beat grid starts there
+        n_beats = max(int(np.ceil(end_time[idx].max() / beat_length)), 1)
+
+        # onset bucketing: onsets are rounded, offsets truncated to the frame grid
+        note_ons = np.round(start_time[idx] / beat_length * beat_resolution).astype(int)
+        note_offs = (end_time[idx] / beat_length * beat_resolution).astype(int)
+        pr = np.zeros((beat_resolution * n_beats, 128), dtype=np.uint8)
+        rasterize_notes(pr, note_ons, note_offs, pitch[idx], velocity[idx])
+        prs.append(pr)
+
+    return prs
+
+
+def get_densities(rhythm, note):
+    '''
+    Rhythm density (ratio of onset frames) and note density (mean polyphony).
+    '''
+    rhythm, note = np.asarray(rhythm), np.asarray(note)
+    return np.count_nonzero(rhythm == 1) / len(rhythm), note.sum() / len(note)
+
+
+def get_token_attributes(tokens_lst, beat_resolution=4, with_chroma=False):
+    '''
+    Batch attribute extraction from performance tokens. Returns a list with, for every
+    sequence, (rhythm, note_density, r_density, n_density) -- plus the per-frame chroma
+    if `with_chroma` -- or None for sequences without notes.
+    '''
+    results = []
+    for pr in tokens_to_pr(tokens_lst, beat_resolution=beat_resolution):
+        if pr is None:
+            results.append(None)
+            continue
+
+        rhythm = pr_to_rhythm(pr)
+        note_density = np.count_nonzero(pr, axis=-1)
+        r_density, n_density = get_densities(rhythm, note_density)
+        res = (rhythm, note_density, r_density, n_density)
+        if with_chroma:
+            padded = np.zeros((len(pr), 132))
+            padded[:, :128] = pr
+            res += (padded.reshape(len(pr), 11, 12).sum(axis=1),)
+        results.append(res)
+
+    return results
+
+
+def validate_token_attributes(tokens_lst, beat_resolution=4):
+    '''
+    Compare `get_token_attributes` against the file-based path of the evaluators
+    (magenta decode, MIDI file bytes, pypianoroll parse, `get_music_attributes`).
+    Returns the absolute rhythm / note density differences for every sequence.
+    '''
+    fast = get_token_attributes(tokens_lst, beat_resolution=beat_resolution)
+    r_diff, n_diff = [], []
+
+    for tokens, res in tqdm(zip(tokens_lst, fast), total=len(tokens_lst)):
+        track = parse_pianoroll(magenta_decode_midi(tokens), beat_resolution=beat_resolution).tracks
+        if len(track) < 1 or res is None:
+            r_diff.append(0. if (len(track) < 1) == (res is None) else np.nan)
+            n_diff.append(r_diff[-1])
+            continue
+
+        _, rhythm, note, _, _ = get_music_attributes(track[0].pianoroll, beat=beat_resolution)
+        r_density, n_density = get_densities(rhythm, note)
+        r_diff.append(abs(r_density - res[2]))
+        n_diff.append(abs(n_density - res[3]))
+
+    r_diff, n_diff = np.array(r_diff), np.array(n_diff)
+    print("Rhythm density: mean abs. diff {:.4f}, exact {:.2%}".format(
+        np.nanmean(r_diff), np.mean(r_diff == 0)))
+    print("Note density: mean abs. diff {:.4f}, exact {:.2%}".format(
+        np.nanmean(n_diff), np.mean(n_diff == 0)))
+    print("Empty-track disagreements: {}".format(np.isnan(r_diff).sum()))
+    return r_diff, n_diff
@@ -1,6 +1,11 @@
 import pypianoroll
 import numpy as np
 import os
+import json
+import time
+import argparse
+from functools import partial
+from multiprocessing import Pool
 from tqdm import tqdm
 
 # 0-127 note on, 128 start token, 129 end token, 130 shift, 131-258 note off
@@ -29,7 +34,65 @@ def convert_pr_to_pitch_lst(pr):
     return output_idx, velocity_idx
 
 
-def pr_to_events(pitch_lst, velocity_lst):
+class PitchFrames:
+    '''
+    Compact CSR store for the active pitches and velocities of every frame: the notes of
+    frame i are `pitches[indptr[i]:indptr[i + 1]]`, in ascending pitch order, with their
+    velocities at the same positions. Drop-in for the (pitch_lst, velocity_lst) pair.
+    '''
+    def __init__(self, indptr, pitches, velocities):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.pitches = np.asarray(pitches, dtype=np.uint8)
+        self.velocities = np.asarray(velocities)
+
+    @classmethod
+    def from_pr(cls, pr):
+        pr = np.asarray(pr)
+        frame_idx, pitches = np.nonzero(pr > 0)
+        indptr = np.zeros(len(pr) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(frame_idx, minlength=len(pr)), out=indptr[1:])
+        return cls(indptr, pitches, pr[frame_idx, pitches])
+
+    @classmethod
+    def from_lists(cls, pitch_lst, velocity_lst):
+        indptr = np.zeros(len(pitch_lst) + 1, dtype=np.int64)
+        np.cumsum([len(k) for k in pitch_lst], out=indptr[1:])
+        pitches = np.concatenate([np.asarray(k, dtype=np.uint8).reshape(-1) for k in pitch_lst] + [[]])
+        velocities = np.concatenate([np.asarray(k).reshape(-1) for k in velocity_lst] + [[]])
+        return cls(indptr, pitches, velocities.astype(np.uint8))
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, i):
+        # zero-copy views into the flat buffers
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.pitches[start:end], self.velocities[start:end]
+
+    def counts(self):
+        return np.diff(self.indptr)
+
+    def to_pr(self, dtype=np.uint8):
+        pr = np.zeros((len(self), 128), dtype=dtype)
+        frame_idx = np.repeat(np.arange(len(self)), self.counts())
+        pr[frame_idx, self.pitches] = self.velocities
+        return pr
+
+    def to_lists(self):
+        # legacy (pitch_lst, velocity_lst) as produced by convert_pr_to_pitch_lst
+        pitches = self.pitches.astype(np.int64)
+        pitch_lst, velocity_lst = [], []
+        for i in range(len(self)):
+            start, end = self.indptr[i], self.indptr[i + 1]
+            pitch_lst.append(list(pitches[start:end]))
+            velocity_lst.append(list(self.velocities[start:end]))
+        return pitch_lst, velocity_lst
+
+
+def pr_to_events(pitch_lst, velocity_lst=None):
+    if isinstance(pitch_lst, PitchFrames):
+        return fast_pr_to_events(pitch_lst.to_pr(dtype=pitch_lst.velocities.dtype))
+
     holding_pitches = sorted(pitch_lst[0])
     events = []
     vel_dict = {}
@@ -81,6 +144,110 @@ def pr_to_events(pitch_lst, velocity_lst):
     return events
 
 
+def batch_pr_to_events(prs):
+    '''
+    Vectorized equivalent of `pr_to_events(*convert_pr_to_pitch_lst(pr))` for a batch of
+    piano rolls. Note-on, note-off and velocity changes are found from frame-to-frame
+    differences of all rolls at once. Returns a list of int64 token arrays, one per roll.
+    '''
+    prs = [np.asarray(pr) for pr in prs]
+    lengths = np.array([len(pr) for pr in prs], dtype=np.int64)
+    if len(prs) == 0:
+        return []
+    if (lengths == 0).any():
+        raise ValueError("Cannot encode an empty piano roll.")
+
+    roll = np.concatenate(prs, axis=0)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+
+    # previous frame of each roll, with the first frame of every roll seeing silence
+    prev = np.zeros_like(roll)
+    prev[1:] = roll[:-1]
+    prev[starts] = 0
+
+    active, prev_active = roll > 0, prev > 0
+    ended = prev_active & ~active
+    retrigger = prev_active & active & (roll != prev)     # held note with a new velocity
+    fresh = active & ~prev_active
+
+    # pr_to_events keeps `holding_pitches` as a list in which a re-triggered pitch ends up
+    # twice, so track that multiplicity: 2 once a note has been re-triggered since its onset
+    n_retrigger = np.cumsum(retrigger, axis=0)
+    run_start = np.maximum.accumulate(np.where(fresh, n_retrigger, 0), axis=0)
+    holding = active.astype(np.int64) + (active & (n_retrigger > run_start))
+    prev_holding = np.zeros_like(holding)
+    prev_holding[1:] = holding[:-1]
+    prev_holding[starts] = 0
+
+    # np.nonzero is row-major, so every group is already ordered by (frame, pitch)
+    end_t, end_p = np.nonzero(ended)
+    end_count = prev_holding[end_t, end_p]
+    re_t, re_p = np.nonzero(retrigger)
+    on_t, on_p = np.nonzero(fresh | retrigger)
+    on_count = np.where(prev_holding[on_t, on_p] == 1, 2, 1)
+    on_count[fresh[on_t, on_p]] = 1
+    on_tokens = np.stack([on_p, roll[on_t, on_p].astype(np.int64) + VELOCITY_DISPLACEMENT], axis=1)
+    on_tokens = np.repeat(on_tokens, on_count, axis=0)
+    shift_t = np.arange(len(roll))
+
+    # note-off the notes still held at the end of each roll; pr_to_events removes from
+    # the list it iterates over, so only every other held pitch gets its note-off
+    last = holding[ends - 1]
+    rank = np.cumsum(last, axis=1) - last
+    tail_r, tail_p = np.nonzero((last == 2) | ((last == 1) & (rank % 2 == 0)))
+    tail_t = ends[tail_r] - 1
+
+    frames = np.concatenate([np.repeat(end_t, end_count), re_t, np.repeat(on_t, 2 * on_count),
+                             shift_t, tail_t])
+    tokens = np.concatenate([np.repeat(end_p, end_count) + OFFSET_DISPLACEMENT,
+                             re_p + OFFSET_DISPLACEMENT,
+                             on_tokens.reshape(-1),
+                             np.full(len(roll), shift(), dtype=np.int64),
+                             tail_p + OFFSET_DISPLACEMENT]).astype(np.int64)
+
+    # within a frame: note-offs, velocity re-triggers, note-ons, shift, trailing note-offs
+    order = np.argsort(frames, kind="stable")
+    frames, tokens = frames[order], tokens[order]
+    bounds = np.searchsorted(frames, ends)
+    return np.split(tokens, bounds[:-1])
+
+
+def fast_pr_to_events(pr):
+    '''
+    Vectorized single-roll version of `pr_to_events` taking the piano roll directly.
+    '''
+    return batch_pr_to_events([pr])[0]
+
+
+def verify_fast_encoder(prs=None, num_of_samples=100, steps=96, seed=0):
+    '''
+    Equivalence harness: compare `fast_pr_to_events` against the list-based encoder
+    on the given piano rolls, or on random rolls with held notes and velocity changes.
+    Returns the indices of mismatching rolls.
+    '''
+    if prs is None:
+        rng = np.random.RandomState(seed)
+        prs = []
+        for _ in range(num_of_samples):
+            # piecewise-constant velocities so that notes are held across frames
+            change = rng.rand(steps, 128) < 0.1
+            seg = np.cumsum(change, axis=0)
+            values = rng.randint(1, 128, size=(steps + 1, 128)) * (rng.rand(steps + 1, 128) < 0.1)
+            prs.append(values[seg, np.arange(128)].astype(np.uint8))
+
+    mismatches = []
+    fast_events = batch_pr_to_events(prs)
+    for i, pr in enumerate(prs):
+        pitch_lst, velocity_lst = convert_pr_to_pitch_lst(pr)
+        events = np.array(pr_to_events(pitch_lst, velocity_lst), dtype=np.int64)
+        if not np.array_equal(events, fast_events[i]):
+            mismatches.append(i)
+
+    print("Vectorized encoder: {} / {} rolls match".format(len(prs) - len(mismatches), len(prs)))
+    return mismatches
+
+
 def events_to_pitch_lst(events):
     pitch_lst = []
     velocity_lst = []
@@ -124,7 +291,10 @@ def events_to_pitch_lst(events):
     return pitch_lst, velocity_lst
 
 
-def pitch_lst_to_pr(pitch_lst, velocity_lst):
+def pitch_lst_to_pr(pitch_lst, velocity_lst=None):
+    if isinstance(pitch_lst, PitchFrames):
+        return pitch_lst.to_pr()
+
     pr = []
     for i in range(len(pitch_lst)):
         p = pitch_lst[i]
@@ -138,6 +308,9 @@ def pitch_lst_to_pr(pitch_lst, velocity_lst):
 
 
 def pitch_lst_to_rhythm(output_idx):    
+    if isinstance(output_idx, PitchFrames):
+        return pr_to_rhythm(output_idx.to_pr())
+
     rhythm_lst = []
     if len(output_idx[0]) > 0:
         rhythm_lst.append(1)
@@ -158,23 +331,133 @@ def pitch_lst_to_rhythm(output_idx):
     return ret
 
 
-def encode_midi(fname, beat=24, is_pr=False):
+def pr_to_rhythm(pr):
+    '''
+    Roll-native `pitch_lst_to_rhythm` for a (T, 128) roll or a (N, T, 128) batch of rolls:
+    0 for a rest, 1 if any pitch was not sounding in the previous frame, else 2 (hold).
+    Returns an int8 array of shape (T,) or (N, T).
+    '''
+    active = np.asarray(pr) > 0
+    prev = np.zeros_like(active)
+    prev[..., 1:, :] = active[..., :-1, :]
+    rhythm = np.where((active & ~prev).any(axis=-1), 1, 2).astype(np.int8)
+    rhythm[~active.any(axis=-1)] = 0
+    return rhythm
+
+
+def encode_midi(fname, beat=24, is_pr=False, compact=False):
+    '''
+    With `compact`, the pitch and velocity lists are returned as one `PitchFrames`
+    (in both slots) and events / rhythm as arrays, without building Python lists.
+    '''
     if not is_pr:
         track = pypianoroll.parse(fname, beat_resolution=beat)
         pr = track.get_merged_pianoroll()[:beat*8]
     else:
         pr = fname
+    if compact:
+        frames = PitchFrames.from_pr(pr)
+        events = fast_pr_to_events(pr)
+        return events, frames, frames, pr, pr_to_rhythm(pr)
+
     pitch_lst, velocity_lst = convert_pr_to_pitch_lst(pr)
     rhythm = pitch_lst_to_rhythm(pitch_lst)
     events = pr_to_events(pitch_lst, velocity_lst)
     return events, pitch_lst, velocity_lst, pr, rhythm
 
 
-def decode_events(events):
+def decode_events(events, compact=False):
+    if compact:
+        pr = fast_decode_events(events)
+        frames = PitchFrames.from_pr(pr)
+        return pr, frames, frames
+
     pitch_lst, velocity_lst = events_to_pitch_lst(events)
     pr = pitch_lst_to_pr(pitch_lst, velocity_lst)
     return pr, pitch_lst, velocity_lst
-    
+
+
+def batch_decode_events(events_lst, n_frames=None):
+    '''
+    Array-based equivalent of `decode_events` for a batch of token sequences. The
+    note-on/off/velocity state machine is stepped over the token axis for all sequences
+    at once and written straight into a preallocated (N, T, 128) uint8 piano roll.
+    Returns the rolls and the number of decoded frames of each sequence.
+    '''
+    seqs = [np.asarray(e, dtype=np.int64).reshape(-1) for e in events_lst]
+    num_of_seqs = len(seqs)
+    max_len = max([len(e) for e in seqs], default=0)
+
+    tokens = np.full((num_of_seqs, max_len), -1, dtype=np.int64)     # -1 marks padding
+    for i, e in enumerate(seqs):
+        tokens[i, :len(e)] = e
+
+    num_of_shifts = (tokens == shift()).sum(axis=1)
+    if n_frames is None:
+        n_frames = int(num_of_shifts.max(initial=0))
+    rolls = np.zeros((num_of_seqs, n_frames, 128), dtype=np.uint8)
+
+    rows = np.arange(num_of_seqs)
+    holding = np.zeros((num_of_seqs, 128), dtype=np.int64)       # a pitch may be on twice
+    velocity = np.full((num_of_seqs, 128), 100, dtype=np.int64)  # default velocity
+    prev_onset = np.zeros(num_of_seqs, dtype=np.int64)
+    frame = np.zeros(num_of_seqs, dtype=np.int64)
+
+    for j in range(max_len):
+        e = tokens[:, j]
+
+        # shift: write the current frame, pitch 0 is never written (as in events_to_pitch_lst)
+        n = rows[(e == shift()) & (frame < n_frames)]
+        if len(n) > 0:
+            held = holding[n] > 0
+            held[:, 0] = False
+            rolls[n, frame[n]] = np.where(held, velocity[n], 0)
+        frame += e == shift()
+
+        # onset
+        n = rows[(e >= 0) & (e < 128)]
+        holding[n, e[n]] += 1
+        prev_onset[n] = e[n]
+
+        # offset of a held pitch
+        n = rows[(e >= OFFSET_DISPLACEMENT) & (e < OFFSET_DISPLACEMENT + 128)]
+        p = e[n] - OFFSET_DISPLACEMENT
+        is_held = holding[n, p] > 0
+        holding[n[is_held], p[is_held]] -= 1
+
+        # velocity of the last onset, if it is still held
+        n = rows[(e > VELOCITY_DISPLACEMENT) & (e < VELOCITY_DISPLACEMENT + 128)]
+        is_held = holding[n, prev_onset[n]] > 0
+        n = n[is_held]
+        velocity[n, prev_onset[n]] = e[n] - VELOCITY_DISPLACEMENT
+
+    return rolls, np.minimum(num_of_shifts, n_frames)
+
+
+def fast_decode_events(events):
+    '''
+    Array-based single-sequence version of `decode_events`, returning the piano roll only.
+    '''
+    rolls, n_frames = batch_decode_events([events])
+    return rolls[0, :n_frames[0]]
+
+
+def verify_fast_decoder(events_lst):
+    '''
+    Equivalence harness: compare `batch_decode_events` against `decode_events` on the
+    given token sequences. Returns the indices of mismatching sequences.
+    '''
+    mismatches = []
+    rolls, n_frames = batch_decode_events(events_lst)
+    for i, events in enumerate(events_lst):
+        pr, _, _ = decode_events(events)
+        if not np.array_equal(pr.reshape(-1, 128), rolls[i, :n_frames[i]]):
+            mismatches.append(i)
+
+    print("Array-based decoder: {} / {} sequences match".format(
+        len(events_lst) - len(mismatches), len(events_lst)))
+    return mismatches
+
 
 def shift():
     return 130
@@ -192,6 +475,86 @@ def vel(velocity):
     return int(velocity) + VELOCITY_DISPLACEMENT    # add a displacement value
 
 
+def rasterize_notes(pianoroll, note_ons, note_offs, pitches, velocities, mode="max",
+                    binarized=False):
+    '''
+    Write notes into a (T, 128) pianoroll in place, with the overlap trimming of
+    `parse_pretty_midi`: a note clears the frame before its onset and is shortened by one
+    frame if it ends on an occupied frame. Trimming only depends on earlier notes whose
+    frames touch the same pitch, so notes are grouped into clusters of touching notes and
+    scattered in rounds holding at most one note per cluster, in their original order.
+    '''
+    n_time_steps = len(pianoroll)
+    note_ons = np.asarray(note_ons, dtype=int)
+    note_offs = np.asarray(note_offs, dtype=int)
+    pitches = np.asarray(pitches, dtype=int)
+    velocities = np.asarray(velocities, dtype=int)
+    if len(pitches) == 0:
+        return pianoroll
+
+    def wrap(idx):
+        # python slice semantics of pianoroll[start:end]
+        return np.clip(np.where(idx < 0, idx + n_time_steps, idx), 0, n_time_steps)
+
+    is_cleared = (note_ons > 0) & (note_ons < n_time_steps)
+    is_checked = (note_offs < n_time_steps - 1) & (note_offs >= -n_time_steps)
+    checked_frame = np.where(note_offs < 0, note_offs + n_time_steps, note_offs)
+
+    # every frame a note may read or write, whether or not it gets trimmed
+    low = np.minimum(wrap(note_ons), np.where(is_cleared, note_ons - 1, n_time_steps))
+    low = np.minimum(low, np.where(is_checked, checked_frame, n_time_steps))
+    high = np.maximum(wrap(note_offs), wrap(note_offs - 1))
+    high = np.maximum(high, np.where(is_checked, checked_frame + 1, 0))
+    high = np.maximum(high, np.where(is_cleared, note_ons, 0))
+
+    # notes of one pitch whose frames overlap form a cluster; clusters are independent
+    order = np.lexsort((low, pitches))
+    stride = n_time_steps + 2
+    reach = np.maximum.accumulate(pitches[order] * stride + high[order])
+    is_new = np.ones(len(order), dtype=bool)
+    is_new[1:] = pitches[order][1:] * stride + low[order][1:] >= reach[:-1]
+    cluster = np.empty(len(order), dtype=int)
+    cluster[order] = np.cumsum(is_new)
+
+    # rank of every note within its cluster, keeping the original order
+    order = np.argsort(cluster, kind="stable")
+    sorted_cluster = cluster[order]
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(len(order)) - np.searchsorted(sorted_cluster, sorted_cluster)
+    rounds = np.argsort(rank, kind="stable")
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(rank))])
+
+    for r in range(len(bounds) - 1):
+        idx = rounds[bounds[r]:bounds[r + 1]]
+        start, end, pitch, velocity = note_ons[idx], note_offs[idx], pitches[idx], velocities[idx]
+
+        # clear the frame before the onset
+        cleared = is_cleared[idx]
+        pianoroll[start[cleared] - 1, pitch[cleared]] = 0
+
+        # shorten notes ending on an occupied frame
+        checked = is_checked[idx]
+        occupied = np.zeros(len(idx), dtype=bool)
+        occupied[checked] = pianoroll[end[checked], pitch[checked]] > 0
+        end = end - occupied
+
+        # scatter all frames of this round, no two notes share a frame
+        start, end = wrap(start), wrap(end)
+        length = np.maximum(end - start, 0)
+        offsets = np.arange(length.sum()) - np.repeat(np.cumsum(length) - length, length)
+        rows = np.repeat(start, length) + offsets
+        cols = np.repeat(pitch, length)
+
+        if binarized:
+            pianoroll[rows, cols] = True
+        elif mode == "sum":
+            pianoroll[rows, cols] += np.repeat(velocity, length)
+        elif mode == "max":
+            pianoroll[rows, cols] = np.maximum(pianoroll[rows, cols], np.repeat(velocity, length))
+
+    return pianoroll
+
+
 def parse_pretty_midi(
         pm,
         mode="max",
@@ -201,7 +564,8 @@ def parse_pretty_midi(
         collect_onsets_only=False,
         threshold=0,
         first_beat_time=None,
-        beat_resolution=4
+        beat_resolution=4,
+        return_tracks=False
     ):
     """
     Parse a :class:`pretty_midi.PrettyMIDI` object. The data type of the
@@ -248,6 +612,10 @@ def parse_pretty_midi(
     first_beat_time : float
         The location (in sec) of the first beat. Required and only effective
         when using 'custom' algorithm.
+    return_tracks : bool
+        True to return the list of parsed pianorolls, one per instrument (the
+        `tracks` of `pypianoroll.parse`). False to return the pianoroll of the
+        last instrument only. Defaults to False.
 
     Notes
     -----
@@ -382,46 +750,113 @@ def parse_pretty_midi(
             )
             note_offs = ((beat_indices + ratios) * beat_resolution).astype(int)
 
-            for idx, start in enumerate(note_ons):
-                end = note_offs[idx]
-                velocity = instrument.notes[idx].velocity
-
-                if velocity < 1:
-                    continue
-                if binarized and velocity <= threshold:
-                    continue
-
-                if 0 < start < n_time_steps:
-                    if pianoroll[start - 1, pitches[idx]]:
-                        pianoroll[start - 1, pitches[idx]] = 0
-                if end < n_time_steps - 1:
-                    if pianoroll[end, pitches[idx]]:
-                        end -= 1
-
-                if binarized:
-                    if mode == "sum":
-                        pianoroll[start:end, pitches[idx]] += 1
-                    elif mode == "max":
-                        pianoroll[start:end, pitches[idx]] = True
-                elif mode == "sum":
-                    pianoroll[start:end, pitches[idx]] += velocity
-                elif mode == "max":
-                    maximum = np.maximum(
-                        pianoroll[start:end, pitches[idx]], velocity
-                    )
-                    pianoroll[start:end, pitches[idx]] = maximum
+            # velocities are looked up by position in `instrument.notes`, as the
+            # per-note loop this replaces did
+            velocities = np.array(
+                [note.velocity for note in instrument.notes[:len(note_ons)]], dtype=int
+            )
+            keep = velocities >= 1
+            if binarized:
+                keep &= velocities > threshold
+
+            rasterize_notes(
+                pianoroll,
+                note_ons[keep],
+                note_offs[keep],
+                pitches[keep],
+                velocities[keep],
+                mode=mode,
+                binarized=binarized,
+            )
+
+        if not skip_empty_tracks or pianoroll.any():
+            tracks.append(pianoroll)
 
+    if return_tracks:
+        return tracks
     return pianoroll
 
 
+MAX_REPORTED_MISMATCHES = 100
+
+
+def verify_round_trip(fname, beat=24, num_of_beats=8, compact=False):
+    '''
+    Encode and decode a single MIDI file and compare the decoded piano roll with the
+    original one. Never raises: failures are recorded in the returned report, together
+    with frame / token counts, mismatching frame positions and the time of each stage.
+    '''
+    report = {"file": fname, "ok": False}
+    try:
+        start = time.time()
+        track = pypianoroll.parse(fname, beat_resolution=beat)
+        pr_ori = track.get_merged_pianoroll()
+        if num_of_beats is not None:
+            pr_ori = pr_ori[:beat * num_of_beats]
+        report["parse_time"] = time.time() - start
+
+        start = time.time()
+        events, _, _, _, _ = encode_midi(pr_ori, beat=beat, is_pr=True, compact=compact)
+        report["encode_time"] = time.time() - start
+
+        start = time.time()
+        pr, _, _ = decode_events(events, compact=compact)
+        pr = np.asarray(pr).reshape(-1, 128)
+        report["decode_time"] = time.time() - start
+
+        length = min(len(pr), len(pr_ori))
+        mismatches = np.nonzero((pr[:length] != pr_ori[:length]).any(axis=1))[0]
+        mismatches = np.concatenate([mismatches, np.arange(length, max(len(pr), len(pr_ori)))])
+
+        report["frames"] = len(pr_ori)
+        report["decoded_frames"] = len(pr)
+        report["tokens"] = len(events)
+        report["num_of_mismatches"] = len(mismatches)
+        report["mismatch_frames"] = mismatches[:MAX_REPORTED_MISMATCHES].tolist()
+        report["ok"] = len(mismatches) == 0
+
+    except Exception as e:
+        report["error"] = "{}: {}".format(type(e).__name__, e)
+
+    return report
+
+
+def verify_corpus(fnames, report_path, num_workers=None, beat=24, num_of_beats=8, compact=False):
+    '''
+    Round-trip verification of many MIDI files over a process pool. Reports are streamed
+    to `report_path` (one JSON object per line) as soon as each file finishes.
+    '''
+    num_of_ok, num_of_failed = 0, 0
+    verify = partial(verify_round_trip, beat=beat, num_of_beats=num_of_beats, compact=compact)
+
+    with Pool(num_workers) as pool, open(report_path, "w") as f:
+        for report in tqdm(pool.imap_unordered(verify, fnames), total=len(fnames)):
+            f.write(json.dumps(report) + "\n")
+            f.flush()
+            if report["ok"]:
+                num_of_ok += 1
+            else:
+                num_of_failed += 1
+
+    print("Round trip: {} passed, {} failed, report saved to {}".format(
+        num_of_ok, num_of_failed, report_path))
+    return num_of_ok, num_of_failed
+
+
 def main():
-    # labelled_midi = ["../../labelled/pieces/midi/" + k for k in os.listdir("../../labelled/pieces/midi/")]
-    labelled_midi = ["/data/classic-piano/" + k for k in os.listdir("/data/classic-piano/")]
-    for i in tqdm(range(len(labelled_midi))):
-        fname = labelled_midi[i]
-        events, pitch_lst, velocity_lst, pr_ori, rhythm = encode_midi(fname)
-        pr, pitch_lst_2, velocity_lst_2 = decode_events(events)
-        assert ((pr_ori == pr).all()) == True
+    parser = argparse.ArgumentParser(description="Verify event encode/decode round trips.")
+    # parser.add_argument("--midi_dir", default="../../labelled/pieces/midi/")
+    parser.add_argument("--midi_dir", default="/data/classic-piano/")
+    parser.add_argument("--report", default="round_trip_report.jsonl")
+    parser.add_argument("--num_workers", type=int, default=None)
+    parser.add_argument("--beat", type=int, default=24)
+    parser.add_argument("--num_of_beats", type=int, default=8, help="0 to verify whole pieces")
+    parser.add_argument("--compact", action="store_true", help="use the vectorized codec")
+    args = parser.parse_args()
+
+    labelled_midi = [os.path.join(args.midi_dir, k) for k in sorted(os.listdir(args.midi_dir))]
+    verify_corpus(labelled_midi, args.report, num_workers=args.num_workers, beat=args.beat,
+                  num_of_beats=args.num_of_beats or None, compact=args.compact)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,9 @@
 import os
 import io
 import json
+import time
+import hashlib
+import sqlite3
 import torch
 import numpy as np
 from collections import defaultdict
@@ -10,8 +13,10 @@ from tqdm import tqdm
 import pretty_midi
 from collections import Counter
 import sys, math
+from functools import partial, lru_cache
 import pypianoroll
 from polyphonic_event_based_v2 import *
+from multiprocessing import Pool
 from multiprocessing.dummy import Pool as ThreadPool
 from sklearn.preprocessing import StandardScaler
 import music21
@@ -34,68 +39,235 @@ MAX_TEMPO = 258
 MIN_VELOCITY = 0
 MAX_VELOCITY = 126
 
+# storage dtypes of the dataset columns, widened again per sample
+TOKEN_DTYPE = np.uint16     # 342-token vocabulary
+RHYTHM_DTYPE = np.int8      # 0 - rest, 1 - onset, 2 - hold
+NOTE_DTYPE = np.uint8       # note count per frame, at most 128
+CHROMA_DTYPE = np.float16
 
-def magenta_encode_midi(midi_filename, is_eos=False):
-    mpe = MidiPerformanceEncoder(
-            steps_per_second=STEPS_PER_SECOND,
-            num_velocity_bins=NUM_VELOCITY_BINS,
-            min_pitch=MIN_PITCH,
-            max_pitch=MAX_PITCH,
+R_DENSITY_BINS = [0.3, 0.5]     # rhythm density classes: < 0.3, < 0.5, otherwise
+N_DENSITY_BINS = [2, 3.5]       # note density classes: <= 2, <= 3.5, otherwise
+
+
+def midi_to_bytes(midi):
+    '''
+    Serialize a MIDI file name, file object, bytes, `PrettyMIDI` or `NoteSequence` into
+    the bytes of a standard MIDI file, without writing to the disk.
+    '''
+    if isinstance(midi, str):
+        with open(midi, "rb") as f:
+            return f.read()
+    if isinstance(midi, (bytes, bytearray)):
+        return bytes(midi)
+    if hasattr(midi, "read"):
+        return midi.read()
+    if not isinstance(midi, pretty_midi.PrettyMIDI):     # NoteSequence
+        midi = magenta.music.sequence_proto_to_pretty_midi(midi)
+
+    buffer = io.BytesIO()
+    midi.write(buffer)
+    return buffer.getvalue()
+
+
+def load_midi(midi):
+    '''
+    Get the `PrettyMIDI` object a MIDI file (name or in-memory object of any kind accepted
+    by `midi_to_bytes`) reads back as. In-memory objects go through the serialized bytes,
+    so results are the same as writing them to a file first.
+    '''
+    if isinstance(midi, str):
+        return pretty_midi.PrettyMIDI(midi)
+    return pretty_midi.PrettyMIDI(io.BytesIO(midi_to_bytes(midi)))
+
+
+def parse_pianoroll(midi, beat_resolution=4):
+    '''
+    In-memory counterpart of `pypianoroll.parse`.
+    '''
+    multitrack = pypianoroll.Multitrack(beat_resolution=beat_resolution)
+    multitrack.parse_pretty_midi(load_midi(midi))
+    return multitrack
+
+
+@lru_cache(maxsize=None)
+def get_performance_encoder(is_eos=False, steps_per_second=STEPS_PER_SECOND,
+                            num_velocity_bins=NUM_VELOCITY_BINS, min_pitch=MIN_PITCH,
+                            max_pitch=MAX_PITCH):
+    '''
+    Shared `MidiPerformanceEncoder`, built once per parameter set in every process.
+    '''
+    return MidiPerformanceEncoder(
+            steps_per_second=steps_per_second,
+            num_velocity_bins=num_velocity_bins,
+            min_pitch=min_pitch,
+            max_pitch=max_pitch,
             add_eos=is_eos)
-    ns = magenta.music.midi_file_to_sequence_proto(midi_filename)
+
+
+def magenta_encode_midi(midi, is_eos=False):
+    mpe = get_performance_encoder(is_eos)
+    if isinstance(midi, str):
+        ns = magenta.music.midi_file_to_sequence_proto(midi)
+    elif isinstance(midi, (bytes, bytearray, pretty_midi.PrettyMIDI)) or hasattr(midi, "read"):
+        ns = magenta.music.midi_to_sequence_proto(midi_to_bytes(midi))
+    else:
+        ns = midi
     return mpe.encode_note_sequence(ns)
 
 
 def magenta_decode_midi(notes, is_eos=False):
-    mpe = MidiPerformanceEncoder(
-            steps_per_second=STEPS_PER_SECOND,
-            num_velocity_bins=NUM_VELOCITY_BINS,
-            min_pitch=MIN_PITCH,
-            max_pitch=MAX_PITCH,
-            add_eos=is_eos)
+    mpe = get_performance_encoder(is_eos)
     pm = mpe.decode(notes, return_pm=True)
     return pm
 
 
-def slice_midi(pm, beats, start_idx, end_idx):
+def map_over_pool(func, items, num_workers=0):
     '''
-    Slice given pretty_midi object into number of beat segments.
+    `func` over a list, on a process pool of `num_workers` processes if given.
     '''
-    new_pm = pretty_midi.PrettyMIDI()
-    new_inst = pretty_midi.Instrument(program=pm.instruments[0].program,
-                                      is_drum=pm.instruments[0].is_drum,
-                                      name=pm.instruments[0].name)
-    start, end = beats[start_idx], beats[end_idx]
-    for i in range(len(pm.instruments)):
-        for note in pm.instruments[i].notes:
-            velocity, pitch = note.velocity, note.pitch
-            if note.start > end or note.start < start:
-                continue
-            else:
-                s = note.start - start
-                if note.end > end:
-                    e = end - start
-                else:
-                    e = note.end - start
-            new_note = pretty_midi.Note(
-                velocity=velocity, pitch=pitch, start=s, end=e)
-            new_inst.notes.append(new_note)
+    items = list(items)
+    if not num_workers:
+        return [func(k) for k in items]
+    with Pool(num_workers) as pool:
+        return pool.map(func, items, chunksize=max(1, len(items) // (4 * num_workers)))
 
-        for ctrl in pm.instruments[i].control_changes:
-            if ctrl.time >= start and ctrl.time < end:
-                new_ctrl = pretty_midi.ControlChange(
-                    number=ctrl.number, value=ctrl.value, time=ctrl.time - start)
-                new_inst.control_changes.append(new_ctrl)
 
-    new_pm.instruments.append(new_inst)
-    new_pm.write('tmp.mid')
-    return new_pm
+def encode_many(midis, is_eos=False, num_workers=0):
+    '''
+    Batch `magenta_encode_midi` over MIDI files / in-memory MIDI objects.
+    '''
+    return map_over_pool(partial(magenta_encode_midi, is_eos=is_eos), midis, num_workers)
 
 
-def get_harmony_vector(fname, is_one_hot=False):
+def decode_many(tokens_lst, is_eos=False, num_workers=0):
     '''
-    Obtain estimated key for a given music segment with music21 library.
+    Batch `magenta_decode_midi` over token sequences, returns `pretty_midi` objects.
     '''
+    return map_over_pool(partial(magenta_decode_midi, is_eos=is_eos), tokens_lst, num_workers)
+
+
+class NoteIndex:
+    '''
+    Notes and control changes of all instruments of a `pretty_midi` object, sorted by time
+    once, so that the events of any time range are found with `searchsorted`.
+    '''
+    def __init__(self, pm):
+        self.program = pm.instruments[0].program
+        self.is_drum = pm.instruments[0].is_drum
+        self.name = pm.instruments[0].name
+
+        notes = [note for inst in pm.instruments for note in inst.notes]
+        ctrls = [ctrl for inst in pm.instruments for ctrl in inst.control_changes]
+        self.note_is_drum = np.array([inst.is_drum for inst in pm.instruments for note in inst.notes],
+                                     dtype=bool)
+        note_start = np.array([note.start for note in notes], dtype=float)
+        ctrl_time = np.array([ctrl.time for ctrl in ctrls], dtype=float)
+
+        # sorted by time, ties kept in instrument / note order
+        self.note_order = np.argsort(note_start, kind="stable")
+        self.note_start = note_start[self.note_order]
+        self.ctrl_order = np.argsort(ctrl_time, kind="stable")
+        self.ctrl_time = ctrl_time[self.ctrl_order]
+
+        self.notes = np.array([[note.start, note.end, note.pitch, note.velocity] for note in notes],
+                              dtype=float).reshape(-1, 4)
+        self.ctrls = np.array([[ctrl.time, ctrl.number, ctrl.value] for ctrl in ctrls],
+                              dtype=float).reshape(-1, 3)
+
+    def count_notes(self, starts, ends):
+        '''
+        Number of notes starting within [start, end] for arrays of ranges.
+        '''
+        return np.searchsorted(self.note_start, ends, side="right") - \
+               np.searchsorted(self.note_start, starts, side="left")
+
+    def pitch_class_histograms(self, starts, ends):
+        '''
+        (N, 12) pitch-class durations of the notes each range would slice out, drum notes
+        skipped as in `midi_to_pitch_class_histogram`.
+        '''
+        starts, ends = np.asarray(starts, dtype=float), np.asarray(ends, dtype=float)
+        lo = np.searchsorted(self.note_start, starts, side="left")
+        hi = np.searchsorted(self.note_start, ends, side="right")
+        lengths = np.maximum(hi - lo, 0)
+
+        window = np.repeat(np.arange(len(starts)), lengths)
+        offset = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        note_idx = self.note_order[np.repeat(lo, lengths) + offset]
+        notes = self.notes[note_idx]
+        durations = np.where(self.note_is_drum[note_idx], 0, np.minimum(notes[:, 1], ends[window]) - notes[:, 0])
+
+        histograms = np.zeros((len(starts), 12))
+        np.add.at(histograms, (window, notes[:, 2].astype(int) % 12), durations)
+        return histograms
+
+    def slice(self, start, end):
+        '''
+        New `pretty_midi` object with the notes starting within [start, end] (cut at `end`)
+        and control changes within [start, end), shifted to start at 0.
+        '''
+        return self.slice_windows([start], [end])[0]
+
+    def slice_windows(self, starts, ends):
+        '''
+        Batch `slice` over arrays of ranges, bounds for all ranges are searched at once.
+        '''
+        starts, ends = np.asarray(starts, dtype=float), np.asarray(ends, dtype=float)
+        note_lo = np.searchsorted(self.note_start, starts, side="left")
+        note_hi = np.searchsorted(self.note_start, ends, side="right")
+        ctrl_lo = np.searchsorted(self.ctrl_time, starts, side="left")
+        ctrl_hi = np.searchsorted(self.ctrl_time, ends, side="left")
+
+        windows = []
+        for i in range(len(starts)):
+            start, end = starts[i], ends[i]
+            new_pm = pretty_midi.PrettyMIDI()
+            new_inst = pretty_midi.Instrument(program=self.program, is_drum=self.is_drum,
+                                              name=self.name)
+
+            # events of the range, back in instrument / note order
+            for s, e, pitch, velocity in self.notes[np.sort(self.note_order[note_lo[i]:note_hi[i]])]:
+                new_inst.notes.append(pretty_midi.Note(
+                    velocity=int(velocity), pitch=int(pitch), start=s - start, end=min(e, end) - start))
+            for ctrl_time, number, value in self.ctrls[np.sort(self.ctrl_order[ctrl_lo[i]:ctrl_hi[i]])]:
+                new_inst.control_changes.append(pretty_midi.ControlChange(
+                    number=int(number), value=int(value), time=ctrl_time - start))
+
+            new_pm.instruments.append(new_inst)
+            windows.append(new_pm)
+
+        return windows
+
+
+def slice_midi(pm, beats, start_idx, end_idx, index=None):
+    '''
+    Slice given pretty_midi object into number of beat segments. Pass a `NoteIndex` of
+    `pm` to avoid rebuilding it for every segment.
+    '''
+    if index is None:
+        index = NoteIndex(pm)
+    return index.slice(beats[start_idx], beats[end_idx])
+
+
+def slice_midi_windows(pm, beats, start_idx_lst, end_idx_lst, index=None):
+    '''
+    All beat segments [start_idx, end_idx] of a pretty_midi object at once.
+    '''
+    if index is None:
+        index = NoteIndex(pm)
+    beats = np.asarray(beats)
+    return index.slice_windows(beats[np.asarray(start_idx_lst, dtype=int)],
+                               beats[np.asarray(end_idx_lst, dtype=int)])
+
+
+def get_harmony_vector(midi, is_one_hot=False, cache=None):
+    '''
+    Obtain estimated key for a given music segment (MIDI file name or in-memory MIDI)
+    with music21 library. Looked up in / stored to a `HarmonyCache` if given.
+    '''
+    if cache is not None:
+        return cache.get_harmony_vector(midi, is_one_hot=is_one_hot)
+
     CHORD_DICT = {
     "C-": 11, "C": 0, "C#": 1, "D-": 1, "D": 2, "D#": 3, "E-": 3, "E": 4, "E#": 5,
     "F-": 4, "F": 5, "F#": 6, "G-": 6, "G": 7, "G#": 8, "A-": 8, "A": 9, "A#": 10, 
@@ -103,7 +275,10 @@ def get_harmony_vector(fname, is_one_hot=False):
     }
 
     try:
-        score = music21.converter.parse(fname)
+        if isinstance(midi, str):
+            score = music21.converter.parse(midi)
+        else:
+            score = music21.converter.parseData(midi_to_bytes(midi), format="midi")
         key = score.analyze('key')
         res = np.zeros(24,)
         name, mode = key.tonic.name, key.mode
@@ -129,31 +304,250 @@ def get_harmony_vector(fname, is_one_hot=False):
         return None
 
 
-def get_music_attributes(pr, beat=24):
+HARMONY_CACHE_PATH = "data/harmony_cache.sqlite"
+HARMONY_CACHES = {}
+
+
+class HarmonyCache:
     '''
-    Get musical attributes including rhythm density, note_density, chroma and velocity
-    for a given piano roll segment.
+    Persistent SQLite cache of music21 harmony vectors, keyed by a hash of the segment's
+    notes and `is_one_hot`. Holds at most `max_entries` vectors, evicting the least
+    recently used ones, and counts hits and misses.
+    '''
+    def __init__(self, path=HARMONY_CACHE_PATH, max_entries=1000000):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits, self.misses = 0, 0
+
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS harmony "
+                          "(key TEXT PRIMARY KEY, vector BLOB, last_used REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS harmony_last_used ON harmony (last_used)")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COUNT(*) FROM harmony").fetchone()[0]
+
+    @staticmethod
+    def get_key(midi, is_one_hot=False):
+        '''
+        Hash of the notes of a segment, as read back from its MIDI file.
+        '''
+        pm = load_midi(midi)
+        notes = np.array([[note.pitch, note.start, note.end, note.velocity]
+                          for inst in pm.instruments for note in inst.notes]).reshape(-1, 4)
+        notes = np.round(notes[np.lexsort(notes.T[::-1])], 6)
+        sha = hashlib.sha1(notes.tobytes())
+        sha.update(b"one_hot" if is_one_hot else b"weighted")
+        return sha.hexdigest()
+
+    def get(self, key):
+        '''
+        Returns (is_hit, vector); vector is None when music21 failed on the segment.
+        '''
+        row = self.conn.execute("SELECT vector FROM harmony WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None
+
+        self.hits += 1
+        self.conn.execute("UPDATE harmony SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        return True, None if row[0] is None else np.frombuffer(row[0], dtype=np.float64).copy()
+
+    def put(self, key, vector):
+        vector = None if vector is None else np.asarray(vector, dtype=np.float64).tobytes()
+        cursor = self.conn.execute("INSERT OR REPLACE INTO harmony VALUES (?, ?, ?)",
+                                   (key, vector, time.time()))
+        self.size += cursor.rowcount
+        if self.size > self.max_entries:
+            self.evict()
+        self.conn.commit()
+
+    def evict(self):
+        '''
+        Drop the least recently used vectors beyond `max_entries`.
+        '''
+        self.size = self.conn.execute("SELECT COUNT(*) FROM harmony").fetchone()[0]
+        self.conn.execute("DELETE FROM harmony WHERE key IN "
+                          "(SELECT key FROM harmony ORDER BY last_used ASC LIMIT ?)",
+                          (max(self.size - self.max_entries, 0),))
+        self.size = min(self.size, self.max_entries)
+
+    def get_harmony_vector(self, midi, is_one_hot=False):
+        key = self.get_key(midi, is_one_hot)
+        is_hit, vector = self.get(key)
+        if not is_hit:
+            vector = get_harmony_vector(midi, is_one_hot=is_one_hot)
+            self.put(key, vector)
+        return vector
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "entries": self.size,
+                "hit_rate": self.hits / total if total else 0.}
+
+
+def get_harmony_cache(path=HARMONY_CACHE_PATH):
     '''
-    events, pitch_lst, velocity_lst, pr, rhythm = encode_midi(pr, beat=beat, is_pr=True)
+    `HarmonyCache` of the current process (SQLite connections must not cross a fork).
+    '''
+    key = (path, os.getpid())
+    if key not in HARMONY_CACHES:
+        HARMONY_CACHES[key] = HarmonyCache(path)
+    return HARMONY_CACHES[key]
 
-    # get note density
-    note_density = np.array([len(k) for k in pitch_lst])
 
-    # get chroma
-    chroma = np.zeros((pr.shape[0], 12))
-    for note in range(12):
-        chroma[:, note] = np.sum(pr[:, note::12], axis=1)
-    
-    # get velocity
-    velocity = []
-    for i in range(len(pr)):
-        if len(np.nonzero(pr[i])[0]) > 0:
-            velocity.append(int(np.sum(pr[i]) / len(np.nonzero(pr[i])[0])))
-        else:
-            velocity.append(0)
-    velocity = np.array(velocity)
+# Aarden-Essen key profiles, the weights of music21's default key analysis (`analyze('key')`)
+MAJOR_KEY_PROFILE = np.array([17.7661, 0.145624, 14.9265, 0.160186, 19.8049, 11.3587,
+                              0.291248, 22.062, 0.145624, 8.15494, 0.232998, 4.95122])
+MINOR_KEY_PROFILE = np.array([18.2648, 0.737619, 14.0499, 16.8599, 0.702494, 14.4362,
+                              0.702494, 18.6161, 4.56621, 1.93186, 7.37619, 1.75623])
+
+# Krumhansl-Kessler key profiles (music21's `analyze('key.krumhansl')`)
+KK_MAJOR_KEY_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+KK_MINOR_KEY_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+
+def get_key_profiles(major, minor):
+    '''
+    (24, 12) profiles of every key, in harmony vector order: C..B major, then C..B minor.
+    '''
+    return np.array([np.roll(major, k) for k in range(12)] + [np.roll(minor, k) for k in range(12)])
+
+
+KEY_PROFILES = {
+    "aarden": get_key_profiles(MAJOR_KEY_PROFILE, MINOR_KEY_PROFILE),
+    "krumhansl": get_key_profiles(KK_MAJOR_KEY_PROFILE, KK_MINOR_KEY_PROFILE),
+}
+
+
+def pr_to_pitch_class_histogram(pr):
+    '''
+    Pitch-class durations (in frames) of a (T, 128) roll or a (N, T, 128) batch.
+    '''
+    durations = np.count_nonzero(np.asarray(pr) > 0, axis=-2)
+    padded = np.zeros(durations.shape[:-1] + (132,))
+    padded[..., :128] = durations
+    return padded.reshape(durations.shape[:-1] + (11, 12)).sum(axis=-2)
+
+
+def midi_to_pitch_class_histogram(midi):
+    '''
+    Pitch-class durations (in seconds) of the notes of a MIDI file / in-memory MIDI.
+    '''
+    pm = midi if isinstance(midi, pretty_midi.PrettyMIDI) else load_midi(midi)
+    notes = [note for inst in pm.instruments if not inst.is_drum for note in inst.notes]
+    histogram = np.zeros(12)
+    np.add.at(histogram, np.array([note.pitch % 12 for note in notes], dtype=int),
+              np.array([note.end - note.start for note in notes], dtype=float))
+    return histogram
+
+
+def estimate_harmony_vectors(histograms, is_one_hot=False, profile="aarden"):
+    '''
+    Key estimation for a (N, 12) batch of pitch-class histograms in one matrix multiply:
+    Pearson correlation with all 24 key profiles of `KEY_PROFILES[profile]`. Returns (N, 24)
+    vectors laid out like `get_harmony_vector`; rows without notes are all zeros.
+    '''
+    histograms = np.asarray(histograms, dtype=float).reshape(-1, 12)
+    centered = histograms - histograms.mean(axis=1, keepdims=True)
+    profiles = KEY_PROFILES[profile] - KEY_PROFILES[profile].mean(axis=1, keepdims=True)
+    norm = np.linalg.norm(centered, axis=1, keepdims=True) * np.linalg.norm(profiles, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = np.where(norm > 0, centered @ profiles.T / norm, 0)
+
+    res = np.zeros_like(corr)
+    if is_one_hot:
+        rows = np.flatnonzero(norm[:, 0] > 0)
+        res[rows, np.argmax(corr[rows], axis=1)] = 1
+    else:
+        res = np.where(corr < 0.1, 0, corr)    # zero out negative values
+    return res
+
 
-    return events, rhythm, note_density, chroma, velocity
+def estimate_harmony_vector(midi, is_one_hot=False, profile="aarden"):
+    '''
+    NumPy counterpart of `get_harmony_vector` for a single MIDI file / in-memory MIDI.
+    '''
+    return estimate_harmony_vectors(midi_to_pitch_class_histogram(midi), is_one_hot=is_one_hot,
+                                    profile=profile)[0]
+
+
+def harmony_agreement_report(midis, is_one_hot=False, profile="aarden"):
+    '''
+    Compare `estimate_harmony_vector` with the music21 `get_harmony_vector` on a reference
+    set of MIDI files / in-memory MIDI objects. Prints and returns the rate of identical
+    top keys, of keys equal up to relative major / minor, and the mean absolute
+    difference of the vectors.
+    '''
+    same_key, same_relative, abs_diff = [], [], []
+    for midi in tqdm(midis):
+        ref = get_harmony_vector(midi, is_one_hot=is_one_hot)
+        if ref is None:
+            continue
+        res = estimate_harmony_vector(midi, is_one_hot=is_one_hot, profile=profile)
+
+        ref_key, res_key = np.argmax(ref), np.argmax(res)
+        same_key.append(ref_key == res_key)
+        # relative keys: C major (0) <-> A minor (21)
+        relative = (ref_key + 21) % 12 + 12 if ref_key < 12 else (ref_key - 12 + 3) % 12
+        same_relative.append(res_key in (ref_key, relative))
+        abs_diff.append(np.abs(ref - res).mean())
+
+    report = {
+        "num_of_files": len(same_key),
+        "same_key": float(np.mean(same_key)) if same_key else float("nan"),
+        "same_key_or_relative": float(np.mean(same_relative)) if same_relative else float("nan"),
+        "mean_abs_diff": float(np.mean(abs_diff)) if abs_diff else float("nan"),
+    }
+    print("Key agreement with music21 on {} files: {:.2%} same key, {:.2%} same or relative key, "
+          "mean abs. diff {:.4f}".format(report["num_of_files"], report["same_key"],
+                                         report["same_key_or_relative"], report["mean_abs_diff"]))
+    return report
+
+
+def get_batch_music_attributes(prs):
+    '''
+    Rhythm, note density, chroma and (mean) velocity for a (N, T, 128) stack of segment
+    rolls, or a list of rolls of different lengths (then each attribute is a list of
+    per-roll arrays).
+    '''
+    lengths = None
+    if not (isinstance(prs, np.ndarray) and prs.ndim == 3):
+        lengths = [len(pr) for pr in prs]
+        padded = np.zeros((len(prs), max(lengths, default=0), 128), dtype=np.uint8)
+        for i, pr in enumerate(prs):
+            padded[i, :len(pr)] = pr
+        prs = padded
+
+    rhythm = pr_to_rhythm(prs)
+    note_density = np.count_nonzero(prs, axis=-1)
+
+    # chroma: pitches folded onto pitch classes, 128 padded up to 11 octaves
+    octaves = np.zeros(prs.shape[:-1] + (132,))
+    octaves[..., :128] = prs
+    chroma = octaves.reshape(prs.shape[:-1] + (11, 12)).sum(axis=-2)
+
+    # mean velocity of the sounding notes of every frame
+    velocity = prs.sum(axis=-1, dtype=np.int64) // np.maximum(note_density, 1)
+
+    if lengths is not None:
+        return tuple([k[i, :length] for i, length in enumerate(lengths)]
+                     for k in (rhythm, note_density, chroma, velocity))
+    return rhythm, note_density, chroma, velocity
+
+
+def get_music_attributes(pr, beat=24):
+    '''
+    Get musical attributes including rhythm density, note_density, chroma and velocity
+    for a given piano roll segment (or its `PitchFrames`).
+    '''
+    if isinstance(pr, PitchFrames):
+        pr = pr.to_pr()
+    events = fast_pr_to_events(pr)
+    rhythm, note_density, chroma, velocity = get_batch_music_attributes(np.asarray(pr)[None])
+    return events, rhythm[0], note_density[0], chroma[0], velocity[0]
 
 
 def get_average_av_values(av_dict, key):
@@ -214,69 +608,377 @@ def get_average_av_values(av_dict, key):
     return arousal_values, valence_values
 
 
-def process_data(name, beat_res=4, num_of_beats=4, max_tokens=100):
+def process_data(name, beat_res=4, num_of_beats=4, max_tokens=100, harmony="profile"):
     '''
-    Utility function for each data function to extract required data.
+    Utility function for each data function to extract required data. The MIDI file is
+    parsed once; the roll, beat grid and segment filters all come from that object.
+    Harmony vectors come from the NumPy key estimator, or music21 with `harmony="music21"`.
     '''
     data_lst = []
     rhythm_lst = []
     note_density_lst = []
     chroma_lst = []
     
-    track = pypianoroll.parse(name, beat_resolution=beat_res).tracks
-
-    if len(track) > 0:
-        try:
-            pm = pretty_midi.PrettyMIDI(name)
-            beats = pm.get_beats()
-            tempo = pm.get_tempo_changes()
-            cur_idx, tempo_new = 0, []
-        
-        except Exception as e:
-            print(e)
-
-        pr = track[0].pianoroll
-
-        # extract segment by segment
-        for j in range(0, len(pr), beat_res * num_of_beats):
-            start_idx = j
-            end_idx = j + beat_res * num_of_beats
-
-            if end_idx // beat_res < len(beats):
-                new_pr = pr[start_idx : end_idx]
-                new_pm = slice_midi(pm, beats, start_idx // beat_res, end_idx // beat_res)
-                new_pm.write("tmp.mid")
-                ms = np.argmax(new_pr, axis=-1)
-
-                # ensure each segment is not empty and contain unique notes
-                if len(new_pm.instruments[0].notes) > 0 and \
-                    len(np.unique(ms)) > 2 and np.count_nonzero(ms) >= 0.75 * len(ms):
-
-                    # get musical attributes
-                    _, rhythm, note_density, chroma, \
-                        velocity = get_music_attributes(new_pr, beat=beat_res)
-
-                    # get midi encoding sequence
-                    events = magenta_encode_midi("tmp.mid")
-                    events.append(1)    # EOS token
-
-                    # filter out segments that start with 0 and limit token length
-                    if rhythm[0] == 1 and len(events) <= max_tokens:   
-                        chroma = get_harmony_vector()    # read from saved "tmp.mid" file
-                        
-                        # aggregate data points
-                        data_lst.append(torch.Tensor(events))
-                        rhythm_lst.append(rhythm)
-                        note_density_lst.append(note_density)
-                        chroma_lst.append(chroma)
+    pm = pretty_midi.PrettyMIDI(name)
+    track = parse_pretty_midi(pm, beat_resolution=beat_res, return_tracks=True)
+    if len(track) == 0:
+        return data_lst, rhythm_lst, note_density_lst, chroma_lst
+
+    pr = track[0]
+    beats = pm.get_beats()
+    steps = beat_res * num_of_beats
+
+    # all segments covered by both the roll and the beat grid, as one (N, steps, 128) batch
+    num_of_segments = max(min(len(pr) // steps, (len(beats) - 1) // num_of_beats), 0)
+    segments = pr[:num_of_segments * steps].reshape(num_of_segments, steps, 128)
+    rhythm, note_density, _, _ = get_batch_music_attributes(segments)
+
+    # ensure each segment is not empty and contain unique notes
+    ms = np.argmax(segments, axis=-1)
+    num_of_unique = (np.diff(np.sort(ms, axis=-1), axis=-1) != 0).sum(axis=-1) + 1
+    is_valid = (num_of_unique > 2) & (np.count_nonzero(ms, axis=-1) >= 0.75 * steps)
+
+    # segments need notes starting within their beats, and filter out those starting with 0
+    index = NoteIndex(pm)
+    bounds = beats[np.arange(num_of_segments + 1) * num_of_beats]
+    is_valid &= (index.count_notes(bounds[:-1], bounds[1:]) > 0) & (rhythm[:, 0] == 1)
+
+    valid_idx = np.flatnonzero(is_valid)
+    new_pms = slice_midi_windows(pm, beats, valid_idx * num_of_beats, (valid_idx + 1) * num_of_beats,
+                                 index=index)
+    chromas = estimate_harmony_vectors(index.pitch_class_histograms(
+        beats[valid_idx * num_of_beats], beats[(valid_idx + 1) * num_of_beats]))
+
+    for k, new_pm, chroma in zip(valid_idx, new_pms, chromas):
+        # get midi encoding sequence, limit token length
+        events = magenta_encode_midi(new_pm)
+        events.append(1)    # EOS token
+        if len(events) <= max_tokens:
+            if harmony == "music21":
+                chroma = get_harmony_vector(new_pm, cache=get_harmony_cache())
+
+            # aggregate data points
+            data_lst.append(torch.Tensor(events))
+            rhythm_lst.append(rhythm[k])
+            note_density_lst.append(note_density[k])
+            chroma_lst.append(chroma)
     
     return data_lst, rhythm_lst, note_density_lst, chroma_lst
 
 
-def get_classic_piano(data_type="short"):
+class RaggedTokens:
+    '''
+    Token sequences of different lengths stored as one flat buffer plus offsets: sequence
+    i is `tokens[offsets[i]:offsets[i + 1]]`. Both arrays can be memory-mapped. Indexing
+    with a slice or an index array gives a lazy view over the same buffer.
+    '''
+    def __init__(self, tokens, offsets, index=None):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.index = np.arange(len(offsets) - 1) if index is None else np.asarray(index)
+
+    @classmethod
+    def from_lists(cls, tokens_lst):
+        lengths = np.array([len(k) for k in tokens_lst], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        tokens = np.concatenate([np.asarray(k) for k in tokens_lst]) if len(tokens_lst) else np.zeros(0, dtype=int)
+        return cls(tokens, offsets)
+
+    @classmethod
+    def as_ragged(cls, column):
+        '''
+        `column` as a `RaggedTokens` store, if it is not one already.
+        '''
+        return column if isinstance(column, RaggedTokens) else cls.from_lists(column)
+
+    @classmethod
+    def from_padded(cls, data, pad=0):
+        '''
+        Strip the padding of a (N, L) padded token array.
+        '''
+        data = np.asarray(data)
+        is_token = data != pad
+        lengths = np.where(is_token.any(axis=1), data.shape[1] - np.argmax(is_token[:, ::-1], axis=1), 0)
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        return cls(data[np.arange(data.shape[1]) < lengths[:, None]], offsets)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode="r"):
+        return cls(np.load(prefix + "tokens.npy", mmap_mode=mmap_mode),
+                   np.load(prefix + "offsets.npy", mmap_mode=mmap_mode))
+
+    def contiguous(self):
+        '''
+        The sequences of this view (in view order) gathered into a new buffer, with its offsets.
+        '''
+        lengths = self.lengths()
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        gather = np.repeat(np.asarray(self.offsets)[self.index] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return np.asarray(self.tokens)[gather], offsets
+
+    def save(self, prefix, dtype=TOKEN_DTYPE):
+        '''
+        Save the sequences of this view (in view order) as `tokens.npy` / `offsets.npy`.
+        '''
+        tokens, offsets = self.contiguous()
+        np.save(prefix + "tokens.npy", tokens.astype(dtype))
+        np.save(prefix + "offsets.npy", offsets)
+
+    def lengths(self):
+        offsets = np.asarray(self.offsets)
+        return offsets[self.index + 1] - offsets[self.index]
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            k = self.index[idx]
+            return np.array(self.tokens[self.offsets[k]:self.offsets[k + 1]])
+        return RaggedTokens(self.tokens, self.offsets, self.index[idx])
+
+
+def get_device(device=None):
+    '''
+    Torch device to run on: `device` if given (e.g. "cpu", "cuda:1"), otherwise CUDA when
+    available.
+    '''
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return torch.device(device)
+
+
+def collate_padded(batch, num_of_padded=1):
+    '''
+    `DataLoader` collate function padding the first `num_of_padded` items of each sample
+    (token sequences, and rhythm / note sequences of different lengths) to the longest
+    one of the batch.
+    '''
+    padded = [torch.nn.utils.rnn.pad_sequence([torch.as_tensor(sample[i]) for sample in batch],
+                                              batch_first=True)
+              for i in range(num_of_padded)]
+    rest = torch.utils.data.dataloader.default_collate([sample[num_of_padded:] for sample in batch])
+    return padded + list(rest)
+
+
+def get_lengths(tokens, pad=0):
+    '''
+    Per-sample lengths of a padded (B, T) token batch.
+    '''
+    return (tokens != pad).sum(-1)
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    '''
+    Batch sampler grouping samples of similar length, so that per-batch padding stays
+    small. With `shuffle`, samples are shuffled, sorted by length within pools of
+    `bucket_size` batches, and the batches are shuffled again; otherwise batches follow
+    the dataset order.
+    '''
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=100):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        if not self.shuffle:
+            idx = np.arange(len(self.lengths))
+            return iter([idx[i:i + self.batch_size].tolist() for i in range(0, len(idx), self.batch_size)])
+
+        idx = np.random.permutation(len(self.lengths))
+        pool = self.batch_size * self.bucket_size
+        batches = []
+        for i in range(0, len(idx), pool):
+            bucket = idx[i:i + pool]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            batches += [bucket[j:j + self.batch_size].tolist() for j in range(0, len(bucket), self.batch_size)]
+        return iter([batches[k] for k in np.random.permutation(len(batches))])
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+SHARD_DIR = "data/values_v3/shards/"
+SEGMENT_PARAMS = {
+    "short": {"beat_res": 4, "num_of_beats": 4, "max_tokens": 100},
+    "long": {"beat_res": 4, "num_of_beats": 16, "max_tokens": 250},
+}
+
+
+def get_shard_key(name, beat_res=4, num_of_beats=4, max_tokens=100, harmony="profile"):
+    '''
+    Content hash of a MIDI file together with the segmentation parameters.
+    '''
+    sha = hashlib.sha1()
+    with open(name, "rb") as f:
+        sha.update(f.read())
+    sha.update(json.dumps([beat_res, num_of_beats, max_tokens, harmony]).encode())
+    return sha.hexdigest()
+
+
+def process_shard(job):
+    '''
+    Run `process_data` on one MIDI file and save the segments into a shard. Segments
+    without a harmony vector are dropped. Returns (file name, error message or None).
+    '''
+    name, shard_path, beat_res, num_of_beats, max_tokens, harmony = job
+    try:
+        data_lst, rhythm_lst, note_density_lst, chroma_lst = process_data(name,
+                                                                         beat_res=beat_res,
+                                                                         num_of_beats=num_of_beats,
+                                                                         max_tokens=max_tokens,
+                                                                         harmony=harmony)
+        keep = [i for i in range(len(data_lst)) if chroma_lst[i] is not None]
+        steps = beat_res * num_of_beats
+        events = [data_lst[i].numpy().astype(TOKEN_DTYPE) for i in keep]
+
+        # write to a temporary name first, so an interrupted run never leaves half a shard
+        tmp_path = shard_path + ".tmp.npz"
+        np.savez(tmp_path,
+                 events=np.concatenate(events) if events else np.zeros(0, dtype=TOKEN_DTYPE),
+                 lengths=np.array([len(k) for k in events], dtype=int),
+                 rhythm=np.array([rhythm_lst[i] for i in keep], dtype=RHYTHM_DTYPE).reshape(-1, steps),
+                 note_density=np.array([note_density_lst[i] for i in keep],
+                                       dtype=NOTE_DTYPE).reshape(-1, steps),
+                 chroma=np.array([chroma_lst[i] for i in keep], dtype=CHROMA_DTYPE).reshape(-1, 24))
+        os.replace(tmp_path, shard_path)
+        return name, None
+
+    except Exception as e:
+        return name, "{}: {}".format(type(e).__name__, e)
+
+
+def preprocess_corpus(fnames, shard_dir=SHARD_DIR, num_workers=None, beat_res=4,
+                      num_of_beats=4, max_tokens=100, harmony="profile"):
+    '''
+    Process MIDI files on a process pool into per-file shards named by `get_shard_key`.
+    Files that already have a shard for the same content and parameters are skipped,
+    so re-runs only process new or changed files. Returns the shard paths in the order
+    of `fnames` (None for files that failed).
+    '''
+    os.makedirs(shard_dir, exist_ok=True)
+    shard_paths = [os.path.join(shard_dir, get_shard_key(name, beat_res, num_of_beats, max_tokens,
+                                                         harmony) + ".npz")
+                   for name in fnames]
+    jobs = [(name, path, beat_res, num_of_beats, max_tokens, harmony)
+            for name, path in zip(fnames, shard_paths) if not os.path.exists(path)]
+    print("Files to process: {} / {}".format(len(jobs), len(fnames)))
+
+    failed = set()
+    if len(jobs) > 0:
+        with Pool(num_workers) as pool:
+            for name, error in tqdm(pool.imap_unordered(process_shard, jobs), total=len(jobs)):
+                if error is not None:
+                    print(name, error)
+                    failed.add(name)
+
+    return [None if name in failed else path for name, path in zip(fnames, shard_paths)]
+
+
+def assemble_shards(shard_paths):
     '''
-    Main data function for Yamaha Piano e-Competition dataset.
+    Concatenate shards into ragged token, rhythm, note density and chroma arrays.
     '''
+    shards = [np.load(path) for path in shard_paths if path is not None]
+    lengths = np.concatenate([k["lengths"] for k in shards])
+    events = np.concatenate([k["events"] for k in shards])
+
+    data_lst = RaggedTokens(events, np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+    rhythm_lst = np.concatenate([k["rhythm"] for k in shards])
+    note_density_lst = np.concatenate([k["note_density"] for k in shards])
+    chroma_lst = np.concatenate([k["chroma"] for k in shards])
+    return data_lst, rhythm_lst, note_density_lst, chroma_lst
+
+
+def sanitize_chroma(chroma):
+    '''
+    Keep the three largest values of every chroma row (ties included), zero out the rest.
+    Returns the sanitized chroma and a mask of the rows that are not all zeros.
+    '''
+    chroma = np.array(chroma)
+    third_largest = -np.partition(-chroma, 2, axis=1)[:, 2:3]
+    chroma[chroma < third_largest] = 0
+    return chroma, np.count_nonzero(chroma, axis=1) > 0
+
+
+def save_columns(prefix, rhythm, note_density, chroma):
+    '''
+    Save the rhythm, note density and chroma columns in their compact storage dtypes. Ragged
+    rhythm / note density columns (`RaggedTokens`) are saved as `RaggedTokens` stores under
+    `rhythm_` / `note_density_`.
+    '''
+    for name, column, dtype in [("rhythm", rhythm, RHYTHM_DTYPE), ("note_density", note_density, NOTE_DTYPE)]:
+        if isinstance(column, RaggedTokens):
+            column.save(prefix + name + "_", dtype=dtype)
+        else:
+            np.save(prefix + name + ".npy", np.asarray(column).astype(dtype))
+    np.save(prefix + "chroma.npy", np.asarray(chroma).astype(CHROMA_DTYPE))
+
+
+def get_density_columns(rhythm, note):
+    '''
+    Rhythm density (ratio of onsets) and note density (mean note count per frame) of every
+    sequence, for (N, T) arrays, lists of sequences or `RaggedTokens` stores.
+    '''
+    def row_mean(column, func):
+        if isinstance(column, np.ndarray) and column.ndim == 2:
+            return func(column).mean(axis=1)
+        column = RaggedTokens.as_ragged(column)
+        offsets = np.asarray(column.offsets)
+        rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        sums = np.bincount(rows, weights=func(np.asarray(column.tokens)), minlength=len(offsets) - 1)
+        return sums[column.index] / column.lengths()
+
+    return row_mean(rhythm, lambda k: k == 1), row_mean(note, lambda k: k)
+
+
+def get_density_classes(r_density, n_density):
+    '''
+    3-way class bins of the rhythm and note densities.
+    '''
+    c_r = np.digitize(r_density, R_DENSITY_BINS).astype(np.int8)
+    c_n = np.digitize(n_density, N_DENSITY_BINS, right=True).astype(np.int8)
+    return c_r, c_n
+
+
+def get_density_table(rhythm, note):
+    '''
+    (N, 2) densities and (N, 2) density classes, rhythm first.
+    '''
+    r_density, n_density = get_density_columns(rhythm, note)
+    return np.stack([r_density, n_density], axis=1), \
+           np.stack(get_density_classes(r_density, n_density), axis=1)
+
+
+def load_densities(prefix, rhythm, note, sources):
+    '''
+    Density table of a saved dataset, computed once and reused while newer than the
+    `sources` columns it was computed from.
+    '''
+    path, class_path = prefix + "density.npy", prefix + "density_class.npy"
+    if os.path.exists(path) and os.path.exists(class_path) and \
+        all(os.path.getmtime(path) >= os.path.getmtime(k) for k in sources):
+        return np.load(path), np.load(class_path)
+
+    density, density_class = get_density_table(rhythm, note)
+    np.save(path, density)
+    np.save(class_path, density_class)
+    return density, density_class
+
+
+def get_classic_piano(data_type="short", num_workers=None, rebuild=False, harmony="profile",
+                      return_densities=False):
+    '''
+    Main data function for Yamaha Piano e-Competition dataset. With `rebuild`, the saved
+    arrays are assembled again from the shards, processing only new or changed files.
+    With `return_densities`, the saved (densities, density classes) table is returned too.
+    '''
+    density_sources = ["data/values_v3/rhythm.npy", "data/values_v3/note_density.npy"]
     labelled_midi = ["/data/haohao_tan/haohao/classic-piano/" + k \
                       for k in os.listdir("/data/haohao_tan/haohao/classic-piano/")]
     labelled_midi += ["/data/haohao_tan/haohao/piano-e-competition/" + k \
@@ -285,41 +987,15 @@ def get_classic_piano(data_type="short"):
     print("Dataset length:", len(labelled_midi))
     keylst = labelled_midi
 
-    if not os.path.exists("data/values_v3/data.npy"):
-        data_lst = []
-        rhythm_lst = []
-        note_density_lst = []
-        tempo_change_lst = []
-        velocity_lst = []
-        chroma_lst = []
-        key_signature_lst = []
-
-        for i, name in tqdm(enumerate(keylst), total=len(keylst)):
-            try:
-                # process data
-                if data_type == "short":
-                    beat_res, num_of_beats, max_tokens = 4, 4, 100
-                elif data_type == "long":
-                    beat_res, num_of_beats, max_tokens = 4, 16, 250
-                    
-                cur_data_lst, cur_rhythm_lst, cur_note_lst, cur_chroma_lst = process_data(name,
-                                                                                          beat_res=beat_res, 
-                                                                                          num_of_beats=num_of_beats, 
-                                                                                          max_tokens=max_tokens)
-                data_lst += cur_data_lst
-                rhythm_lst += cur_rhythm_lst
-                note_density_lst += cur_note_lst
-                chroma_lst += cur_chroma_lst
-        
-            except Exception as e:
-                print(e)
-                print("Current dataset: {}".format(len(data_lst)))
+    # padded arrays of earlier versions are converted to the ragged token store once
+    if not rebuild and not os.path.exists("data/values_v3/tokens.npy") and \
+        os.path.exists("data/values_v3/data.npy"):
+        RaggedTokens.from_padded(np.load("data/values_v3/data.npy")).save("data/values_v3/")
 
-        # consolidate data
-        data_lst = torch.nn.utils.rnn.pad_sequence(data_lst, batch_first=True).numpy().astype(int)
-        rhythm_lst = np.array(rhythm_lst)
-        note_density_lst = np.array(note_density_lst)
-        chroma_lst = np.array(chroma_lst)
+    if rebuild or not os.path.exists("data/values_v3/tokens.npy"):
+        shard_paths = preprocess_corpus(keylst, num_workers=num_workers, harmony=harmony,
+                                        **SEGMENT_PARAMS[data_type])
+        data_lst, rhythm_lst, note_density_lst, chroma_lst = assemble_shards(shard_paths)
 
         # shuffle data
         np.random.seed(777)
@@ -333,77 +1009,113 @@ def get_classic_piano(data_type="short"):
         print("Shapes for: Data, Rhythm Density, Note Density, Chroma")
         print(data_lst.shape, rhythm_lst.shape, note_density_lst.shape, chroma_lst.shape)
 
-        np.save("data/values_v3/data.npy", data_lst)
-        np.save("data/values_v3/rhythm.npy", rhythm_lst)
-        np.save("data/values_v3/note_density.npy", note_density_lst)
-        np.save("data/values_v3/chroma.npy", chroma_lst)
+        data_lst.save("data/values_v3/")
+        data_lst = RaggedTokens.load("data/values_v3/")
+        save_columns("data/values_v3/", rhythm_lst, note_density_lst, chroma_lst)
+        if return_densities:
+            densities = load_densities("data/values_v3/", rhythm_lst, note_density_lst, density_sources)
 
         print("Dataset saved!")
     
     else:
-        data_lst = np.load("data/values_v3/data.npy")
+        data_lst = RaggedTokens.load("data/values_v3/")
         rhythm_lst = np.load("data/values_v3/rhythm.npy")
         note_density_lst = np.load("data/values_v3/note_density.npy")
         chroma_lst = np.load("data/values_v3/chroma.npy")
 
-        # sanitization
-        idx = []
+        # columns saved by earlier versions are rewritten in the compact dtypes once
+        if chroma_lst.dtype != CHROMA_DTYPE:
+            save_columns("data/values_v3/", rhythm_lst, note_density_lst, chroma_lst)
+            rhythm_lst = np.load("data/values_v3/rhythm.npy")
+            note_density_lst = np.load("data/values_v3/note_density.npy")
+            chroma_lst = np.load("data/values_v3/chroma.npy")
+
+        # sanitization, computed once per saved dataset
+        if os.path.exists("data/values_v3/sanitized_index.npy") and \
+            os.path.getmtime("data/values_v3/sanitized_index.npy") >= \
+            os.path.getmtime("data/values_v3/chroma.npy"):
+            idx = np.load("data/values_v3/sanitized_index.npy")
+            chroma_lst = np.load("data/values_v3/sanitized_chroma.npy")
+        else:
+            chroma_lst, keep = sanitize_chroma(chroma_lst)
+            idx = np.flatnonzero(keep)
+            chroma_lst = chroma_lst[idx]
+            np.save("data/values_v3/sanitized_chroma.npy", chroma_lst)
+            np.save("data/values_v3/sanitized_index.npy", idx)
 
-        for i in tqdm(range(len(chroma_lst))):
-            c = chroma_lst[i]
-            third_largest = -np.sort(-c)[2]
-            c[c < third_largest] = 0
-            chroma_lst[i] = c
-            if np.count_nonzero(chroma_lst[i]) == 0:
-                idx.append(i)
+        if return_densities:
+            density, density_class = load_densities("data/values_v3/", rhythm_lst, note_density_lst,
+                                                    density_sources)
+            densities = density[idx], density_class[idx]
 
-        data_lst = np.delete(data_lst, idx, axis=0)
-        rhythm_lst = np.delete(rhythm_lst, idx, axis=0)
-        note_density_lst = np.delete(note_density_lst, idx, axis=0)
-        chroma_lst = np.delete(chroma_lst, idx, axis=0)
+        data_lst = data_lst[idx]
+        rhythm_lst = rhythm_lst[idx]
+        note_density_lst = note_density_lst[idx]
 
         print("Shapes for: Data, Rhythm Density, Note Density, Chroma")
         print(data_lst.shape, rhythm_lst.shape, note_density_lst.shape, chroma_lst.shape)
 
+    if return_densities:
+        return data_lst, rhythm_lst, note_density_lst, chroma_lst, densities
     return data_lst, rhythm_lst, note_density_lst, chroma_lst
 
 
-def get_vgmidi():
+def get_vgmidi(return_densities=False):
     '''
-    Main data function for VGMIDI dataset.
+    Main data function for VGMIDI dataset. Tokens, rhythm and note density are loaded as
+    `RaggedTokens` stores. With `return_densities`, the saved (densities, density classes)
+    table is returned too.
     '''
-    data_lst = np.load("data/filtered_songs_disambiguate/song_tokens.npy", allow_pickle=True)
-    rhythm_lst = np.load("data/filtered_songs_disambiguate/rhythm_lst.npy", allow_pickle=True)
-    note_density_lst = np.load("data/filtered_songs_disambiguate/note_lst.npy", allow_pickle=True)
-    valence_lst = np.load("data/filtered_songs_disambiguate/valence_lst.npy")
-    arousal_lst = np.load("data/filtered_songs_disambiguate/arousal_lst.npy")
+    prefix = "data/filtered_songs_disambiguate/"
+    density_sources = [prefix + "rhythm_tokens.npy", prefix + "note_density_tokens.npy"]
 
-    if os.path.exists("data/filtered_songs_disambiguate/chroma_lst.npy"):
-        chroma_lst = np.load("data/filtered_songs_disambiguate/chroma_lst.npy")
-    else:
-        chroma_lst = []
-        for _, token in tqdm(enumerate(data_lst), total=len(data_lst)):
-            pm = magenta_decode_midi(token)
-            pm.write("vgmidi_tmp.mid")
-            chroma = get_harmony_vector("vgmidi_tmp.mid", is_one_hot=True)
-            chroma_lst.append(chroma)
-        chroma_lst = np.array(chroma_lst)
-        np.save("data/filtered_songs_disambiguate/chroma_lst.npy", chroma_lst)
+    # the int64 pickles of the released data are rewritten in the compact dtypes once
+    if not os.path.exists(prefix + "tokens.npy") or not os.path.exists(prefix + "chroma.npy"):
+        data_lst = np.load(prefix + "song_tokens.npy", allow_pickle=True)
+        rhythm_lst = np.load(prefix + "rhythm_lst.npy", allow_pickle=True)
+        note_density_lst = np.load(prefix + "note_lst.npy", allow_pickle=True)
+
+        if os.path.exists(prefix + "chroma_lst.npy"):
+            chroma_lst = np.load(prefix + "chroma_lst.npy")
+        else:
+            chroma_lst = []
+            for _, token in tqdm(enumerate(data_lst), total=len(data_lst)):
+                pm = magenta_decode_midi(token)
+                chroma = estimate_harmony_vector(pm, is_one_hot=True)
+                chroma_lst.append(chroma)
+
+        RaggedTokens.from_lists(data_lst).save(prefix)
+        save_columns(prefix, RaggedTokens.from_lists(rhythm_lst), RaggedTokens.from_lists(note_density_lst),
+                     chroma_lst)
+
+    data_lst = RaggedTokens.load(prefix)
+    rhythm_lst = RaggedTokens.load(prefix + "rhythm_")
+    note_density_lst = RaggedTokens.load(prefix + "note_density_")
+    chroma_lst = np.load(prefix + "chroma.npy")
+    valence_lst = np.load(prefix + "valence_lst.npy")
+    arousal_lst = np.load(prefix + "arousal_lst.npy")
     
     print("Shapes for: Data, Rhythm Density, Note Density, Chroma")
     print(data_lst.shape, rhythm_lst.shape, note_density_lst.shape, chroma_lst.shape)
     print("Shapes for: Arousal, Valence")
     print(arousal_lst.shape, valence_lst.shape)
+
+    if return_densities:
+        densities = load_densities(prefix, rhythm_lst, note_density_lst, density_sources)
+        return data_lst, rhythm_lst, note_density_lst, arousal_lst, valence_lst, chroma_lst, densities
     return data_lst, rhythm_lst, note_density_lst, arousal_lst, valence_lst, chroma_lst
 
 
 class YamahaDataset(Dataset):
     '''
-    Yamaha Piano e-competition dataset loader. No arousal/valence labels.
+    Yamaha Piano e-competition dataset loader. No arousal/valence labels. Token sequences
+    are read lazily from a `RaggedTokens` store (or rows of a padded array); use
+    `collate_padded` to pad them per batch. `densities` is the saved density table of
+    `get_classic_piano(return_densities=True)`, computed here if not given.
     '''
-    def __init__(self, data, rhythm, note, chroma, mode="train"):
+    def __init__(self, data, rhythm, note, chroma, mode="train", densities=None):
         super().__init__()
-        inputs = data, rhythm, note, chroma
+        inputs = (data, rhythm, note, chroma) + (tuple(densities) if densities is not None else ())
         indexed = []
 
         # train test split
@@ -417,18 +1129,26 @@ class YamahaDataset(Dataset):
             elif mode == "test":
                 indexed.append(input[vlen:])
 
-        self.data, self.rhythm, self.note, self.chroma = indexed
-        self.r_density = [Counter(k)[1] / len(k) for k in self.rhythm]
-        self.n_density = np.array([sum(k) / len(k) for k in self.note])
+        self.data, self.rhythm, self.note, self.chroma = indexed[:4]
+        density, density_class = indexed[4:] if densities is not None else \
+                                 get_density_table(self.rhythm, self.note)
+        self.r_density, self.n_density = density[:, 0], density[:, 1]
+        self.r_class, self.n_class = density_class[:, 0], density_class[:, 1]
                 
     def __len__(self):
         return len(self.data)
 
+    def lengths(self):
+        if isinstance(self.data, RaggedTokens):
+            return self.data.lengths()
+        return np.count_nonzero(np.asarray(self.data), axis=1)
+
     def __getitem__(self, idx):
-        x = self.data[idx]
-        r = self.rhythm[idx]
-        n = self.note[idx]
-        c = self.chroma[idx]
+        # widen the compact storage dtypes
+        x = np.asarray(self.data[idx], dtype=np.int64)
+        r = np.asarray(self.rhythm[idx], dtype=np.int64)
+        n = np.asarray(self.note[idx], dtype=np.int64)
+        c = np.asarray(self.chroma[idx], dtype=np.float32)
         
         r_density = self.r_density[idx]
         n_density = self.n_density[idx]
@@ -438,11 +1158,14 @@ class YamahaDataset(Dataset):
 
 class VGMIDIDataset(Dataset):
     '''
-    VGMIDI dataset loader.
+    VGMIDI dataset loader. Sequences are kept ragged; use `data_loader.get_loader` with
+    `num_of_padded=3` to pad tokens, rhythm and notes per batch. `densities` is the saved
+    density table of `get_vgmidi(return_densities=True)`, computed here if not given.
     '''
-    def __init__(self, data, rhythm, note, chroma, arousal, valence, mode="train"):
+    def __init__(self, data, rhythm, note, chroma, arousal, valence, mode="train", densities=None):
         super().__init__()
-        inputs = data, rhythm, note, chroma, arousal, valence
+        inputs = (data, rhythm, note, chroma, arousal, valence) + \
+                 (tuple(densities) if densities is not None else ())
         indexed = []
 
         tlen, vlen = int(0.9 * len(data)), int(0.95 * len(data))
@@ -455,19 +1178,19 @@ class VGMIDIDataset(Dataset):
             elif mode == "test":
                 indexed.append(input[vlen:])
 
-        self.data, self.rhythm, self.note, self.chroma, self.arousal, self.valence = indexed
-        self.data = [torch.Tensor(np.insert(k, -1, 1)) for k in self.data]
-        self.data = torch.nn.utils.rnn.pad_sequence(self.data, batch_first=True)
+        self.data, self.rhythm, self.note, self.chroma, self.arousal, self.valence = indexed[:6]
 
-        # put this before applying torch.Tensor
-        self.r_density = [Counter(list(k))[1] / len(k) for k in self.rhythm]
-        self.n_density = np.array([sum(k) / len(k) for k in self.note])
+        # ragged stores; EOS goes before the last token of every sequence in one insert
+        tokens, offsets = RaggedTokens.as_ragged(self.data).contiguous()
+        self.data = RaggedTokens(np.insert(tokens.astype(TOKEN_DTYPE), offsets[1:] - 1, 1),
+                                 offsets + np.arange(len(offsets)))
+        self.rhythm = RaggedTokens.as_ragged(self.rhythm)
+        self.note = RaggedTokens.as_ragged(self.note)
 
-        self.rhythm = [torch.Tensor(k) for k in self.rhythm]
-        self.note = [torch.Tensor(k) for k in self.note]
-        
-        self.rhythm = torch.nn.utils.rnn.pad_sequence(self.rhythm, batch_first=True)
-        self.note = torch.nn.utils.rnn.pad_sequence(self.note, batch_first=True)
+        density, density_class = indexed[6:] if densities is not None else \
+                                 get_density_table(self.rhythm, self.note)
+        self.r_density, self.n_density = density[:, 0], density[:, 1]
+        self.r_class, self.n_class = density_class[:, 0], density_class[:, 1]
 
         self.arousal[self.arousal >= 0] = 1
         self.arousal[self.arousal < 0] = 0
@@ -475,11 +1198,16 @@ class VGMIDIDataset(Dataset):
     def __len__(self):
         return len(self.data)
 
+    def lengths(self):
+        return self.data.lengths()
+
     def __getitem__(self, idx):
-        x = self.data[idx]
-        r = self.rhythm[idx]
-        n = self.note[idx]
-        c = self.chroma[idx]
+        # widen the compact storage dtypes; sequences come out as tensors, as before the
+        # ragged storage
+        x = torch.from_numpy(np.asarray(self.data[idx], dtype=np.int64))
+        r = torch.from_numpy(np.asarray(self.rhythm[idx], dtype=np.int64))
+        n = torch.from_numpy(np.asarray(self.note[idx], dtype=np.int64))
+        c = torch.from_numpy(np.asarray(self.chroma[idx], dtype=np.float32))
         a = self.arousal[idx]
         v  =self.valence[idx]
         
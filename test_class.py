@@ -33,10 +33,10 @@ CHROMA_DIMS = 24
 # ====================== Utility functions ======================== #
 def convert_to_one_hot(input, dims):
     if type(input) != int and len(input.shape) > 1:
-        input_oh = torch.zeros((input.shape[0], input.shape[1], dims)).cuda()
+        input_oh = torch.zeros((input.shape[0], input.shape[1], dims), device=input.device)
         input_oh = input_oh.scatter_(-1, input.unsqueeze(-1), 1.)
     else:
-        input_oh = torch.zeros((input.shape[0], dims)).cuda()
+        input_oh = torch.zeros((input.shape[0], dims), device=input.device)
         input_oh = input_oh.scatter_(-1, input.unsqueeze(-1), 1.)
     return input_oh
 
@@ -51,23 +51,15 @@ def clean_output(out):
 
 
 def repar(mu, stddev, sigma=1):
-    eps = Normal(0, sigma).sample(sample_shape=stddev.size()).cuda()
+    eps = torch.randn_like(stddev) * sigma
     z = mu + stddev * eps  # reparameterization trick
     return z
 
 
-def get_classes(r, n):
-    r_density = Counter(r)[1] / len(r)
-    if r_density < 0.3: c_r = 0
-    elif r_density < 0.5: c_r = 1
-    else: c_r = 2
-
-    n_density = sum(n) / len(n)
-    if n_density <= 2: c_n = 0
-    elif n_density <= 3.5: c_n = 1
-    else: c_n = 2
-    
-    return r_density, n_density, c_r, c_n
+def get_classes(r_lst, n_lst):
+    # densities and classes of a batch of rhythm / note sequences, as stored with the datasets
+    density, density_class = get_density_table(r_lst, n_lst)
+    return density[:, 0], density[:, 1], density_class[:, 0], density_class[:, 1]
 
 
 class BaseEvaluator:
@@ -77,6 +69,7 @@ class BaseEvaluator:
         self.num_of_samples = num_of_samples
     
     def evaluate(self, model, min_val, max_val, r_std, n_std):
+        self.device = next(model.parameters()).device
         #  run generation, calculate linear regression score
         c_lst, v_lst, r_lst, m_lst = [], [], [], []
 
@@ -105,17 +98,17 @@ class BaseEvaluator:
                 # choose a random sample from test set
                 random_idx = random.randint(0, len(self.ds) - 1)
                 d, r, n, c, r_density, n_density = self.ds[random_idx]
-                d, r, n, c = torch.from_numpy(d).cuda().long(), torch.from_numpy(r).cuda().long(), \
-                            torch.from_numpy(n).cuda().long(), torch.from_numpy(c).cuda().float()
+                d, r, n, c = torch.from_numpy(d).to(self.device).long(), torch.from_numpy(r).to(self.device).long(), \
+                            torch.from_numpy(n).to(self.device).long(), torch.from_numpy(c).to(self.device).float()
                 
                 r_density_lst.append(r_density)
                 n_density_lst.append(n_density)
 
-                d_oh = convert_to_one_hot(d, EVENT_DIMS).unsqueeze(0)
+                d_in = d.unsqueeze(0)
                 r_oh = convert_to_one_hot(r, RHYTHM_DIMS).unsqueeze(0)
                 n_oh = convert_to_one_hot(n, NOTE_DIMS).unsqueeze(0)
 
-                res = self.model_forward(model, d_oh, r_oh, n_oh, c)
+                res = self.model_forward(model, d_in, r_oh, n_oh, c)
 
                 z_r, z_n = self.handle_z_output(res)
                 z_r_lst.append(z_r.cpu().detach())
@@ -123,21 +116,22 @@ class BaseEvaluator:
 
                 # generation part
                 try:
-                    r_infer_lst, n_infer_lst = [], []
+                    r_infer_lst, n_infer_lst, pr_lst = [], [], []
                     for val in value_lst:
                         d_shifted, z_r_0 = self.shift(model, d, r, n, c, target_z_value=val)
                         pm = magenta_decode_midi(clean_output(d_shifted))
-                        pm.write('tmp.mid')
 
                         # get class
-                        track = pypianoroll.parse('tmp.mid', beat_resolution=4).tracks
+                        track = parse_pianoroll(pm, beat_resolution=4).tracks
                         if len(track) < 1: continue
-                        pr = track[0].pianoroll
-                        _, rhythm, note, chroma, _ = get_music_attributes(pr, beat=4)
-                        r_density_shifted, n_density_shifted, _, _ = get_classes(rhythm, note)
-                        r_density_lst_new.append(r_density_shifted)
-                        n_density_lst_new.append(n_density_shifted)
+                        pr_lst.append(track[0].pianoroll)
                     
+                    # attributes of all generated segments at once
+                    rhythm_lst, note_lst, _, _ = get_batch_music_attributes(pr_lst)
+                    r_density_shifted, n_density_shifted, _, _ = get_classes(rhythm_lst, note_lst)
+                    r_density_lst_new += list(r_density_shifted)
+                    n_density_lst_new += list(n_density_shifted)
+
                     if self.is_density_lst_length(r_density_lst_new, n_density_lst_new, value_lst):   
                         # errorneous if some tracks has length < 0, discard the results for this round
                         r_density_lst_new = []
@@ -193,7 +187,7 @@ class BaseEvaluator:
         print("Monotonicity: {} +/- {}".format(np.mean(m_lst), np.std(m_lst)))
         print("============================================")
 
-    def model_forward(self, model, d_oh, r_oh, n_oh, c):
+    def model_forward(self, model, d_in, r_oh, n_oh, c):
         raise NotImplementedError
 
     def shift(self, model, d, r, n, c, target_z_value):
@@ -227,15 +221,15 @@ class RhythmEvaluator(BaseEvaluator):
     def __init__(self, ds, epochs=10, num_of_samples=100):
         super().__init__(ds, epochs=epochs, num_of_samples=num_of_samples)
     
-    def model_forward(self, model, d_oh, r_oh, n_oh, c):
-        return model(d_oh, r_oh, n_oh, c.unsqueeze(0))
+    def model_forward(self, model, d_in, r_oh, n_oh, c):
+        return model(d_in, r_oh, n_oh, c.unsqueeze(0))
     
     def shift(self, model, d, r, n, c, target_z_value):
-        d_oh = convert_to_one_hot(d, EVENT_DIMS).unsqueeze(0)
+        d_in = d.unsqueeze(0)
         r_oh = convert_to_one_hot(r, RHYTHM_DIMS).unsqueeze(0)
         n_oh = convert_to_one_hot(n, NOTE_DIMS).unsqueeze(0)
         
-        res = self.model_forward(model, d_oh, r_oh, n_oh, c)        
+        res = self.model_forward(model, d_in, r_oh, n_oh, c)        
         z_r, z_n = self.handle_z_output(res)
 
         # get original latent variables
@@ -276,15 +270,15 @@ class NoteEvaluator(BaseEvaluator):
     def __init__(self, ds, epochs=10, num_of_samples=100):
         super().__init__(ds, epochs=epochs, num_of_samples=num_of_samples)
     
-    def model_forward(self, model, d_oh, r_oh, n_oh, c):
-        return model(d_oh, r_oh, n_oh, c.unsqueeze(0))
+    def model_forward(self, model, d_in, r_oh, n_oh, c):
+        return model(d_in, r_oh, n_oh, c.unsqueeze(0))
     
     def shift(self, model, d, r, n, c, target_z_value):
-        d_oh = convert_to_one_hot(d, EVENT_DIMS).unsqueeze(0)
+        d_in = d.unsqueeze(0)
         r_oh = convert_to_one_hot(r, RHYTHM_DIMS).unsqueeze(0)
         n_oh = convert_to_one_hot(n, NOTE_DIMS).unsqueeze(0)
         
-        res = self.model_forward(model, d_oh, r_oh, n_oh, c)
+        res = self.model_forward(model, d_in, r_oh, n_oh, c)
         z_r, z_n = self.handle_z_output(res)
 
         # get original latent variables
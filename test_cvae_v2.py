@@ -30,6 +30,7 @@ class CVAEEvaluator(BaseEvaluator):
         super().__init__(ds, epochs=epochs, num_of_samples=num_of_samples)
     
     def evaluate(self, model):
+        self.device = next(model.parameters()).device
         #  run generation, calculate linear regression score
         c_lst, v_lst, r_lst, m_lst = [], [], [], []
 
@@ -55,21 +56,21 @@ class CVAEEvaluator(BaseEvaluator):
 
                 random_idx = random.randint(0, len(self.ds) - 1)
                 d, r, n, c, r_density, n_density = self.ds[random_idx]
-                d, r, n, c = torch.from_numpy(d).cuda().long(), torch.from_numpy(r).cuda().long(), \
-                            torch.from_numpy(n).cuda().long(), torch.from_numpy(c).cuda().float()
+                d, r, n, c = torch.from_numpy(d).to(self.device).long(), torch.from_numpy(r).to(self.device).long(), \
+                            torch.from_numpy(n).to(self.device).long(), torch.from_numpy(c).to(self.device).float()
                 
                 r_density_lst.append(r_density)
                 n_density_lst.append(n_density)
 
-                d_oh = convert_to_one_hot(d, EVENT_DIMS).unsqueeze(0)
+                d_in = d.unsqueeze(0)
                 r_oh = convert_to_one_hot(r, RHYTHM_DIMS).unsqueeze(0)
                 n_oh = convert_to_one_hot(n, NOTE_DIMS).unsqueeze(0)
 
-                dis = self.model_forward(model, d_oh, r_density, n_density, c)
+                dis = self.model_forward(model, d_in, r_density, n_density, c)
                 z = repar(dis.mean, dis.stddev)
 
                 try:
-                    r_infer_lst, n_infer_lst = [], []
+                    r_infer_lst, n_infer_lst, pr_lst = [], [], []
                     for val in value_lst:
                         new_r_density, new_n_density = self.get_values(val, r_density, n_density)
                         
@@ -78,16 +79,17 @@ class CVAEEvaluator(BaseEvaluator):
                         d_shifted = model.global_decoder(z_cur, steps=100)
                         
                         pm = magenta_decode_midi(clean_output(d_shifted))
-                        pm.write('tmp.mid')
 
                         # get class
-                        track = pypianoroll.parse('tmp.mid', beat_resolution=4).tracks
+                        track = parse_pianoroll(pm, beat_resolution=4).tracks
                         if len(track) < 1: continue
-                        pr = track[0].pianoroll
-                        _, rhythm, note, chroma, _ = get_music_attributes(pr, beat=4)
-                        r_density_shifted, n_density_shifted, _, _ = get_classes(rhythm, note)
-                        r_density_lst_new.append(r_density_shifted)
-                        n_density_lst_new.append(n_density_shifted)
+                        pr_lst.append(track[0].pianoroll)
+
+                    # attributes of all generated segments at once
+                    rhythm_lst, note_lst, _, _ = get_batch_music_attributes(pr_lst)
+                    r_density_shifted, n_density_shifted, _, _ = get_classes(rhythm_lst, note_lst)
+                    r_density_lst_new += list(r_density_shifted)
+                    n_density_lst_new += list(n_density_shifted)
 
                     if self.is_density_lst_length(r_density_lst_new, n_density_lst_new, value_lst):   
                         # if some tracks has length < 0
@@ -146,12 +148,12 @@ class CVAEEvaluator(BaseEvaluator):
         print("============================================")
     
     def get_values(self, val, r_density, n_density):
-        new_r_density = torch.Tensor([val]).cuda().unsqueeze(-1)
-        new_n_density = torch.Tensor([n_density]).cuda().unsqueeze(-1)
+        new_r_density = torch.Tensor([val]).to(self.device).unsqueeze(-1)
+        new_n_density = torch.Tensor([n_density]).to(self.device).unsqueeze(-1)
         return new_r_density, new_n_density
 
-    def model_forward(self, model, d_oh, r_density, n_density, c):
-        dis = model.encoder(d_oh, torch.Tensor([r_density]).cuda().unsqueeze(0), torch.Tensor([n_density]).cuda().unsqueeze(0), c)
+    def model_forward(self, model, d_in, r_density, n_density, c):
+        dis = model.encoder(d_in, torch.Tensor([r_density]).to(self.device).unsqueeze(0), torch.Tensor([n_density]).to(self.device).unsqueeze(0), c)
         return dis
 
     def is_density_lst_length(self, r_density_lst_new, n_density_lst_new, value_lst):
@@ -175,8 +177,8 @@ class RhythmCVAEEvaluator(CVAEEvaluator):
         super().__init__(ds, epochs=epochs, num_of_samples=num_of_samples)
     
     def get_values(self, val, r_density, n_density):
-        new_r_density = torch.Tensor([val]).cuda().unsqueeze(-1)
-        new_n_density = torch.Tensor([n_density]).cuda().unsqueeze(-1)
+        new_r_density = torch.Tensor([val]).to(self.device).unsqueeze(-1)
+        new_n_density = torch.Tensor([n_density]).to(self.device).unsqueeze(-1)
         return new_r_density, new_n_density
 
     def is_density_lst_length(self, r_density_lst_new, n_density_lst_new, value_lst):
@@ -203,8 +205,8 @@ class NoteCVAEEvaluator(CVAEEvaluator):
         super().__init__(ds, epochs=epochs, num_of_samples=num_of_samples)
     
     def get_values(self, val, r_density, n_density):
-        new_r_density = torch.Tensor([r_density]).cuda().unsqueeze(-1)
-        new_n_density = torch.Tensor([val]).cuda().unsqueeze(-1)
+        new_r_density = torch.Tensor([r_density]).to(self.device).unsqueeze(-1)
+        new_n_density = torch.Tensor([val]).to(self.device).unsqueeze(-1)
         return new_r_density, new_n_density
 
     def is_density_lst_length(self, r_density_lst_new, n_density_lst_new, value_lst):
@@ -230,8 +232,8 @@ class RhythmFaderNetsEvaluator(RhythmCVAEEvaluator):
     def __init__(self, ds, epochs=10, num_of_samples=100):
         super().__init__(ds, epochs=epochs, num_of_samples=num_of_samples)
     
-    def model_forward(self, model, d_oh, r_density, n_density, c):
-        dis = model.encoder(d_oh)
+    def model_forward(self, model, d_in, r_density, n_density, c):
+        dis = model.encoder(d_in)
         return dis
 
 
@@ -239,8 +241,8 @@ class NoteFaderNetsEvaluator(NoteCVAEEvaluator):
     def __init__(self, ds, epochs=10, num_of_samples=100):
         super().__init__(ds, epochs=epochs, num_of_samples=num_of_samples)
     
-    def model_forward(self, model, d_oh, r_density, n_density, c):
-        dis = model.encoder(d_oh)
+    def model_forward(self, model, d_in, r_density, n_density, c):
+        dis = model.encoder(d_in)
         return dis
 
 
@@ -249,6 +251,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Training CVAE or Fader Networks.')
     parser.add_argument('--is_cvae', action='store_true',
                         help='Evaluating CVAE or Fader Networks')
+    parser.add_argument('--device', default=None,
+                        help='Torch device, e.g. cpu or cuda:0 (default: CUDA when available)')
 
     input_args = parser.parse_args()
     
@@ -262,13 +266,14 @@ if __name__ == "__main__":
     NOTE_DIMS = 16
     TEMPO_DIMS = 264
     
+    device = get_device(input_args.device)
     if input_args.is_cvae:
         print("Evaluating CVAE...")
         save_path = "params/music_attr_vae_reg_cvae.pt"
         model = MusicAttrCVAE(roll_dims=EVENT_DIMS, rhythm_dims=RHYTHM_DIMS, note_dims=NOTE_DIMS, 
                         chroma_dims=CHROMA_DIMS,
                         hidden_dims=args['hidden_dim'], z_dims=args['z_dim'], 
-                        n_step=args['time_step'])
+                        n_step=args['time_step'], device=device)
 
     else:
         print("Evaluating Fader Networks...")
@@ -276,37 +281,36 @@ if __name__ == "__main__":
         model = MusicAttrFaderNets(roll_dims=EVENT_DIMS, rhythm_dims=RHYTHM_DIMS, note_dims=NOTE_DIMS, 
                         chroma_dims=CHROMA_DIMS,
                         hidden_dims=args['hidden_dim'], z_dims=args['z_dim'], 
-                        n_step=args['time_step'])
+                        n_step=args['time_step'], device=device)
     
 
     if os.path.exists(save_path):
         print("Loading {}".format(save_path))
-        model.load_state_dict(torch.load(save_path))
+        model.load_state_dict(torch.load(save_path, map_location=device))
     else:
         print("No save path!!")
 
-    if torch.cuda.is_available():
-        print('Using: ', torch.cuda.get_device_name(torch.cuda.current_device()))
-        model.cuda()
-    else:
-        print('CPU mode')
+    print('Using: ', device)
 
     step, pre_epoch = 0, 0
     batch_size = args["batch_size"]
     # model.train()
 
     # dataloaders
-    data_lst, rhythm_lst, note_density_lst, chroma_lst = get_classic_piano()
+    data_lst, rhythm_lst, note_density_lst, chroma_lst, density_lst = get_classic_piano(return_densities=True)
     tlen, vlen = int(0.8 * len(data_lst)), int(0.9 * len(data_lst))
     train_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="train")
-    train_dl_dist = DataLoader(train_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="train", densities=density_lst)
+    train_dl_dist = DataLoader(train_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0,
+                               collate_fn=collate_padded)
     val_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="val")
-    val_dl_dist = DataLoader(val_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="val", densities=density_lst)
+    val_dl_dist = DataLoader(val_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0,
+                             collate_fn=collate_padded)
     test_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="test")
-    test_dl_dist = DataLoader(test_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="test", densities=density_lst)
+    test_dl_dist = DataLoader(test_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0,
+                              collate_fn=collate_padded)
     dl = test_dl_dist
     print(len(train_ds_dist), len(val_ds_dist), len(test_ds_dist))
 
@@ -31,6 +31,7 @@ class SingleEvaluator(BaseEvaluator):
         super().__init__(ds, epochs=epochs, num_of_samples=num_of_samples)
     
     def evaluate(self, model, min_val, max_val, r_std, n_std):
+        self.device = next(model.parameters()).device
         c_lst, v_lst, r_lst, m_lst = [], [], [], []
         
         for _ in range(self.epochs):
@@ -57,17 +58,17 @@ class SingleEvaluator(BaseEvaluator):
 
                 random_idx = random.randint(0, len(self.ds))
                 d, r, n, c, r_density, n_density = self.ds[random_idx]
-                d, r, n, c = torch.from_numpy(d).cuda().long(), torch.from_numpy(r).cuda().long(), \
-                            torch.from_numpy(n).cuda().long(), torch.from_numpy(c).cuda().float()
+                d, r, n, c = torch.from_numpy(d).to(self.device).long(), torch.from_numpy(r).to(self.device).long(), \
+                            torch.from_numpy(n).to(self.device).long(), torch.from_numpy(c).to(self.device).float()
                 
                 r_density_lst.append(r_density)
                 n_density_lst.append(n_density)
 
-                d_oh = convert_to_one_hot(d, EVENT_DIMS).unsqueeze(0)
+                d_in = d.unsqueeze(0)
                 r_oh = convert_to_one_hot(r, RHYTHM_DIMS).unsqueeze(0)
                 n_oh = convert_to_one_hot(n, NOTE_DIMS).unsqueeze(0)
 
-                res = self.model_forward(model, d_oh, r_oh, n_oh, c)
+                res = self.model_forward(model, d_in, r_oh, n_oh, c)
                 out, dis, _ = res
 
                 # get original latent variables
@@ -77,25 +78,26 @@ class SingleEvaluator(BaseEvaluator):
                 
                 # generation part
                 try:
-                    r_infer_lst, n_infer_lst = [], []
+                    r_infer_lst, n_infer_lst, pr_lst = [], [], []
                     for val in value_lst:
                         d_shifted, z_r_0 = self.shift(model, d, r, n, c, target_z_value=val)
                         pm = magenta_decode_midi(clean_output(d_shifted))
-                        pm.write('tmp.mid')
 
                         # get class
-                        track = pypianoroll.parse('tmp.mid', beat_resolution=4).tracks
+                        track = parse_pianoroll(pm, beat_resolution=4).tracks
                         if len(track) < 1: continue
-                        pr = track[0].pianoroll
-                        _, rhythm, note, chroma, _ = get_music_attributes(pr, beat=4)
-                        r_density_shifted, n_density_shifted, _, _ = get_classes(rhythm, note)
-                        r_density_lst_new.append(r_density_shifted)
-                        n_density_lst_new.append(n_density_shifted)
+                        pr_lst.append(track[0].pianoroll)
 
                         # inferred
                         z_r_lst_infer.append(z[:, 0].item())
                         z_n_lst_infer.append(z[:, 0])
                     
+                    # attributes of all generated segments at once
+                    rhythm_lst, note_lst, _, _ = get_batch_music_attributes(pr_lst)
+                    r_density_shifted, n_density_shifted, _, _ = get_classes(rhythm_lst, note_lst)
+                    r_density_lst_new += list(r_density_shifted)
+                    n_density_lst_new += list(n_density_shifted)
+
                     if self.is_density_lst_length(r_density_lst_new, n_density_lst_new, value_lst):   
                         # if some tracks has length < 0
                         r_density_lst_new = []
@@ -149,8 +151,8 @@ class SingleEvaluator(BaseEvaluator):
         print("Monotonicity: {} +/- {}".format(np.mean(m_lst), np.std(m_lst)))
         print("============================================")  
 
-    def model_forward(self, model, d_oh, r_oh, n_oh, c):
-        res = model(d_oh, c.unsqueeze(0))
+    def model_forward(self, model, d_in, r_oh, n_oh, c):
+        res = model(d_in, c.unsqueeze(0))
         return res
 
     def shift(self, model, d, r, n, c, target_z_value):
@@ -179,12 +181,12 @@ class SingleRhythmEvaluator(SingleEvaluator):
         super().__init__(ds, epochs=epochs, num_of_samples=num_of_samples)
 
     def shift(self, model, d, r, n, c, target_z_value):
-        d_oh = convert_to_one_hot(d, EVENT_DIMS).unsqueeze(0)
+        d_in = d.unsqueeze(0)
         r_oh = convert_to_one_hot(r, RHYTHM_DIMS).unsqueeze(0)
         n_oh = convert_to_one_hot(n, NOTE_DIMS).unsqueeze(0)
         c = c.unsqueeze(0)
         
-        res = model(d_oh, c)
+        res = model(d_in, c)
         out, dis, _ = res
 
         # get original latent variables
@@ -225,12 +227,12 @@ class SingleNoteEvaluator(SingleEvaluator):
         super().__init__(ds, epochs=epochs, num_of_samples=num_of_samples)
 
     def shift(self, model, d, r, n, c, target_z_value):
-        d_oh = convert_to_one_hot(d, EVENT_DIMS).unsqueeze(0)
+        d_in = d.unsqueeze(0)
         r_oh = convert_to_one_hot(r, RHYTHM_DIMS).unsqueeze(0)
         n_oh = convert_to_one_hot(n, NOTE_DIMS).unsqueeze(0)
         c = c.unsqueeze(0)
         
-        res = model(d_oh, c)
+        res = model(d_in, c)
         out, dis, _ = res
 
         # get original latent variables
@@ -275,19 +277,18 @@ def run_through(dl):
 
     for j, x in tqdm(enumerate(dl), total=len(dl)):
         d, r, n, c, r_density, n_density = x
-        d, r, n, c = d.cuda().long(), r.cuda().long(), \
-                    n.cuda().long(), c.cuda().float()
+        d, r, n, c = d.to(device).long(), r.to(device).long(), \
+                    n.to(device).long(), c.to(device).float()
         
         r_lst.append(r)
         n_lst.append(n)
         r_density_lst.append(r_density.float())
         n_density_lst.append(n_density.float())
 
-        d_oh = convert_to_one_hot(d, EVENT_DIMS)
         r_oh = convert_to_one_hot(r, RHYTHM_DIMS)
         n_oh = convert_to_one_hot(n, NOTE_DIMS)
 
-        res = model(d_oh, c)
+        res = model(d, c, lengths=get_lengths(d))
 
         # package output
         out, dis, z = res
@@ -360,39 +361,40 @@ if __name__ == "__main__":
 
     save_path = "params/music_attr_vae_reg_singlevae.pt"
     
+    device = get_device(args.get("device"))
+    
     model = MusicAttrSingleVAE(roll_dims=EVENT_DIMS, rhythm_dims=RHYTHM_DIMS, note_dims=NOTE_DIMS, 
                         chroma_dims=CHROMA_DIMS,
                         hidden_dims=args['hidden_dim'], z_dims=args['z_dim'], 
-                        n_step=args['time_step'])
+                        n_step=args['time_step'], device=device)
 
     if os.path.exists(save_path):
         print("Loading {}".format(save_path))
-        model.load_state_dict(torch.load(save_path))
+        model.load_state_dict(torch.load(save_path, map_location=device))
     else:
         print("No save path!!")
 
-    if torch.cuda.is_available():
-        print('Using: ', torch.cuda.get_device_name(torch.cuda.current_device()))
-        model.cuda()
-    else:
-        print('CPU mode')
+    print('Using: ', device)
 
     step, pre_epoch = 0, 0
     batch_size = args["batch_size"]
     # model.train()
 
     # dataloaders
-    data_lst, rhythm_lst, note_density_lst, chroma_lst = get_classic_piano()
+    data_lst, rhythm_lst, note_density_lst, chroma_lst, density_lst = get_classic_piano(return_densities=True)
     tlen, vlen = int(0.8 * len(data_lst)), int(0.9 * len(data_lst))
     train_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="train")
-    train_dl_dist = DataLoader(train_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="train", densities=density_lst)
+    train_dl_dist = DataLoader(train_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0,
+                               collate_fn=collate_padded)
     val_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="val")
-    val_dl_dist = DataLoader(val_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="val", densities=density_lst)
+    val_dl_dist = DataLoader(val_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0,
+                             collate_fn=collate_padded)
     test_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="test")
-    test_dl_dist = DataLoader(test_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="test", densities=density_lst)
+    test_dl_dist = DataLoader(test_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0,
+                              collate_fn=collate_padded)
     dl = test_dl_dist
     print(len(train_ds_dist), len(val_ds_dist), len(test_ds_dist))
 
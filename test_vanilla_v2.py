@@ -28,19 +28,18 @@ def run_through(dl):
 
     for j, x in tqdm(enumerate(dl), total=len(dl)):
         d, r, n, c, r_density, n_density = x
-        d, r, n, c = d.cuda().long(), r.cuda().long(), \
-                    n.cuda().long(), c.cuda().float()
+        d, r, n, c = d.to(device).long(), r.to(device).long(), \
+                    n.to(device).long(), c.to(device).float()
         
         r_lst.append(r)
         n_lst.append(n)
         r_density_lst.append(r_density.float())
         n_density_lst.append(n_density.float())
 
-        d_oh = convert_to_one_hot(d, EVENT_DIMS)
         r_oh = convert_to_one_hot(r, RHYTHM_DIMS)
         n_oh = convert_to_one_hot(n, NOTE_DIMS)
 
-        res = model(d_oh, r_oh, n_oh, c)
+        res = model(d, r_oh, n_oh, c, lengths=get_lengths(d))
 
         # package output
         output, dis, z_out = res
@@ -106,40 +105,40 @@ if __name__ == "__main__":
         args = json.load(f)
 
     save_path = "params/music_attr_vae_reg_vanilla.pt"
+    device = get_device(args.get("device"))
     model = MusicAttrRegVAE(roll_dims=EVENT_DIMS, rhythm_dims=RHYTHM_DIMS, note_dims=NOTE_DIMS, 
                         chroma_dims=CHROMA_DIMS,
                         hidden_dims=args['hidden_dim'], z_dims=args['z_dim'], 
-                        n_step=args['time_step'])
+                        n_step=args['time_step'], device=device)
     
 
     if os.path.exists(save_path):
         print("Loading {}".format(save_path))
-        model.load_state_dict(torch.load(save_path))
+        model.load_state_dict(torch.load(save_path, map_location=device))
     else:
         print("No save path!!")
 
-    if torch.cuda.is_available():
-        print('Using: ', torch.cuda.get_device_name(torch.cuda.current_device()))
-        model.cuda()
-    else:
-        print('CPU mode')
+    print('Using: ', device)
 
     step, pre_epoch = 0, 0
     batch_size = args["batch_size"]
     # model.train()
 
     # dataloaders
-    data_lst, rhythm_lst, note_density_lst, chroma_lst = get_classic_piano()
+    data_lst, rhythm_lst, note_density_lst, chroma_lst, density_lst = get_classic_piano(return_densities=True)
     tlen, vlen = int(0.8 * len(data_lst)), int(0.9 * len(data_lst))
     train_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="train")
-    train_dl_dist = DataLoader(train_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="train", densities=density_lst)
+    train_dl_dist = DataLoader(train_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0,
+                               collate_fn=collate_padded)
     val_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="val")
-    val_dl_dist = DataLoader(val_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="val", densities=density_lst)
+    val_dl_dist = DataLoader(val_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0,
+                             collate_fn=collate_padded)
     test_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                    chroma_lst, mode="test")
-    test_dl_dist = DataLoader(test_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0)
+                                    chroma_lst, mode="test", densities=density_lst)
+    test_dl_dist = DataLoader(test_ds_dist, batch_size=batch_size, shuffle=False, num_workers=0,
+                              collate_fn=collate_padded)
     dl = test_dl_dist
     print(len(train_ds_dist), len(val_ds_dist), len(test_ds_dist))
     
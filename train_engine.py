@@ -0,0 +1,134 @@
+'''
+Training loop shared by the trainers: mixed precision, gradient accumulation, per-epoch
+train / validation reporting and checkpointing. Each trainer plugs in a loss adapter
+`loss_fn(step, batch) -> (loss, terms)` computing its model's loss on a batch.
+'''
+import torch
+from tqdm import tqdm
+from datetime import datetime
+
+AMP_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def get_amp_dtype(device, amp=None):
+    '''
+    Autocast dtype of the "amp" config entry: "bf16", "fp16", or `True` for bf16 on CPU and
+    fp16 on CUDA. None / `False` trains in full precision.
+    '''
+    if not amp:
+        return None
+    if amp is True:
+        return torch.bfloat16 if device.type == "cpu" else torch.float16
+    return AMP_DTYPES[amp]
+
+
+class TrainEngine:
+    '''
+    Trains `model` with `optimizer` on batches from the data loaders. Gradients of
+    `accumulation_steps` batches are summed per optimizer step (an effective batch of
+    `accumulation_steps * batch_size`), then clipped to `clip`. `step` counts optimizer
+    steps, and is what the loss adapters receive for annealing.
+    '''
+    def __init__(self, model, optimizer, device, accumulation_steps=1, amp=None, clip=1):
+        self.model = model
+        self.optimizer = optimizer
+        self.device = device
+        self.accumulation_steps = accumulation_steps
+        self.amp_dtype = get_amp_dtype(device, amp)
+        self.clip = clip
+        self.scaler = torch.amp.GradScaler(device.type, enabled=self.amp_dtype == torch.float16)
+        self.step = 0
+
+    @classmethod
+    def from_config(cls, model, optimizer, device, args):
+        '''
+        Engine with the "accumulation_steps" and "amp" entries of a trainer config.
+        '''
+        return cls(model, optimizer, device, accumulation_steps=args.get("accumulation_steps", 1),
+                   amp=args.get("amp"))
+
+    def autocast(self):
+        return torch.autocast(self.device.type, dtype=self.amp_dtype,
+                              enabled=self.amp_dtype is not None)
+
+    def update(self):
+        self.scaler.unscale_(self.optimizer)
+        torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.clip)
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.optimizer.zero_grad(set_to_none=True)
+        self.step += 1
+
+    def train_epoch(self, dl, loss_fn):
+        '''
+        One pass of training over `dl`. Returns the mean loss and terms.
+        '''
+        total = 0
+        self.optimizer.zero_grad(set_to_none=True)
+        for j, x in tqdm(enumerate(dl), total=len(dl)):
+            # the last group of the epoch may hold fewer batches
+            group_start = j - j % self.accumulation_steps
+            group_len = min(self.accumulation_steps, len(dl) - group_start)
+
+            with self.autocast():
+                loss, terms = loss_fn(self.step, x)
+            self.scaler.scale(loss / group_len).backward()
+            total = total + get_terms(loss, terms)
+
+            if j + 1 == group_start + group_len:
+                self.update()
+
+        return (total / len(dl)).tolist()
+
+    def evaluate_epoch(self, dl, loss_fn):
+        '''
+        Mean loss and terms over `dl`, at the last training step.
+        '''
+        total = 0
+        with torch.no_grad():
+            for j, x in tqdm(enumerate(dl), total=len(dl)):
+                with self.autocast():
+                    loss, terms = loss_fn(self.step - 1, x)
+                total = total + get_terms(loss, terms)
+
+        return (total / len(dl)).tolist()
+
+    def save(self, save_path):
+        torch.save({k: v.cpu() for k, v in self.model.state_dict().items()}, save_path)
+
+    def fit(self, phases, n_epochs, term_names, save_path):
+        '''
+        Runs `n_epochs` epochs of each `(train_dl, val_dl, loss_fn)` phase in turn, saving the
+        model to `save_path` after every epoch and to a timestamped copy at the end.
+        '''
+        print("Mixed precision: {} - Gradient accumulation: {} steps".format(
+            self.amp_dtype, self.accumulation_steps))
+        for i in range(1, n_epochs + 1):
+            print("Epoch {} / {}".format(i, n_epochs))
+
+            for train_dl, val_dl, loss_fn in phases:
+                train_res = self.train_epoch(train_dl, loss_fn)
+                val_res = self.evaluate_epoch(val_dl, loss_fn)
+                report(train_res, val_res, term_names)
+
+            print("Saving model...")
+            self.save(save_path)
+
+        timestamp = str(datetime.now())
+        self.save(save_path[:-len(".pt")] + "_" + timestamp + ".pt")
+        print('Model saved as {}!'.format(save_path))
+
+
+def get_terms(loss, terms):
+    '''
+    Detached loss and terms as one float32 vector, so that summing them over an epoch does
+    not wait on the device.
+    '''
+    return torch.stack([k.detach().float().sum() for k in (loss,) + tuple(terms)])
+
+
+def report(train_res, val_res, term_names):
+    print('batch loss: {:.5f}  {:.5f}'.format(train_res[0], val_res[0]))
+    for mode, res in [("train", train_res), ("test", val_res)]:
+        print("{} loss by term - ".format(mode) + " ".join(
+            "{}: {:.4f}".format(name, value) for name, value in zip(term_names, res[1:])))
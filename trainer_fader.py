@@ -12,6 +12,8 @@ from torch.nn import functional as F
 from torch.optim.lr_scheduler import ExponentialLR
 from sklearn.model_selection import train_test_split
 from ptb_v2 import *
+from data_loader import *
+from train_engine import *
 
 # initialization
 with open('model_config_v2.json') as f:
@@ -32,24 +34,23 @@ RHYTHM_DIMS = 3
 NOTE_DIMS = 16
 CHROMA_DIMS = 24
 
+device = get_device(args.get("device"))
+
 model = MusicAttrFaderNets(roll_dims=EVENT_DIMS, rhythm_dims=RHYTHM_DIMS, note_dims=NOTE_DIMS, 
                         chroma_dims=CHROMA_DIMS,
                         hidden_dims=args['hidden_dim'], z_dims=args['z_dim'], 
-                        n_step=args['time_step'])
+                        n_step=args['time_step'], device=device)
 
 if os.path.exists(save_path):
     print("Loading {}".format(save_path))
-    model.load_state_dict(torch.load(save_path))
+    model.load_state_dict(torch.load(save_path, map_location=device))
 else:
     print("Save path: {}".format(save_path))
 
 optimizer = optim.Adam(model.parameters(), lr=args['lr'])
+engine = TrainEngine.from_config(model, optimizer, device, args)
 
-if torch.cuda.is_available():
-    print('Using: ', torch.cuda.get_device_name(torch.cuda.current_device()))
-    model.cuda()
-else:
-    print('CPU mode')
+print('Using: ', device)
 
 step, pre_epoch = 0, 0
 batch_size = args["batch_size"]
@@ -57,27 +58,16 @@ model.train()
 
 # dataloaders
 is_shuffle = True
-data_lst, rhythm_lst, note_density_lst, chroma_lst = get_classic_piano()
-tlen, vlen = int(0.8 * len(data_lst)), int(0.9 * len(data_lst))
-train_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                chroma_lst, mode="train")
-train_dl_dist = DataLoader(train_ds_dist, batch_size=batch_size, shuffle=is_shuffle, num_workers=0)
-val_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                chroma_lst, mode="val")
-val_dl_dist = DataLoader(val_ds_dist, batch_size=batch_size, shuffle=is_shuffle, num_workers=0)
-test_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                chroma_lst, mode="test")
-test_dl_dist = DataLoader(test_ds_dist, batch_size=batch_size, shuffle=is_shuffle, num_workers=0)
+(train_ds_dist, val_ds_dist, test_ds_dist), (train_dl_dist, val_dl_dist) = \
+    get_yamaha_loaders(batch_size, shuffle=is_shuffle, device=device,
+                       num_workers=args.get("num_workers"))
 dl = train_dl_dist
 print("Train / Validation / Test")
 print(len(train_ds_dist), len(val_ds_dist), len(test_ds_dist))
 
 
 def std_normal(shape):
-    N = Normal(torch.zeros(shape), torch.ones(shape))
-    if torch.cuda.is_available():
-        N.loc = N.loc.cuda()
-        N.scale = N.scale.cuda()
+    N = Normal(torch.zeros(shape, device=device), torch.ones(shape, device=device))
     return N
 
 
@@ -110,33 +100,14 @@ def adversarial_loss(step, r_out, n_out, r_density, n_density):
     return l_adv_r, l_adv_n
 
 
-def train(step, d_oh, r_oh, n_oh, d, r, n, c, r_density, n_density):
-    
-    optimizer.zero_grad()
+def loss_step(step, x):
+    d, r, n, c, r_density, n_density = x
+    r_density, n_density = r_density.unsqueeze(-1), n_density.unsqueeze(-1)
 
-    res = model(d_oh, r_oh, n_oh, c, r_density, n_density)
+    r_oh = convert_to_one_hot(r, RHYTHM_DIMS)
+    n_oh = convert_to_one_hot(n, NOTE_DIMS)
 
-    # package output
-    output, dis, z = res
-    out, r_out, n_out = output
-        
-    # calculate loss
-    loss, CE_X = loss_function(out, d, dis, step, beta=args['beta'])
-    l_adv_r, l_adv_n = adversarial_loss(step, r_out, n_out, r_density, n_density)
-    loss += l_adv_r + l_adv_n
-    
-    loss.backward()
-    torch.nn.utils.clip_grad_norm_(model.parameters(), 1)
-    optimizer.step()
-    step += 1
-    
-    output = loss.item(), CE_X.item(), l_adv_r.item(), l_adv_n.item()
-    return step, output
-
-
-def evaluate(step, d_oh, r_oh, n_oh, d, r, n, c, r_density, n_density):
-
-    res = model(d_oh, r_oh, n_oh, c, r_density, n_density)
+    res = model(d, r_oh, n_oh, c, r_density, n_density, lengths=get_lengths(d))
 
     # package output
     output, dis, z = res
@@ -147,102 +118,31 @@ def evaluate(step, d_oh, r_oh, n_oh, d, r, n, c, r_density, n_density):
     l_adv_r, l_adv_n = adversarial_loss(step, r_out, n_out, r_density, n_density)
     loss += l_adv_r + l_adv_n
     
-    output = loss.item(), CE_X.item(), l_adv_r.item(), l_adv_n.item()
-    return output
+    return loss, (CE_X, l_adv_r, l_adv_n)
 
 
 def convert_to_one_hot(input, dims):
     if len(input.shape) > 1:
-        input_oh = torch.zeros((input.shape[0], input.shape[1], dims)).cuda()
+        input_oh = torch.zeros((input.shape[0], input.shape[1], dims), device=input.device)
         input_oh = input_oh.scatter_(-1, input.unsqueeze(-1), 1.)
     else:
-        input_oh = torch.zeros((input.shape[0], dims)).cuda()
+        input_oh = torch.zeros((input.shape[0], dims), device=input.device)
         input_oh = input_oh.scatter_(-1, input.unsqueeze(-1), 1.)
     return input_oh
 
 
-def training_phase(step):
-    print("D - Data, R - Rhythm, N - Note, RA - Rhythm Adversarial, NA - Note Adversarial")
-    for i in range(1, args['n_epochs'] + 1):
-        print("Epoch {} / {}".format(i, args['n_epochs']))
-
-        batch_loss, batch_test_loss = 0, 0
-        b_CE_X, b_CE_R, b_CE_N = 0, 0, 0
-        t_CE_X, t_CE_R, t_CE_N = 0, 0, 0
-        b_l_r, b_l_n, t_l_r, t_l_n = 0, 0, 0, 0
-        b_l_adv_r, b_l_adv_n, t_l_adv_r, t_l_adv_n = 0, 0, 0, 0
-
-        for j, x in tqdm(enumerate(train_dl_dist), total=len(train_dl_dist)):
-
-            d, r, n, c, r_density, n_density = x
-            d, r, n, c = d.cuda().long(), r.cuda().long(), \
-                         n.cuda().long(), c.cuda().float()
-            r_density, n_density = r_density.cuda().float().unsqueeze(-1), \
-                                    n_density.cuda().float().unsqueeze(-1)
-
-            d_oh = convert_to_one_hot(d, EVENT_DIMS)
-            r_oh = convert_to_one_hot(r, RHYTHM_DIMS)
-            n_oh = convert_to_one_hot(n, NOTE_DIMS)
-
-            step, loss = train(step, d_oh, r_oh, n_oh,
-                                d, r, n, c, r_density, n_density)
-            loss, CE_X, l_adv_r, l_adv_n = loss
-            batch_loss += loss
-            b_CE_X += CE_X
-            b_l_adv_r += l_adv_r
-            b_l_adv_n += l_adv_n
-
-        for j, x in tqdm(enumerate(val_dl_dist), total=len(val_dl_dist)):
-            
-            d, r, n, c, r_density, n_density = x
-            d, r, n, c = d.cuda().long(), r.cuda().long(), \
-                         n.cuda().long(), c.cuda().float()
-            r_density, n_density = r_density.cuda().float().unsqueeze(-1), \
-                                    n_density.cuda().float().unsqueeze(-1)
-
-            d_oh = convert_to_one_hot(d, EVENT_DIMS)
-            r_oh = convert_to_one_hot(r, RHYTHM_DIMS)
-            n_oh = convert_to_one_hot(n, NOTE_DIMS)
-            
-            loss = evaluate(step, d_oh, r_oh, n_oh,
-                            d, r, n, c, r_density, n_density)
-            loss, CE_X, l_adv_r, l_adv_n = loss
-            batch_test_loss += loss
-            t_CE_X += CE_X
-            t_l_adv_r += l_adv_r
-            t_l_adv_n += l_adv_n
-        
-        print('batch loss: {:.5f}  {:.5f}'.format(batch_loss / len(train_dl_dist),
-                                                  batch_test_loss / len(val_dl_dist)))
-        print("train loss by term - D: {:.4f} R: {:.4f} N: {:.4f} RA: {:.4f} NA: {:.4f}".format(
-            b_CE_X / len(train_dl_dist), b_CE_R / len(train_dl_dist), 
-            b_CE_N / len(train_dl_dist),
-            b_l_adv_r / len(train_dl_dist), b_l_adv_n / len(train_dl_dist)
-        ))
-        print("test loss by term - D: {:.4f} R: {:.4f} N: {:.4f} RA: {:.4f} NA: {:.4f}".format(
-            t_CE_X / len(val_dl_dist), t_CE_R / len(val_dl_dist), 
-            t_CE_N / len(val_dl_dist),
-            t_l_adv_r / len(val_dl_dist), t_l_adv_n / len(val_dl_dist)
-        ))
-
-    torch.save(model.cpu().state_dict(), save_path)
-
-    timestamp = str(datetime.now())
-    save_path_timing = 'params/{}.pt'.format(args['name'] + "_" + timestamp)
-    torch.save(model.cpu().state_dict(), save_path_timing)
-
-    if torch.cuda.is_available():
-        model.cuda()
-    print('Model saved as {}!'.format(save_path))
+def training_phase():
+    print("D - Data, RA - Rhythm Adversarial, NA - Note Adversarial")
+    engine.fit([(train_dl_dist, val_dl_dist, loss_step)], args['n_epochs'],
+               ["D", "RA", "NA"], save_path)
 
 
 def evaluation_phase():
-    if torch.cuda.is_available():
-        model.cuda()
+    model.to(device)
 
     if os.path.exists(save_path):
         print("Loading {}".format(save_path))
-        model.load_state_dict(torch.load(save_path))
+        model.load_state_dict(torch.load(save_path, map_location=device))
     
     def run(dl):
         
@@ -254,16 +154,12 @@ def evaluation_phase():
 
         for i, x in tqdm(enumerate(dl), total=len(dl)):
             d, r, n, c, r_density, n_density = x
-            d, r, n, c = d.cuda().long(), r.cuda().long(), \
-                         n.cuda().long(), c.cuda().float()
-            r_density, n_density = r_density.cuda().float().unsqueeze(-1), \
-                                    n_density.cuda().float().unsqueeze(-1)
+            r_density, n_density = r_density.unsqueeze(-1), n_density.unsqueeze(-1)
 
-            d_oh = convert_to_one_hot(d, EVENT_DIMS)
             r_oh = convert_to_one_hot(r, RHYTHM_DIMS)
             n_oh = convert_to_one_hot(n, NOTE_DIMS)
             
-            res = model(d_oh, r_oh, n_oh, c, r_density, n_density)
+            res = model(d, r_oh, n_oh, c, r_density, n_density, lengths=get_lengths(d))
 
             # package output
             output, dis, z = res
@@ -323,12 +219,14 @@ def evaluation_phase():
                                                 t_acc_n / data_len))
         
 
-    dl = DataLoader(train_ds_dist, batch_size=128, shuffle=False, num_workers=0)
+    dl = get_loader(train_ds_dist, batch_size=128, shuffle=False, device=device,
+                    persistent=False)
     run(dl)
-    dl = DataLoader(test_ds_dist, batch_size=128, shuffle=False, num_workers=0)
+    dl = get_loader(test_ds_dist, batch_size=128, shuffle=False, device=device,
+                    persistent=False)
     run(dl)
 
 
-training_phase(step)
+training_phase()
 evaluation_phase()
 
@@ -15,6 +15,8 @@ from polyphonic_event_based_v2 import parse_pretty_midi
 from collections import Counter
 from sklearn.metrics import accuracy_score
 from ptb_v2 import *
+from data_loader import *
+from train_engine import *
 
 
 # some initialization
@@ -37,25 +39,24 @@ RHYTHM_DIMS = 3
 NOTE_DIMS = 16
 CHROMA_DIMS = 24
 
+device = get_device(args.get("device"))
+
 model = MusicAttrRegGMVAE(roll_dims=EVENT_DIMS, rhythm_dims=RHYTHM_DIMS, note_dims=NOTE_DIMS, 
                         chroma_dims=CHROMA_DIMS,
                         hidden_dims=args['hidden_dim'], z_dims=args['z_dim'], 
                         n_step=args['time_step'],
-                        n_component=args['num_clusters'])
+                        n_component=args['num_clusters'], device=device)
 
 if os.path.exists(save_path):
     print("Loading {}".format(save_path))
-    model.load_state_dict(torch.load(save_path))
+    model.load_state_dict(torch.load(save_path, map_location=device))
 else:
     print("Save path: {}".format(save_path))
 
 optimizer = optim.Adam(model.parameters(), lr=args['lr'])
+engine = TrainEngine.from_config(model, optimizer, device, args)
 
-if torch.cuda.is_available():
-    print('Using: ', torch.cuda.get_device_name(torch.cuda.current_device()))
-    model.cuda()
-else:
-    print('CPU mode')
+print('Using: ', device)
 
 step, pre_epoch = 0, 0
 batch_size = args["batch_size"]
@@ -65,33 +66,19 @@ model.train()
 # dataloaders
 print("Loading Yamaha...")
 is_shuffle = True
-data_lst, rhythm_lst, note_density_lst, chroma_lst = get_classic_piano()
-tlen, vlen = int(0.8 * len(data_lst)), int(0.9 * len(data_lst))
-train_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                chroma_lst, mode="train")
-train_dl_dist = DataLoader(train_ds_dist, batch_size=batch_size, shuffle=is_shuffle, num_workers=0)
-val_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                chroma_lst, mode="val")
-val_dl_dist = DataLoader(val_ds_dist, batch_size=batch_size, shuffle=is_shuffle, num_workers=0)
-test_ds_dist = YamahaDataset(data_lst, rhythm_lst, note_density_lst, 
-                                chroma_lst, mode="test")
-test_dl_dist = DataLoader(test_ds_dist, batch_size=batch_size, shuffle=is_shuffle, num_workers=0)
+(train_ds_dist, val_ds_dist, test_ds_dist), (train_dl_dist, val_dl_dist) = \
+    get_yamaha_loaders(batch_size, shuffle=is_shuffle, device=device,
+                       num_workers=args.get("num_workers"))
 dl = train_dl_dist
 print("Yamaha: Train / Validation / Test")
 print(len(train_ds_dist), len(val_ds_dist), len(test_ds_dist))
 
 # vgmidi dataloaders
 print("Loading VGMIDI...")
-data_lst, rhythm_lst, note_density_lst, arousal_lst, valence_lst, chroma_lst = get_vgmidi()
-vgm_train_ds_dist = VGMIDIDataset(data_lst, rhythm_lst, note_density_lst, 
-                                chroma_lst, arousal_lst, valence_lst, mode="train")
-vgm_train_dl_dist = DataLoader(vgm_train_ds_dist, batch_size=32, shuffle=is_shuffle, num_workers=0)
-vgm_val_ds_dist = VGMIDIDataset(data_lst, rhythm_lst, note_density_lst, 
-                                chroma_lst, arousal_lst, valence_lst, mode="val")
-vgm_val_dl_dist = DataLoader(vgm_val_ds_dist, batch_size=32, shuffle=is_shuffle, num_workers=0)
-vgm_test_ds_dist = VGMIDIDataset(data_lst, rhythm_lst, note_density_lst, 
-                                chroma_lst, arousal_lst, valence_lst, mode="test")
-vgm_test_dl_dist = DataLoader(vgm_test_ds_dist, batch_size=32, shuffle=is_shuffle, num_workers=0)
+(vgm_train_ds_dist, vgm_val_ds_dist, vgm_test_ds_dist), \
+    (vgm_train_dl_dist, vgm_val_dl_dist) = \
+    get_vgmidi_loaders(batch_size=32, shuffle=is_shuffle, device=device,
+                       num_workers=args.get("num_workers"))
 print("VGMIDI: Train / Validation / Test")
 print(len(vgm_train_ds_dist), len(vgm_val_ds_dist), len(vgm_test_ds_dist))
 print()
@@ -99,10 +86,7 @@ print()
 
 # ====================== TRAINING ===================== #
 def std_normal(shape):
-    N = Normal(torch.zeros(shape), torch.ones(shape))
-    if torch.cuda.is_available():
-        N.loc = N.loc.cuda()
-        N.scale = N.scale.cuda()
+    N = Normal(torch.zeros(shape, device=device), torch.ones(shape, device=device))
     return N
 
 
@@ -143,8 +127,8 @@ def loss_function(out, d,
     logLogit_qy_x_r, logLogit_qy_x_n = logLogit_out
     
     # KLD latent and class loss
-    kld_lat_r_total, kld_lat_n_total = torch.Tensor([0]).cuda(), torch.Tensor([0]).cuda()
-    kld_cls_r, kld_cls_n = torch.Tensor([0]).cuda(), torch.Tensor([0]).cuda()
+    kld_lat_r_total, kld_lat_n_total = torch.Tensor([0]).to(device), torch.Tensor([0]).to(device)
+    kld_cls_r, kld_cls_n = torch.Tensor([0]).to(device), torch.Tensor([0]).to(device)
 
     # Unsupervised loss
     if not is_supervised:
@@ -153,12 +137,12 @@ def loss_function(out, d,
         
         for k in torch.arange(0, n_component):       # number of components
             # infer current p(z|y)
-            mu_pz_y_r, var_pz_y_r = model.mu_r_lookup(k.cuda()), model.logvar_r_lookup(k.cuda()).exp_()
+            mu_pz_y_r, var_pz_y_r = model.mu_r_lookup(k.to(device)), model.logvar_r_lookup(k.to(device)).exp_()
             dis_pz_y_r = Normal(mu_pz_y_r, var_pz_y_r)
             kld_lat_r = torch.mean(kl_divergence(dis_r, dis_pz_y_r), dim=-1)
             kld_lat_r *= qy_x_r[:, k]
 
-            mu_pz_y_n, var_pz_y_n = model.mu_n_lookup(k.cuda()), model.logvar_n_lookup(k.cuda()).exp_()
+            mu_pz_y_n, var_pz_y_n = model.mu_n_lookup(k.to(device)), model.logvar_n_lookup(k.to(device)).exp_()
             dis_pz_y_n = Normal(mu_pz_y_n, var_pz_y_n)
             kld_lat_n = torch.mean(kl_divergence(dis_n, dis_pz_y_n), dim=-1)
             kld_lat_n *= qy_x_n[:, k]
@@ -179,18 +163,18 @@ def loss_function(out, d,
     
     # Supervised loss
     else:
-        mu_pz_y_r, var_pz_y_r = model.mu_r_lookup(y_label.cuda().long()), model.logvar_r_lookup(y_label.cuda().long()).exp_()
+        mu_pz_y_r, var_pz_y_r = model.mu_r_lookup(y_label.to(device).long()), model.logvar_r_lookup(y_label.to(device).long()).exp_()
         dis_pz_y_r = Normal(mu_pz_y_r, var_pz_y_r)
         kld_lat_r = torch.mean(kl_divergence(dis_r, dis_pz_y_r), dim=-1)
 
-        mu_pz_y_n, var_pz_y_n = model.mu_n_lookup(y_label.cuda().long()), model.logvar_n_lookup(y_label.cuda().long()).exp_()
+        mu_pz_y_n, var_pz_y_n = model.mu_n_lookup(y_label.to(device).long()), model.logvar_n_lookup(y_label.to(device).long()).exp_()
         dis_pz_y_n = Normal(mu_pz_y_n, var_pz_y_n)
         kld_lat_n = torch.mean(kl_divergence(dis_n, dis_pz_y_n), dim=-1)
 
         kld_lat_r_total, kld_lat_n_total = kld_lat_r.mean(), kld_lat_n.mean()
 
-        label_clf_loss = nn.CrossEntropyLoss()(qy_x_r, y_label.cuda().long()) + \
-                            nn.CrossEntropyLoss()(qy_x_n, y_label.cuda().long())
+        label_clf_loss = nn.CrossEntropyLoss()(qy_x_r, y_label.to(device).long()) + \
+                            nn.CrossEntropyLoss()(qy_x_n, y_label.to(device).long())
         loss = CE + beta0 * (kld_lat_r_total + kld_lat_n_total) + label_clf_loss
         
     return loss, CE_X, CE_R, CE_N, kld_lat_r_total, kld_lat_n_total, kld_cls_r, kld_cls_n
@@ -205,63 +189,29 @@ def latent_regularized_loss_function(z_out, r, n):
 
     # rhythm regularized
     r_density = r
-    D_attr_r = torch.from_numpy(np.subtract.outer(r_density, r_density)).cuda().float()
+    D_attr_r = r_density.reshape(-1, 1) - r_density
     D_z_r = z_r_new[:, 0].reshape(-1, 1) - z_r_new[:, 0]
     l_r = torch.nn.MSELoss(reduction="mean")(torch.tanh(D_z_r), torch.sign(D_attr_r))
         
     n_density = n
-    D_attr_n = torch.from_numpy(np.subtract.outer(n_density, n_density)).cuda().float()
+    D_attr_n = n_density.reshape(-1, 1) - n_density
     D_z_n = z_n_new[:, 0].reshape(-1, 1) - z_n_new[:, 0]
     l_n = torch.nn.MSELoss(reduction="mean")(torch.tanh(D_z_n), torch.sign(D_attr_n))
 
     return l_r, l_n
 
 
-def train(step, d_oh, r_oh, n_oh, d, r, n, c, r_density, n_density,
-          is_supervised=False, y_label=None):
-    
-    optimizer.zero_grad()
-    res = model(d_oh, r_oh, n_oh, c)
-
-    # package output
-    output, dis, z_out, logLogit_out, qy_x_out, y_out = res
-    out, r_out, n_out, _, _ = output
-    z_r, z_n = z_out
-
-    # calculate gmm loss
-    loss, CE_X, CE_R, CE_N, kld_lat_r_total, kld_lat_n_total, \
-        kld_cls_r, kld_cls_n = loss_function(out, d,
-                                        r_out, r,
-                                        n_out, n,
-                                        dis,
-                                        qy_x_out,
-                                        logLogit_out,
-                                        step,
-                                        beta=args['beta'],
-                                        is_supervised=is_supervised,
-                                        y_label=y_label)
-    
-    # calculate latent regularization loss
-    l_r, l_n = torch.Tensor([0]), torch.Tensor([0])
-    l_r, l_n = latent_regularized_loss_function(z_out, r_density, n_density)
-    loss += l_r + l_n
-    
-    loss.backward()
-    torch.nn.utils.clip_grad_norm_(model.parameters(), 1)
-    optimizer.step()
-    step += 1
+def loss_step(step, x, is_supervised=False):
+    if is_supervised:
+        d, r, n, c, a, v, r_density, n_density = x
+    else:
+        d, r, n, c, r_density, n_density = x
+        a = None
 
-    kld_latent = kld_lat_r_total + kld_lat_n_total
-    kld_class = kld_cls_r + kld_cls_n
-    
-    output = loss.item(), CE_X.item(), CE_R.item(), CE_N.item(), l_r.item(), l_n.item(), kld_latent.item(), kld_class.item()
-    return step, output
+    r_oh = convert_to_one_hot(r, RHYTHM_DIMS)
+    n_oh = convert_to_one_hot(n, NOTE_DIMS)
 
-
-def evaluate(step, d_oh, r_oh, n_oh, d, r, n, c, r_density, n_density,
-             is_supervised=False, y_label=None):
-    
-    res = model(d_oh, r_oh, n_oh, c)
+    res = model(d, r_oh, n_oh, c, lengths=get_lengths(d))
 
     # package output
     output, dis, z_out, logLogit_out, qy_x_out, y_out = res
@@ -279,202 +229,48 @@ def evaluate(step, d_oh, r_oh, n_oh, d, r, n, c, r_density, n_density,
                                         step,
                                         beta=args['beta'],
                                         is_supervised=is_supervised,
-                                        y_label=y_label)
+                                        y_label=a)
     
     # calculate latent regularization loss
-    l_r, l_n = torch.Tensor([0]), torch.Tensor([0])
     l_r, l_n = latent_regularized_loss_function(z_out, r_density, n_density)
     loss += l_r + l_n
 
     kld_latent = kld_lat_r_total + kld_lat_n_total
     kld_class = kld_cls_r + kld_cls_n
     
-    output = loss.item(), CE_X.item(), CE_R.item(), CE_N.item(), l_r.item(), l_n.item(), kld_latent.item(), kld_class.item()
-    return output
+    return loss, (CE_X, CE_R, CE_N, l_r, l_n, kld_latent, kld_class)
+
+
+def vgmidi_loss_step(step, x):
+    # VGMIDI batches are labelled with arousal, used as the GMM component
+    return loss_step(step, x, is_supervised=True)
 
 
 def convert_to_one_hot(input, dims):
     if len(input.shape) > 1:
-        input_oh = torch.zeros((input.shape[0], input.shape[1], dims)).cuda()
+        input_oh = torch.zeros((input.shape[0], input.shape[1], dims), device=input.device)
         input_oh = input_oh.scatter_(-1, input.unsqueeze(-1), 1.)
     else:
-        input_oh = torch.zeros((input.shape[0], dims)).cuda()
+        input_oh = torch.zeros((input.shape[0], dims), device=input.device)
         input_oh = input_oh.scatter_(-1, input.unsqueeze(-1), 1.)
     return input_oh
 
 
-def training_phase(step):
+def training_phase():
     print("D - Data, R - Rhythm, N - Note, RD - Reg. Rhythm, ND- Reg. Note, KLD-L: KLD Latent, KLD-C: KLD Class")
-    for i in range(1, args['n_epochs'] + 1):
-        print("Epoch {} / {}".format(i, args['n_epochs']))
-
-        # =================== TRAIN VGMIDI ======================== #
-
-        batch_loss, batch_test_loss = 0, 0
-        b_CE_X, b_CE_R, b_CE_N = 0, 0, 0
-        t_CE_X, t_CE_R, t_CE_N = 0, 0, 0
-        b_l_r, b_l_n, t_l_r, t_l_n = 0, 0, 0, 0
-        b_kld_latent, b_kld_class, t_kld_latent, t_kld_class  = 0, 0, 0, 0
-        
-        # train on vgmidi
-        for j, x in tqdm(enumerate(vgm_train_dl_dist), total=len(vgm_train_dl_dist)):
-
-            d, r, n, c, a, v, r_density, n_density = x
-            d, r, n, c = d.cuda().long(), r.cuda().long(), \
-                         n.cuda().long(), c.cuda().float()
-
-            d_oh = convert_to_one_hot(d, EVENT_DIMS)
-            r_oh = convert_to_one_hot(r, RHYTHM_DIMS)
-            n_oh = convert_to_one_hot(n, NOTE_DIMS)
-
-            step, loss = train(step, d_oh, r_oh, n_oh,
-                                d, r, n, c, r_density, n_density,
-                                is_supervised=True, y_label=a)
-            loss, CE_X, CE_R, CE_N, l_r, l_n, kld_latent, kld_class = loss
-            batch_loss += loss
-
-            b_CE_X += CE_X
-            b_CE_R += CE_R
-            b_CE_N += CE_N
-            b_l_r += l_r
-            b_l_n += l_n
-            b_kld_latent += kld_latent
-            b_kld_class += kld_class
-        
-        # evaluate on vgmidi
-        for j, x in tqdm(enumerate(vgm_val_dl_dist), total=len(vgm_val_dl_dist)):
-            
-            d, r, n, c, a, v, r_density, n_density = x
-            d, r, n, c = d.cuda().long(), r.cuda().long(), \
-                         n.cuda().long(), c.cuda().float()
-
-            d_oh = convert_to_one_hot(d, EVENT_DIMS)
-            r_oh = convert_to_one_hot(r, RHYTHM_DIMS)
-            n_oh = convert_to_one_hot(n, NOTE_DIMS)
-
-            loss = evaluate(step - 1, d_oh, r_oh, n_oh,
-                            d, r, n, c, r_density, n_density,
-                            is_supervised=True, y_label=a)
-            loss, CE_X, CE_R, CE_N, l_r, l_n, kld_latent, kld_class = loss
-            batch_test_loss += loss
-            
-            t_CE_X += CE_X
-            t_CE_R += CE_R
-            t_CE_N += CE_N
-            t_l_r += l_r
-            t_l_n += l_n
-            t_kld_latent += kld_latent
-            t_kld_class += kld_class
-        
-        print('batch loss: {:.5f}  {:.5f}'.format(batch_loss / len(vgm_train_dl_dist),
-                                                  batch_test_loss / len(vgm_val_dl_dist)))
-
-        print("train loss by term - D: {:.4f} R: {:.4f} N: {:.4f} RD: {:.4f} ND: {:.4f} KLD-L: {:.4f} KLD-C: {:.4f}".format(
-            b_CE_X / len(vgm_train_dl_dist), b_CE_R / len(vgm_train_dl_dist), 
-            b_CE_N / len(vgm_train_dl_dist),
-            b_l_r / len(vgm_train_dl_dist), b_l_n / len(vgm_train_dl_dist),
-            b_kld_latent / len(vgm_train_dl_dist), b_kld_class / len(vgm_train_dl_dist)
-        ))
-        print("test loss by term - D: {:.4f} R: {:.4f} N: {:.4f} RD: {:.4f} ND: {:.4f} KLD-L: {:.4f} KLD-C: {:.4f}".format(
-            t_CE_X / len(vgm_val_dl_dist), t_CE_R / len(vgm_val_dl_dist), 
-            t_CE_N / len(vgm_val_dl_dist),
-            t_l_r / len(vgm_val_dl_dist), t_l_n / len(vgm_val_dl_dist),
-            t_kld_latent / len(vgm_val_dl_dist), t_kld_class / len(vgm_val_dl_dist)
-        ))
-
-        # =================== TRAIN YAMAHA ======================== #
-        
-        batch_loss, batch_test_loss = 0, 0
-        b_CE_X, b_CE_R, b_CE_N = 0, 0, 0
-        t_CE_X, t_CE_R, t_CE_N = 0, 0, 0
-        b_l_r, b_l_n, t_l_r, t_l_n = 0, 0, 0, 0
-        b_kld_latent, b_kld_class, t_kld_latent, t_kld_class  = 0, 0, 0, 0
-
-        # train on yamaha
-        for j, x in tqdm(enumerate(train_dl_dist), total=len(train_dl_dist)):
-
-            d, r, n, c, r_density, n_density = x
-            d, r, n, c = d.cuda().long(), r.cuda().long(), \
-                         n.cuda().long(), c.cuda().float()
-
-            d_oh = convert_to_one_hot(d, EVENT_DIMS)
-            r_oh = convert_to_one_hot(r, RHYTHM_DIMS)
-            n_oh = convert_to_one_hot(n, NOTE_DIMS)
-
-            step, loss = train(step, d_oh, r_oh, n_oh, d, r, n, c, 
-                               r_density, n_density)
-            loss, CE_X, CE_R, CE_N, l_r, l_n, kld_latent, kld_class = loss
-            batch_loss += loss
-
-            b_CE_X += CE_X
-            b_CE_R += CE_R
-            b_CE_N += CE_N
-            b_l_r += l_r
-            b_l_n += l_n
-            b_kld_latent += kld_latent
-            b_kld_class += kld_class
-
-        # evaluate on yamaha
-        for j, x in tqdm(enumerate(val_dl_dist), total=len(val_dl_dist)):
-            
-            d, r, n, c, r_density, n_density = x
-            d, r, n, c = d.cuda().long(), r.cuda().long(), \
-                         n.cuda().long(), c.cuda().float()
-
-            d_oh = convert_to_one_hot(d, EVENT_DIMS)
-            r_oh = convert_to_one_hot(r, RHYTHM_DIMS)
-            n_oh = convert_to_one_hot(n, NOTE_DIMS)
-
-            loss = evaluate(step - 1, d_oh, r_oh, n_oh, d, r, n, c, 
-                            r_density, n_density)
-
-            loss, CE_X, CE_R, CE_N, l_r, l_n, kld_latent, kld_class = loss
-            batch_test_loss += loss
-
-            t_CE_X += CE_X
-            t_CE_R += CE_R
-            t_CE_N += CE_N
-            t_l_r += l_r
-            t_l_n += l_n
-            t_kld_latent += kld_latent
-            t_kld_class += kld_class
-        
-        print('batch loss: {:.5f}  {:.5f}'.format(batch_loss / len(train_dl_dist),
-                                                  batch_test_loss / len(val_dl_dist)))
-        print("train loss by term - D: {:.4f} R: {:.4f} N: {:.4f} RD: {:.4f} ND: {:.4f} KLD-L: {:.4f} KLD-C: {:.4f}".format(
-            b_CE_X / len(train_dl_dist), b_CE_R / len(train_dl_dist), 
-            b_CE_N / len(train_dl_dist),
-            b_l_r / len(train_dl_dist), b_l_n / len(train_dl_dist),
-            b_kld_latent / len(train_dl_dist), b_kld_class / len(train_dl_dist)
-        ))
-        print("test loss by term - D: {:.4f} R: {:.4f} N: {:.4f} RD: {:.4f} ND: {:.4f} KLD-L: {:.4f} KLD-C: {:.4f}".format(
-            t_CE_X / len(val_dl_dist), t_CE_R / len(val_dl_dist), 
-            t_CE_N / len(val_dl_dist),
-            t_l_r / len(val_dl_dist), t_l_n / len(val_dl_dist),
-            t_kld_latent / len(val_dl_dist), t_kld_class / len(val_dl_dist)
-        ))
-
-        print("Saving model...")
-        torch.save(model.cpu().state_dict(), save_path)
-        model.cuda()
-
-    timestamp = str(datetime.now())
-    save_path_timing = 'params/{}.pt'.format(args['name'] + "_" + timestamp)
-    torch.save(model.cpu().state_dict(), save_path_timing)
-
-    if torch.cuda.is_available():
-        model.cuda()
-    print('Model saved as {}!'.format(save_path))
+    # each epoch trains on VGMIDI (supervised), then Yamaha (unsupervised)
+    engine.fit([(vgm_train_dl_dist, vgm_val_dl_dist, vgmidi_loss_step),
+                (train_dl_dist, val_dl_dist, loss_step)], args['n_epochs'],
+               ["D", "R", "N", "RD", "ND", "KLD-L", "KLD-C"], save_path)
 
 
 def evaluation_phase():
     print("Evaluate")
-    if torch.cuda.is_available():
-        model.cuda()
+    model.to(device)
 
     if os.path.exists(save_path):
         print("Loading {}".format(save_path))
-        model.load_state_dict(torch.load(save_path))
+        model.load_state_dict(torch.load(save_path, map_location=device))
     
     def run(dl, is_vgmidi=False):
         
@@ -486,14 +282,11 @@ def evaluation_phase():
 
         for i, x in tqdm(enumerate(dl), total=len(dl)):
             d, r, n, c, a, v, r_density, n_density = x
-            d, r, n, c = d.cuda().long(), r.cuda().long(), \
-                         n.cuda().long(), c.cuda().float()
 
-            d_oh = convert_to_one_hot(d, EVENT_DIMS)
             r_oh = convert_to_one_hot(r, RHYTHM_DIMS)
             n_oh = convert_to_one_hot(n, NOTE_DIMS)
 
-            res = model(d_oh, r_oh, n_oh, c)
+            res = model(d, r_oh, n_oh, c, lengths=get_lengths(d))
 
             # package output
             output, dis, z_out, logLogit_out, qy_x_out, y_out = res
@@ -600,16 +393,20 @@ def evaluation_phase():
                                                             t_acc_a_r / data_len,
                                                             t_acc_a_n / data_len))
 
-    dl = DataLoader(train_ds_dist, batch_size=128, shuffle=False, num_workers=0)
+    dl = get_loader(train_ds_dist, batch_size=128, shuffle=False, device=device,
+                    persistent=False)
     run(dl)
-    dl = DataLoader(test_ds_dist, batch_size=128, shuffle=False, num_workers=0)
+    dl = get_loader(test_ds_dist, batch_size=128, shuffle=False, device=device,
+                    persistent=False)
     run(dl)
-    dl = DataLoader(vgm_train_ds_dist, batch_size=32, shuffle=False, num_workers=0)
+    dl = get_loader(vgm_train_ds_dist, batch_size=32, shuffle=False, device=device, num_of_padded=3,
+                    persistent=False)
     run(dl, is_vgmidi=True)
-    dl = DataLoader(vgm_test_ds_dist, batch_size=32, shuffle=False, num_workers=0)
+    dl = get_loader(vgm_test_ds_dist, batch_size=32, shuffle=False, device=device, num_of_padded=3,
+                    persistent=False)
     run(dl, is_vgmidi=True)
 
 
-training_phase(step)
+training_phase()
 evaluation_phase()
 